@@ -9,18 +9,48 @@
 # code for the these subcomponents is subject to the terms and
 # conditions of the subcomponent's license, as noted in the LICENSE file.
 #
+import importlib
 import logging
 import platform
 
-import altinity_datasets.api as api
-
 import click
 
-import pkg_resources
+# Other modules of the package are imported within the commands that use
+# them to keep startup fast for scripts.
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
+class ModuleChoice(click.ParamType):
+    """Choice of values listed in a module, which is imported when a
+       command uses the option"""
+    name = 'choice'
+
+    def __init__(self, module, attribute):
+        self.module = module
+        self.attribute = attribute
+
+    def choices(self):
+        return tuple(
+            getattr(importlib.import_module(self.module), self.attribute))
+
+    def get_metavar(self, param, ctx=None):
+        return "[{0}]".format("|".join(self.choices()))
+
+    def convert(self, value, param, ctx):
+        choices = self.choices()
+        if value not in choices:
+            self.fail(
+                "{0!r} is not one of {1}.".format(
+                    value, ", ".join(repr(c) for c in choices)), param, ctx)
+        return value
+
+    def shell_complete(self, ctx, param, incomplete):
+        from click.shell_completion import CompletionItem
+        return [CompletionItem(c) for c in self.choices()
+                if c.startswith(incomplete)]
+
+
 @click.group(context_settings=CONTEXT_SETTINGS, invoke_without_command=True)
 @click.pass_context
 @click.option('-V',
@@ -38,10 +68,12 @@ def ad_cli(ctx, verbose, log_file):
         click.secho(ctx.get_help())
         return
 
+    # Delay opening the log file until something is logged.
+    handler = logging.FileHandler(log_file, delay=True)
     if verbose:
-        logging.basicConfig(filename=log_file, level=logging.DEBUG)
+        logging.basicConfig(handlers=[handler], level=logging.DEBUG)
     else:
-        logging.basicConfig(filename=log_file, level=logging.INFO)
+        logging.basicConfig(handlers=[handler], level=logging.INFO)
 
 
 @ad_cli.command(short_help='Show version')
@@ -49,7 +81,8 @@ def ad_cli(ctx, verbose, log_file):
 def version(ctx):
     """Show version"""
     try:
-        version = pkg_resources.require("altinity-datasets")[0].version
+        from importlib import metadata
+        version = metadata.version("altinity-datasets")
     except Exception:
         version = '0.0.0'
     version_string = 'ad-cli {0}, Python {1}'.format(version,
@@ -67,10 +100,23 @@ def repo(ctx):
 @click.pass_context
 def list(ctx):
     """List dataset repositories"""
-    repos = api.repos()
+    from altinity_datasets import catalog
+    repos = catalog.repos()
     _print_dict_vertical(repos, ['name', 'description', 'path'])
 
 
+@repo.command(short_help='Index a repository for serving remotely')
+@click.pass_context
+@click.argument('path', metavar='<path>', required=True)
+def index(ctx, path):
+    """Write repo-index.json so the repository can be served over HTTP or
+    from an S3 bucket"""
+    from altinity_datasets import remote
+    repo_index = remote.build_index(path)
+    for name, entry in sorted(repo_index['datasets'].items()):
+        print("{0}: {1} files".format(name, len(entry['files'])))
+
+
 @ad_cli.group(short_help="Manage datasets")
 @click.pass_context
 def dataset(ctx):
@@ -84,6 +130,7 @@ def dataset(ctx):
 @click.option('-r', '--repo-path', help='Use this repo path')
 @click.option('-f', '--full', help='Show full description')
 def search(ctx, name, repo_path, full):
+    from altinity_datasets import api
     datasets = api.dataset_search(name, repo_path=repo_path)
     _print_dict_vertical(datasets, [
         'name', 'title', 'description', 'size', 'sources', 'notes', 'repo',
@@ -99,6 +146,9 @@ def search(ctx, name, repo_path, full):
               is_flag=True,
               default=False,
               help='Clean existing database')
+@click.option('--cluster',
+              help='Create tables ON CLUSTER and spread files over the '
+              'shards of this cluster')
 @click.option('-d', '--database', help='Database [defaults to dataset name]')
 @click.option('-D',
               '--dry_run',
@@ -110,21 +160,72 @@ def search(ctx, name, repo_path, full):
               default='localhost',
               help='Server host',
               show_default=True)
-@click.option('-p', '--password', help='ClickHouse user name')
+@click.option('--hosts',
+              metavar='HOST:PORT,...',
+              help='Create tables on and spread files over these shard '
+              'hosts')
+@click.option('-l',
+              '--loader',
+              type=ModuleChoice('altinity_datasets.formats', 'LOADERS'),
+              default='client',
+              show_default=True,
+              help='Load through clickhouse-client or native protocol')
+@click.option('--block-size',
+              type=int,
+              help='Rows per INSERT block for native loader')
+@click.option('-p', '--password', help='ClickHouse password')
 @click.option('--parallel',
               default=5,
               show_default=True,
-              help='Number of threads to run in parallel')
+              help='Number of threads to run in parallel [per shard for '
+              'cluster loads]')
 @click.option('-P',
               '--port',
               type=int,
               help='Server port [Defaults to 9000 or 9443 depending on -s]')
 @click.option('-r', '--repo-path', default=None, help='Datasets repository')
+@click.option('--report',
+              help='Write throughput report to file [Prometheus text if '
+              'name ends in .prom, otherwise JSON]')
+@click.option('-R',
+              '--resume',
+              is_flag=True,
+              default=False,
+              help='Skip files already loaded according to the journal')
+@click.option('--journal', help='Load journal file [defaults to dataset dir]')
 @click.option('-s',
               '--secure',
               is_flag=True,
               default=False,
               help='Use secure connection to server')
+@click.option('--setting',
+              multiple=True,
+              metavar='NAME=VALUE',
+              help='Insert setting that overrides the profile [repeatable]')
+@click.option('--settings-profile',
+              type=click.Choice(['manifest', 'auto', 'none']),
+              default='manifest',
+              show_default=True,
+              help='Apply manifest settings, also size inserts for the '
+              'server, or apply only --setting')
+@click.option('--source',
+              type=click.Choice(['files', 'parquet', 'parquet_hive']),
+              default='files',
+              show_default=True,
+              help='Load data files or have the server insert from manifest '
+              'object storage locations')
+@click.option('--split-size',
+              default=0,
+              show_default=True,
+              help='Split files larger than this many MB (0 to disable)')
+@click.option('--staging',
+              is_flag=True,
+              default=False,
+              help='Load into staging tables and replace partitions when '
+              'each table has loaded')
+@click.option('--partition-filter',
+              help='SQL condition on hive partition columns, e.g., '
+              '"year >= 2020" [parquet_hive source only]')
 @click.option('--verify/--no-verify',
               is_flag=True,
               default=True,
@@ -135,20 +236,102 @@ def search(ctx, name, repo_path, full):
               default='default',
               show_default=True)
 def load(ctx, name, repo_path, host, port, secure, verify, user, password,
-         database, parallel, clean, dry_run):
-    api.dataset_load(name,
-                     repo_path=repo_path,
-                     host=host,
-                     port=port,
-                     secure=secure,
-                     verify=verify,
-                     user=user,
-                     password=password,
-                     database=database,
-                     parallel=parallel,
-                     clean=clean,
-                     dry_run=dry_run,
-                     progress_reporter=_print_progress)
+         database, parallel, clean, loader, block_size, split_size, resume,
+         journal, source, partition_filter, settings_profile, setting,
+         staging, cluster, hosts, report, dry_run):
+    from altinity_datasets import api
+    from altinity_datasets import native_load
+    if block_size is None:
+        block_size = native_load.DEFAULT_BLOCK_SIZE
+    insert_settings = {}
+    for name_value in setting:
+        if '=' not in name_value:
+            raise click.BadParameter(
+                "Expected NAME=VALUE: {0}".format(name_value))
+        key, value = name_value.split('=', 1)
+        insert_settings[key.strip()] = value.strip()
+    load_report = api.dataset_load(name,
+                                   repo_path=repo_path,
+                                   host=host,
+                                   port=port,
+                                   secure=secure,
+                                   verify=verify,
+                                   user=user,
+                                   password=password,
+                                   database=database,
+                                   parallel=parallel,
+                                   clean=clean,
+                                   loader=loader,
+                                   block_size=block_size,
+                                   split_size=split_size * 1024 * 1024,
+                                   resume=resume,
+                                   journal_path=journal,
+                                   source=source,
+                                   partition_filter=partition_filter,
+                                   settings_profile=settings_profile,
+                                   insert_settings=insert_settings,
+                                   staging=staging,
+                                   cluster=cluster,
+                                   hosts=hosts.split(',') if hosts else None,
+                                   dry_run=dry_run,
+                                   progress_reporter=_print_progress)
+    if report:
+        load_report.write(report)
+
+
+@dataset.command(short_help='Publish tables kept by a staged load')
+@click.pass_context
+@click.argument('name', metavar='<name>', required=True)
+@click.option('-d', '--database', help='Database [defaults to dataset name]')
+@click.option('-D',
+              '--dry_run',
+              is_flag=True,
+              default=False,
+              help='Print commands only')
+@click.option('-H',
+              '--host',
+              default='localhost',
+              help='Server host',
+              show_default=True)
+@click.option('-p', '--password', help='ClickHouse password')
+@click.option('-P',
+              '--port',
+              type=int,
+              help='Server port [Defaults to 9000 or 9443 depending on -s]')
+@click.option('--report',
+              help='Write throughput report to file [Prometheus text if '
+              'name ends in .prom, otherwise JSON]')
+@click.option('-s',
+              '--secure',
+              is_flag=True,
+              default=False,
+              help='Use secure connection to server')
+@click.option('--verify/--no-verify',
+              is_flag=True,
+              default=True,
+              help='Verify certificate of secure connection')
+@click.option('-u',
+              '--user',
+              help='ClickHouse user name',
+              default='default',
+              show_default=True)
+def publish(ctx, name, host, port, secure, verify, user, password, database,
+            report, dry_run):
+    """Retry publishing tables whose staging tables a staged load kept
+       after they failed to publish"""
+    from altinity_datasets import api
+    publish_report = api.dataset_publish(name,
+                                         host=host,
+                                         port=port,
+                                         secure=secure,
+                                         verify=verify,
+                                         user=user,
+                                         password=password,
+                                         database=database,
+                                         dry_run=dry_run,
+                                         progress_reporter=_print_progress)
+    if report:
+        publish_report.write(report)
 
 
 @dataset.command(short_help='Dump a live dataset from database to files')
@@ -159,6 +342,16 @@ def load(ctx, name, repo_path, host, port, secure, verify, user, password,
               is_flag=True,
               help='Compress data files',
               default=False)
+@click.option('--codec',
+              type=ModuleChoice('altinity_datasets.formats', 'CODECS'),
+              help='Compression codec [overrides gzip from --compress]')
+@click.option('--compressor',
+              type=ModuleChoice('altinity_datasets.formats', 'COMPRESSORS'),
+              help='Compress with gzip command, clickhouse-client or '
+              'parallel threads')
+@click.option('--compress-threads',
+              type=int,
+              help='Threads per file for parallel compressor')
 @click.option('-d', '--database', help='Database [defaults to dataset name]')
 @click.option('-D',
               '--dry_run',
@@ -170,12 +363,27 @@ def load(ctx, name, repo_path, host, port, secure, verify, user, password,
               default='localhost',
               help='Server host',
               show_default=True)
+@click.option('--incremental',
+              is_flag=True,
+              default=False,
+              help='Dump only partitions changed since the last dump')
+@click.option('-f',
+              '--format',
+              type=ModuleChoice('altinity_datasets.formats', 'DUMP_FORMATS'),
+              default='CSVWithNames',
+              show_default=True,
+              help='Data file format')
+@click.option('--file-size',
+              default=0,
+              show_default=True,
+              help='Target MB per data file (0 for one file per partition)')
+@click.option('--level', type=int, help='Compression level for --codec')
 @click.option('-o',
               '--overwrite',
               is_flag=True,
               help='Overwrite existing files',
               default=False)
-@click.option('-p', '--password', help='ClickHouse user name')
+@click.option('-p', '--password', help='ClickHouse password')
 @click.option('--parallel',
               default=5,
               show_default=True,
@@ -190,6 +398,13 @@ def load(ctx, name, repo_path, host, port, secure, verify, user, password,
               is_flag=True,
               default=False,
               help='Use secure connection to server')
+@click.option('--report',
+              help='Write throughput report to file [Prometheus text if '
+              'name ends in .prom, otherwise JSON]')
+@click.option('--seekable',
+              is_flag=True,
+              default=False,
+              help='Write compressed files that loads can split')
 @click.option('--verify/--no-verify',
               is_flag=True,
               default=True,
@@ -201,22 +416,124 @@ def load(ctx, name, repo_path, host, port, secure, verify, user, password,
               default='default',
               show_default=True)
 def dump(ctx, name, repo_path, host, port, secure, verify, user, password,
-         database, tables, parallel, overwrite, compress, dry_run):
-    api.dataset_dump(name,
-                     repo_path=repo_path,
-                     host=host,
-                     port=port,
-                     secure=secure,
-                     verify=verify,
-                     user=user,
-                     password=password,
-                     database=database,
-                     table_regex=tables,
-                     parallel=parallel,
-                     overwrite=overwrite,
-                     compress=compress,
-                     dry_run=dry_run,
-                     progress_reporter=_print_progress)
+         database, tables, parallel, overwrite, incremental, compress,
+         seekable, file_size, format, codec, level, compressor,
+         compress_threads, report, dry_run):
+    from altinity_datasets import api
+    dump_report = api.dataset_dump(name,
+                                   repo_path=repo_path,
+                                   host=host,
+                                   port=port,
+                                   secure=secure,
+                                   verify=verify,
+                                   user=user,
+                                   password=password,
+                                   database=database,
+                                   table_regex=tables,
+                                   parallel=parallel,
+                                   overwrite=overwrite,
+                                   incremental=incremental,
+                                   compress=compress,
+                                   seekable=seekable,
+                                   file_size=file_size * 1024 * 1024,
+                                   format=format,
+                                   codec=codec,
+                                   level=level,
+                                   compressor=compressor,
+                                   compress_threads=compress_threads,
+                                   dry_run=dry_run,
+                                   progress_reporter=_print_progress)
+    if report:
+        dump_report.write(report)
+
+
+@dataset.command(short_help='Generate synthetic data for a dataset')
+@click.pass_context
+@click.argument('name', metavar='<name>', required=True)
+@click.option('--scale',
+              type=float,
+              required=True,
+              help='Scale factor [about this many GB of CSV data]')
+@click.option('-C',
+              '--clean',
+              is_flag=True,
+              default=False,
+              help='Clean existing database with --load')
+@click.option('--codec',
+              type=ModuleChoice('altinity_datasets.formats', 'CODECS'),
+              help='Compress generated files')
+@click.option('-d', '--database', help='Database [defaults to dataset name]')
+@click.option('--file-rows',
+              type=int,
+              help='Rows per file or insert stream')
+@click.option('-H',
+              '--host',
+              default='localhost',
+              help='Server host',
+              show_default=True)
+@click.option('--load',
+              is_flag=True,
+              default=False,
+              help='Insert generated data instead of writing files')
+@click.option('-O', '--output-path', help='Repo directory for generated data')
+@click.option('-o',
+              '--overwrite',
+              is_flag=True,
+              help='Overwrite existing files',
+              default=False)
+@click.option('-p', '--password', help='ClickHouse password')
+@click.option('--parallel',
+              type=int,
+              help='Number of worker processes [defaults to CPU count]')
+@click.option('-P',
+              '--port',
+              type=int,
+              help='Server port [Defaults to 9000 or 9443 depending on -s]')
+@click.option('-r', '--repo-path', default=None, help='Datasets repository')
+@click.option('--seed',
+              default=0,
+              show_default=True,
+              help='Random seed for repeatable data')
+@click.option('-s',
+              '--secure',
+              is_flag=True,
+              default=False,
+              help='Use secure connection to server')
+@click.option('--verify/--no-verify',
+              is_flag=True,
+              default=True,
+              help='Verify certificate of secure connection')
+@click.option('-u',
+              '--user',
+              help='ClickHouse user name',
+              default='default',
+              show_default=True)
+def generate(ctx, name, scale, repo_path, output_path, overwrite, codec,
+             file_rows, seed, parallel, load, host, port, secure, verify,
+             user, password, database, clean):
+    from altinity_datasets import api
+    from altinity_datasets.generate import DEFAULT_FILE_ROWS
+    if file_rows is None:
+        file_rows = DEFAULT_FILE_ROWS
+    api.dataset_generate(name,
+                         scale,
+                         repo_path=repo_path,
+                         output_path=output_path,
+                         overwrite=overwrite,
+                         codec=codec,
+                         file_rows=file_rows,
+                         seed=seed,
+                         parallel=parallel,
+                         load=load,
+                         host=host,
+                         port=port,
+                         secure=secure,
+                         verify=verify,
+                         user=user,
+                         password=password,
+                         database=database,
+                         clean=clean,
+                         progress_reporter=_print_progress)
 
 
 def _print_progress(message):
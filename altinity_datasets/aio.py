@@ -0,0 +1,552 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import signal
+import time
+
+from altinity_datasets import api
+from altinity_datasets import clickhouse
+from altinity_datasets import native_load
+from altinity_datasets import report
+from altinity_datasets import server_load
+from altinity_datasets.proc_pool import ProcessResult
+"""Asyncio versions of dataset load and dump for use within an event loop.
+   Commands run as asyncio subprocesses.  Planning, DDL, native inserts and
+   server-side inserts use the blocking driver on the loop's default
+   executor"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Result of runs that only log what they would do in a dry run.
+DRY_RUN = object()
+
+
+class ProgressEvent:
+    """Progress of a load or dump job"""
+
+    def __init__(self, state, message, table=None, name=None, result=None):
+        """Define an event
+        :param state: (str): 'message' for job progress, or 'started',
+                             'succeeded', 'failed' or 'cancelled' for an
+                             operation on one file
+        :param message: (str): Progress message
+        :param table: (str): Table of the operation
+        :param name: (str): File or partition of the operation
+        :param result: Operation result: a ProcessResult for commands, rows
+                       for native loads, or an exception for failures
+        """
+        self.state = state
+        self.message = message
+        self.table = table
+        self.name = name
+        self.result = result
+
+    def __repr__(self):
+        return "ProgressEvent({0}, {1!r})".format(self.state, self.message)
+
+
+class Job:
+    """A load or dump running as a task on the event loop.  Await the job
+       for its Report.  Iterate over it with async for to get progress
+       events until it finishes"""
+
+    def __init__(self, run, parallel):
+        """Start a job.  Must be called from a running event loop
+        :param run: (function): Coroutine function that takes the job
+        :param parallel: (int): Maximum operations of this job at once
+        """
+        self.semaphore = asyncio.Semaphore(parallel)
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self.task = self._loop.create_task(run(self))
+        self.task.add_done_callback(lambda _: self._events.put_nowait(None))
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def __aiter__(self):
+        return self._iter_events()
+
+    async def _iter_events(self):
+        while True:
+            event = await self._events.get()
+            if event is None:
+                return
+            yield event
+
+    def cancel(self):
+        """Cancel the job.  Running commands are terminated"""
+        return self.task.cancel()
+
+    def emit(self, event):
+        """Post an event.  May be called from any thread"""
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def progress(self, message):
+        """Progress reporter for blocking api functions"""
+        self.emit(ProgressEvent('message', message))
+
+    async def run_blocking(self, function, *args):
+        """Run a blocking function on the default executor"""
+        return await self._loop.run_in_executor(
+            None, functools.partial(function, *args))
+
+
+def start_load(name, limit=None, **options):
+    """Start loading a dataset on the running event loop
+    :param name: (str): Name of dataset
+    :param limit: (asyncio.Semaphore): If specified, a limit on concurrent
+                                       operations shared by all jobs that
+                                       use it.  Each job also runs at most
+                                       parallel operations
+    :param options: Keyword arguments of api.dataset_load other than
+                    progress_reporter
+    :return: Job that returns a Report
+    """
+    args = _bind(api.dataset_load, name, options)
+    return Job(functools.partial(_run_load, args=args, limit=limit),
+               args['parallel'])
+
+
+async def dataset_load(name, limit=None, **options):
+    """Load a dataset.  Arguments are the same as start_load
+    :return: Report with rows, bytes and timings of each operation
+    """
+    return await start_load(name, limit, **options)
+
+
+def start_dump(name, limit=None, **options):
+    """Start dumping a dataset on the running event loop
+    :param name: (str): Name of dataset
+    :param limit: (asyncio.Semaphore): Shared limit as for start_load
+    :param options: Keyword arguments of api.dataset_dump other than
+                    progress_reporter
+    :return: Job that returns a Report
+    """
+    args = _bind(api.dataset_dump, name, options)
+    return Job(functools.partial(_run_dump, args=args, limit=limit),
+               args['parallel'])
+
+
+async def dataset_dump(name, limit=None, **options):
+    """Dump a dataset.  Arguments are the same as start_dump
+    :return: Report with rows, bytes and timings of each operation
+    """
+    return await start_dump(name, limit, **options)
+
+
+def _bind(function, name, options):
+    """Return arguments of a blocking api function with defaults filled in"""
+    if 'progress_reporter' in options:
+        raise Exception("Use job events instead of progress_reporter")
+    bound = inspect.signature(function).bind(name, **options)
+    bound.apply_defaults()
+    return bound.arguments
+
+
+async def _run_load(job, args, limit):
+    a = args
+    load_report = report.Report(
+        'load', a['name'],
+        a['name'] if a['database'] is None else a['database'])
+    api.check_load(a['source'], a['resume'], a['staging'], a['cluster'],
+                   a['hosts'])
+    if a['source'] != 'files':
+        await _run_server_load(job, a, limit, load_report)
+    else:
+        await _run_file_load(job, a, limit, load_report)
+    api.summarize(load_report, job.progress)
+    return load_report
+
+
+async def _run_file_load(job, a, limit, load_report):
+    (ch, load_journal, load_files, ddl_runner, prefetcher,
+     load_settings) = await job.run_blocking(
+         api.prepare_load, a['name'], a['repo_path'], a['host'], a['port'],
+         a['secure'], a['verify'], a['user'], a['password'], a['database'],
+         a['parallel'], a['clean'], a['loader'], a['split_size'],
+         a['resume'], a['journal_path'], a['settings_profile'],
+         a['insert_settings'], a['cluster'], a['hosts'], a['dry_run'],
+         job.progress)
+    targets = []
+    ready_tasks = []
+    try:
+        targets = api.load_targets(ch, a['host'], a['port'], load_files,
+                                   a['staging'], a['parallel'], load_journal,
+                                   a['resume'], a['dry_run'], job.progress)
+        loads = []
+        for target in targets:
+            semaphore = job.semaphore
+            if len(targets) > 1:
+                # Each shard runs up to parallel operations.
+                semaphore = asyncio.Semaphore(a['parallel'])
+                message = "Loading shard: host={0}, files={1}".format(
+                    target[0], len(target[3]))
+                logger.info(message)
+                job.progress(message)
+            loads.append(
+                asyncio.ensure_future(
+                    _run_target_load(job, limit, semaphore, a, target,
+                                     load_journal, load_settings,
+                                     load_report, ddl_runner, ready_tasks)))
+        await _gather(loads)
+        await job.run_blocking(api.finish_load, targets, load_report,
+                               ddl_runner)
+    finally:
+        # Stop the DDL so that tables being prepared stop waiting for it.
+        await job.run_blocking(ddl_runner.close)
+        await asyncio.gather(*ready_tasks, return_exceptions=True)
+        await job.run_blocking(api.close_load, ch, targets, ddl_runner,
+                               prefetcher)
+
+
+async def _run_target_load(job, limit, semaphore, a, target, load_journal,
+                           load_settings, load_report, ddl_runner,
+                           ready_tasks):
+    """Load the files of one target from api.load_targets
+    :param semaphore: (asyncio.Semaphore): Limit on operations of the target
+    :param ready_tasks: (list): Tasks that prepare tables are added here
+    """
+    host, port, ch, load_files, staged = target
+    native = a['loader'] == 'native' and not a['dry_run']
+    columns = {}
+    table_tasks = {}
+    if staged is not None:
+        # Files are journaled when their table publishes.
+        load_journal = staged
+
+    async def prepare_table(table):
+        # Wait for the table's DDL, then look up native column types.
+        await job.run_blocking(ddl_runner.wait, table)
+        if staged is not None:
+            await job.run_blocking(staged.create, table)
+        if native:
+            columns[table] = await job.run_blocking(ch.fetch_columns, table)
+
+    async def split_ready(table, split):
+        # Files of a table share one task that prepares the table.
+        if table not in table_tasks:
+            table_tasks[table] = asyncio.ensure_future(prepare_table(table))
+            ready_tasks.append(table_tasks[table])
+        await asyncio.shield(table_tasks[table])
+
+    async def fetch_split(split):
+        # Remote files are fetched once the operation has a slot.
+        await job.run_blocking(split.wait)
+
+    async def load_split(split, run):
+        # Release remote files once their load has finished.
+        try:
+            return await run()
+        finally:
+            split.finish()
+
+    runs = []
+    if a['loader'] == 'native':
+        for table, split in load_files:
+            insert_table = table
+            if staged is not None:
+                insert_table = staged.insert_table(table, split)
+            run = functools.partial(_run_native, job, ch, table,
+                                    insert_table, split, columns,
+                                    a['block_size'],
+                                    load_settings.table(table), a['dry_run'])
+            runs.append((table, split, run, None))
+    else:
+        opts = api.build_ch_client_opts(host, port, a['secure'], a['user'],
+                                        a['password'], ch.database)
+        for table, split, cmd, query_id in api.load_commands(
+                opts, load_files, load_settings, staged):
+            run = functools.partial(_run_command, cmd, a['dry_run'])
+            runs.append((table, split, run, query_id))
+
+    def journal_callback(table, split, stats):
+        def callback(result):
+            load_journal.record(table, split, stats.rows)
+
+        return callback
+
+    operations = []
+    load_stats = []
+    for table, split, run, query_id in runs:
+        stats = load_report.add(table, split.name(), bytes=split.size())
+        load_stats.append((query_id, stats))
+        operations.append(
+            (stats, "Loading data: table={0}, file={1}".format(
+                table, split.name()),
+             functools.partial(load_split, split, run),
+             journal_callback(table, split, stats),
+             functools.partial(split_ready, table, split),
+             functools.partial(fetch_split, split)))
+    await _run_operations(job, limit, operations, semaphore)
+    if a['loader'] != 'native' and not a['dry_run']:
+        # Rows of client loads come from the query log.
+        await job.run_blocking(api.set_load_rows, ch, load_stats)
+
+
+async def _run_server_load(job, a, limit, load_report):
+    ch, format, units, load_settings, ddl_runner = await job.run_blocking(
+        api.prepare_server_load, a['name'], a['repo_path'], a['host'],
+        a['port'], a['secure'], a['verify'], a['user'], a['password'],
+        a['database'], a['parallel'], a['clean'], a['source'],
+        a['partition_filter'], a['settings_profile'], a['insert_settings'],
+        a['dry_run'], job.progress)
+    columns = {}
+    table_tasks = {}
+
+    async def prepare_table(unit):
+        # Wait for the table's DDL, then match columns with the source.
+        await job.run_blocking(ddl_runner.wait, unit.table)
+        if not a['dry_run']:
+            columns[unit.table] = await job.run_blocking(
+                server_load.insert_columns, ch, unit, format)
+
+    async def unit_ready(unit):
+        # Units of a table share one task that prepares the table.
+        if unit.table not in table_tasks:
+            table_tasks[unit.table] = asyncio.ensure_future(
+                prepare_table(unit))
+        await asyncio.shield(table_tasks[unit.table])
+
+    try:
+        operations = []
+        for unit in units:
+            stats = load_report.add(unit.table, unit.name(), bytes=unit.bytes)
+            operations.append(
+                (stats, "Loading data: table={0}, files={1}".format(
+                    unit.table, unit.name()),
+                 functools.partial(_run_insert, job, ch, unit, format,
+                                   columns, load_settings.table(unit.table),
+                                   a['dry_run']), None,
+                 functools.partial(unit_ready, unit)))
+        await _run_operations(job, limit, operations)
+        await job.run_blocking(ddl_runner.wait)
+    finally:
+        await job.run_blocking(ddl_runner.close)
+        await asyncio.gather(*table_tasks.values(), return_exceptions=True)
+        ch.close()
+
+
+async def _run_dump(job, args, limit):
+    a = args
+    dump_report = report.Report(
+        'dump', a['name'],
+        a['name'] if a['database'] is None else a['database'])
+    codec, compressor, compress_threads = api.dump_options(
+        a['format'], a['codec'], a['compress'], a['seekable'],
+        a['compressor'], a['compress_threads'], a['parallel'],
+        a['incremental'], a['file_size'])
+    ch, tables, data_path, opts, state = await job.run_blocking(
+        api.prepare_dump, a['name'], a['repo_path'], a['host'], a['port'],
+        a['secure'], a['verify'], a['user'], a['password'], a['database'],
+        a['table_regex'], a['parallel'], a['overwrite'], a['incremental'],
+        a['dry_run'], job.progress)
+    file_size = a['file_size']
+
+    def size_callback(stats, file_path):
+        def callback(result):
+            stats.bytes = os.path.getsize(file_path)
+
+        return callback
+
+    try:
+        dump_operations = await job.run_blocking(
+            api.plan_dump, ch, tables, data_path, opts,
+            a['overwrite'] or a['incremental'], a['format'], codec,
+            a['level'], compressor, compress_threads, file_size, state)
+        operations = []
+        for table, key, cmd, _, file_path, rows, _ in dump_operations:
+            stats = dump_report.add(table,
+                                    os.path.basename(file_path),
+                                    rows=rows)
+            operations.append(
+                (stats, "Dumping data: table={0}, partition={1}".format(
+                    table, key),
+                 functools.partial(_run_command, cmd, a['dry_run']),
+                 size_callback(stats, file_path)))
+        await _run_operations(job, limit, operations)
+        if not a['dry_run']:
+            await job.run_blocking(api.check_dump_rows, ch, tables,
+                                   dump_operations, dump_report.operations,
+                                   not a['incremental'], job.progress, state)
+    finally:
+        ch.close()
+        await job.run_blocking(state.save)
+    if not a['dry_run']:
+        await job.run_blocking(api.report_output_bytes,
+                               [op[4] for op in dump_operations],
+                               job.progress)
+    api.summarize(dump_report, job.progress)
+    return dump_report
+
+
+async def _run_operations(job, limit, operations, semaphore=None):
+    """Run operations concurrently within the job and shared limits
+    :param operations: (list): Tuples of (OperationStats, message, run,
+                               on_success) in start order, where run is a
+                               coroutine function and on_success is a
+                               blocking function called with the result.
+                               An optional fifth element is a coroutine
+                               function awaited before taking a slot, and
+                               an optional sixth one is awaited after
+                               taking it, before the operation is timed
+    :param semaphore: (asyncio.Semaphore): Limit on these operations in
+                                           place of the job's semaphore
+    :return: Tuple of (succeeded, failed)
+    """
+    if semaphore is None:
+        semaphore = job.semaphore
+    results = await _gather([
+        asyncio.ensure_future(
+            _run_operation(job, limit, semaphore, *operation))
+        for operation in operations
+    ])
+    return results.count(True), results.count(False)
+
+
+async def _gather(tasks):
+    """Wait for tasks.  If one raises or the wait is cancelled, cancel the
+       others and wait for them to finish before raising
+    :return: List of task results
+    """
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Wait for running commands to be terminated.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _run_operation(job, limit, semaphore, stats, message, run,
+                         on_success, ready=None, prepare=None):
+    """Run one operation when ready and limits allow and post its events.
+       Queue wait is measured from when the operation is ready
+    :return: True if the operation succeeded
+    """
+    if ready is not None:
+        await ready()
+    queued = time.monotonic()
+    async with semaphore:
+        if limit is None:
+            return await _run_and_emit(job, queued, stats, message, run,
+                                       on_success, prepare)
+        async with limit:
+            return await _run_and_emit(job, queued, stats, message, run,
+                                       on_success, prepare)
+
+
+async def _run_and_emit(job, queued, stats, message, run, on_success,
+                        prepare=None):
+    """Run an operation, record its stats and post events.  Runs return
+       DRY_RUN in dry runs, when nothing is recorded"""
+    table, name = stats.table, stats.name
+    logger.info(message)
+    job.emit(ProgressEvent('started', message, table, name))
+    start = time.monotonic()
+    try:
+        if prepare is not None:
+            await prepare()
+            start = time.monotonic()
+        result = await run()
+        if isinstance(result, ProcessResult) and result.returncode != 0:
+            raise Exception("Process failed: {0}: {1}".format(
+                result.command, result.stderr.strip()))
+        if result is DRY_RUN:
+            result = None
+        else:
+            if isinstance(result, int):
+                stats.rows = result
+            stats.record('succeeded', start, time.monotonic() - start,
+                         queued)
+            if on_success is not None:
+                await job.run_blocking(on_success, result)
+    except asyncio.CancelledError:
+        job.emit(
+            ProgressEvent('cancelled', "Cancelled: {0}".format(name), table,
+                          name))
+        raise
+    except Exception as e:
+        stats.record('failed', start, time.monotonic() - start, queued)
+        failure = "Operation failed: table={0}, name={1}, error={2}".format(
+            table, name, e)
+        logger.info(failure)
+        job.emit(ProgressEvent('failed', failure, table, name, e))
+        return False
+    job.emit(
+        ProgressEvent('succeeded', "Completed: {0}".format(name), table, name,
+                      result))
+    return True
+
+
+async def _run_native(job, ch, table, insert_table, split, columns,
+                      block_size, settings, dry_run):
+    """Load a split with the blocking native loader
+    :param insert_table: (str): Table or staging table to insert into
+    :param columns: (dict): Column types keyed by table
+    :param settings: (dict): Query settings for the inserts
+    :return: Rows loaded or DRY_RUN
+    """
+    if dry_run:
+        logger.info("Dry run: native load of {0}".format(split.name()))
+        return DRY_RUN
+    return await job.run_blocking(native_load.load_split, ch, insert_table,
+                                  split, columns[table], block_size,
+                                  settings)
+
+
+async def _run_insert(job, ch, unit, format, columns, settings, dry_run):
+    """Run the INSERT SELECT of a server-side load unit.  The insert keeps
+       running on the server if the operation is cancelled
+    :param columns: (dict): Insert columns keyed by table
+    :param settings: (dict): Query settings for the insert
+    :return: Rows written, None if the server did not report them, or
+             DRY_RUN
+    """
+    if dry_run:
+        logger.info("Dry run: {0}".format(clickhouse.mask(
+            server_load.insert_sql(unit, format, None, settings))))
+        return DRY_RUN
+    return await job.run_blocking(server_load.load_unit, ch, unit, format,
+                                  settings, columns[unit.table])
+
+
+async def _run_command(command, dry_run):
+    """Run a shell command as an asyncio subprocess.  The command runs in a
+       new session so that cancellation terminates the whole pipeline
+    :return: ProcessResult or DRY_RUN
+    """
+    if dry_run:
+        logger.info("Dry run: " + command)
+        return DRY_RUN
+    logger.info("Starting a new process: " + command)
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_shell(
+        command, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        raise
+    return ProcessResult(command, process.returncode,
+                         stderr.decode('utf-8', errors='replace'),
+                         time.monotonic() - start)
@@ -9,13 +9,33 @@
 # code for the these subcomponents is subject to the terms and
 # conditions of the subcomponent's license, as noted in the LICENSE file.
 
+import collections
+import concurrent.futures
+import functools
 import glob
 import logging
 import os
-import re
+import shlex
+import shutil
+import time
 import urllib.parse
+import uuid
 
+from altinity_datasets import catalog
 from altinity_datasets import clickhouse
+from altinity_datasets import ddl
+from altinity_datasets import dump_state
+from altinity_datasets import formats
+from altinity_datasets import generate
+from altinity_datasets import journal
+from altinity_datasets import native_load
+from altinity_datasets import remote
+from altinity_datasets import report
+from altinity_datasets import server_load
+from altinity_datasets import sharding
+from altinity_datasets import splits
+from altinity_datasets import staging
+from altinity_datasets import tuning
 from altinity_datasets.proc_pool import ProcessPool
 
 import yaml
@@ -26,15 +46,14 @@ logger = logging.getLogger(__name__)
 # Base directory of the installation.
 BASE = os.path.join(os.path.dirname(__file__), '..')
 
+# Methods available to load data files.
+LOADERS = formats.LOADERS
+
+# Methods available to compress dumped data files.
+COMPRESSORS = formats.COMPRESSORS
+
 # A list of built-in repo locations.
-BUILT_INS = [
-    {
-        'name': 'built-ins',
-        'description': 'Built-in dataset repository',
-        'path':
-        os.path.realpath(os.path.join(BASE, 'altinity_datasets/built-ins'))
-    },
-]
+BUILT_INS = catalog.BUILT_INS
 
 
 def _sql(conn, sql, verbose=False, dry_run=False):
@@ -47,40 +66,45 @@ def _sql(conn, sql, verbose=False, dry_run=False):
 
 def repos():
     """List known repos"""
-    return BUILT_INS
+    return catalog.repos()
 
 
 def dataset_search(name, repo_path=None):
     """Search for dataset(s)
     :param name: (str): If specified show only datasets that match this name
-    :param repo_path: (str): A path to the repo directory.  If specified
-                             search this repo path.  Otherwise search built-ins
+    :param repo_path: (str): A path to the repo directory or URL of a remote
+                             repo.  If specified search this repo.  Otherwise
+                             search built-ins and configured repos
     """
     datasets = []
     if repo_path is None:
-        search_list = [os.path.join(BASE, repo['path']) for repo in BUILT_INS]
+        search_list = [repo['path'] for repo in catalog.repos()]
     else:
         search_list = [repo_path]
 
     for dir in search_list:
-        children = [os.path.join(dir, child) for child in os.listdir(dir)]
-        for child in children:
-            manifest_yaml = os.path.join(child, 'manifest.yaml')
-            # Skip if not a directory or if the name does not match.
-            if not os.path.isdir(child):
+        if remote.is_remote(dir):
+            try:
+                datasets.extend(remote.RemoteRepo(dir).datasets(name))
+            except Exception as e:
+                if repo_path is not None:
+                    raise
+                logger.warning("Unable to read remote repo: {0}: {1}".format(
+                    dir, e))
+            continue
+        repo_catalog = catalog.Catalog(dir)
+        if name:
+            entries = [repo_catalog.get(name)]
+        else:
+            entries = repo_catalog.datasets()
+        for entry in entries:
+            if entry is None:
                 continue
-            elif name and name != os.path.basename(child):
-                continue
-            # Load the manifest if it exists.
-            if os.path.exists(manifest_yaml):
-                with open(manifest_yaml, "r") as f:
-                    manifest = yaml.safe_load(f)
-            else:
-                manifest = {}
+            manifest = dict(entry['manifest'])
             # Fill in location fields.
             manifest['repo'] = os.path.basename(dir)
-            manifest['path'] = child
-            manifest['name'] = os.path.basename(child)
+            manifest['path'] = os.path.join(dir, entry['name'])
+            manifest['name'] = entry['name']
             datasets.append(manifest)
 
     return datasets
@@ -97,6 +121,18 @@ def dataset_load(name,
                  database=None,
                  parallel=5,
                  clean=False,
+                 loader='client',
+                 block_size=native_load.DEFAULT_BLOCK_SIZE,
+                 split_size=None,
+                 resume=False,
+                 journal_path=None,
+                 source='files',
+                 partition_filter=None,
+                 settings_profile='manifest',
+                 insert_settings=None,
+                 staging=False,
+                 cluster=None,
+                 hosts=None,
                  verbose=False,
                  dry_run=False,
                  progress_reporter=None):
@@ -110,13 +146,541 @@ def dataset_load(name,
     :param user: (str): ClickHouse user name
     :param password: (str): ClickHouse password
     :param database: (str): Database (defaults to dataset name)
-    :param parallel: (int): Number of processes to run in parallen when loading
+    :param parallel: (int): Number of processes to run in parallen when
+                            loading.  Sharded loads run this many per shard
     :param clean: (boolean): If True wipe out existing data
+    :param loader: (str): 'client' to pipe files through clickhouse-client
+                          or 'native' to send blocks over the native protocol
+    :param block_size: (int): Rows per INSERT block for the native loader
+    :param split_size: (int): If specified split files larger than this
+                              many bytes into ranges that load in parallel
+    :param resume: (boolean): If True skip files that the journal shows were
+                              already loaded from the same contents
+    :param journal_path: (str): Load journal file.  Defaults to a file in
+                                the dataset directory
+    :param source: (str): 'files' to load data files or a manifest key with
+                          object storage locations, e.g., 'parquet', that
+                          the server inserts from directly
+    :param partition_filter: (str): SQL condition on hive partition columns
+                                    that selects source files to load
+    :param settings_profile: (str): 'manifest' to apply settings from the
+                                    manifest, 'auto' to also size insert
+                                    blocks and threads for the server or
+                                    'none'
+    :param insert_settings: (dict): Settings for inserts that override the
+                                    profile
+    :param staging: (boolean): If True load files into staging tables and
+                               replace partitions of each table once all of
+                               its files have loaded
+    :param cluster: (str): Cluster in system.clusters of the host.  Tables
+                           are created ON CLUSTER and data files spread
+                           over its shards
+    :param hosts: (list): host:port of each shard to create tables on and
+                          spread data files over, for hosts without a
+                          cluster definition
     :param dry_run: (boolean): If True print commands instead of executing them
     :param progress_reporter: (function): If specified call function with
                                           string message showing progress
+    :return: Report with rows, bytes and timings of each operation
+    """
+    load_report = report.Report('load', name,
+                                name if database is None else database)
+    check_load(source, resume, staging, cluster, hosts)
+    if source != 'files':
+        _load_server(name, repo_path, host, port, secure, verify, user,
+                     password, database, parallel, clean, source,
+                     partition_filter, settings_profile, insert_settings,
+                     load_report, dry_run, progress_reporter)
+    else:
+        _load_files(name, repo_path, host, port, secure, verify, user,
+                    password, database, parallel, clean, loader, block_size,
+                    split_size, resume, journal_path, settings_profile,
+                    insert_settings, staging, cluster, hosts, load_report,
+                    dry_run, progress_reporter)
+    summarize(load_report, progress_reporter)
+    return load_report
+
+
+def check_load(source, resume, staging_tables, cluster, hosts):
+    """Raise if load options cannot be used together.  Arguments are those
+       of dataset_load"""
+    _check_staging(source, resume, staging_tables, cluster, hosts)
+    _check_cluster(source, cluster, hosts)
+    if source != 'files' and resume:
+        raise Exception("Resume is not supported for server-side loads")
+
+
+def summarize(operation_report, progress_reporter):
+    """Finish a report and show its operation counts
+    :param operation_report: (Report): Report of a load or dump
     """
-    # Look up the dataset.
+    operation_report.finish()
+    _progress_and_info(
+        "Operation summary: succeeded={0}, failed={1}, skipped={2}".format(
+            operation_report.succeeded, operation_report.failed,
+            operation_report.skipped), progress_reporter)
+
+
+def _check_staging(source, resume, staging, cluster, hosts):
+    """Raise if a staged load cannot run with other load options"""
+    if not staging:
+        return
+    elif source != 'files':
+        raise Exception("Staging is only supported for loads of files")
+    elif resume and (cluster is not None or hosts is not None):
+        # Remaining files may go to other shards than the kept staging
+        # tables.
+        raise Exception("Resume is not supported for staged cluster loads")
+
+
+def _check_cluster(source, cluster, hosts):
+    """Raise if a sharded load cannot run with other load options"""
+    if cluster is None and hosts is None:
+        return
+    elif cluster is not None and hosts is not None:
+        raise Exception("Specify a cluster or a list of hosts, not both")
+    elif hosts is not None and not hosts:
+        raise Exception("List of hosts is empty")
+    elif source != 'files':
+        raise Exception("Sharded loads are only supported for loads of files")
+
+
+def _load_files(name, repo_path, host, port, secure, verify, user, password,
+                database, parallel, clean, loader, block_size, split_size,
+                resume, journal_path, settings_profile, insert_settings,
+                staging_tables, cluster, hosts, load_report, dry_run,
+                progress_reporter):
+    """Load data files of a dataset through the client host.  Sharded loads
+       spread the files over shards, which load in parallel"""
+    (ch, load_journal, load_files, ddl_runner, prefetcher,
+     load_settings) = prepare_load(name, repo_path, host, port, secure,
+                                   verify, user, password, database,
+                                   parallel, clean, loader, split_size,
+                                   resume, journal_path, settings_profile,
+                                   insert_settings, cluster, hosts, dry_run,
+                                   progress_reporter)
+    targets = []
+    try:
+        targets = load_targets(ch, host, port, load_files, staging_tables,
+                               parallel, load_journal, resume, dry_run,
+                               progress_reporter)
+        if len(targets) == 1:
+            _load_target(targets[0], secure, user, password, loader,
+                         parallel, block_size, load_settings, load_journal,
+                         load_report, ddl_runner, dry_run, progress_reporter)
+        else:
+            _load_shards(targets, secure, user, password, loader, parallel,
+                         block_size, load_settings, load_journal,
+                         load_report, ddl_runner, dry_run, progress_reporter)
+        finish_load(targets, load_report, ddl_runner)
+    finally:
+        close_load(ch, targets, ddl_runner, prefetcher)
+
+
+def load_targets(ch, host, port, load_files, staging_tables, parallel,
+                 load_journal, resume, dry_run, progress_reporter):
+    """Assign files to the hosts that load them.  Sharded loads spread the
+       files over their shards.  A new load starts a new journal once no
+       staging tables of an earlier load are left
+    :param ch: (ClickHouse): Connector from prepare_load
+    :param staging_tables: (boolean): If True each host loads into staging
+                                      tables, resuming those of an earlier
+                                      load if resume is set
+    :return: List of tuple(host, port, ClickHouse connector, list of
+             tuple(table, FileSplit), StagingTables or None)
+    """
+    if isinstance(ch, sharding.ShardedConnector):
+        assigned = sharding.assign(load_files,
+                                   [shard for shard, _ in ch.shards])
+        hosts = [(shard.host, shard.port, shard_ch, files)
+                 for (shard, shard_ch), (_, files) in zip(
+                     ch.shards, assigned)]
+    else:
+        hosts = [(host, port, ch, load_files)]
+    targets = []
+    for target_host, target_port, target_ch, files in hosts:
+        staged = None
+        if staging_tables:
+            staged = staging.StagingTables(target_ch, files, parallel,
+                                           load_journal, dry_run,
+                                           progress_reporter)
+            staged.adopt_leftover(resume)
+        targets.append((target_host, target_port, target_ch, files, staged))
+    if not resume and not dry_run:
+        load_journal.reset()
+    return targets
+
+
+def finish_load(targets, load_report, ddl_runner):
+    """Publish staging tables once files have loaded and wait for the
+       remaining DDL.  Raise if tables failed to publish
+    :param targets: (list): Targets from load_targets
+    """
+    kept = []
+    for _, _, _, _, staged in targets:
+        if staged is not None:
+            kept.extend(staged.publish_all(load_report))
+    # Tables without data and views must be created as well.
+    ddl_runner.wait()
+    staging.check_published(kept)
+
+
+def close_load(ch, targets, ddl_runner, prefetcher):
+    """Drop unpublished staging tables and release what prepare_load
+       started"""
+    for _, _, _, _, staged in targets:
+        if staged is not None:
+            staged.close()
+    ddl_runner.close()
+    ch.close()
+    if prefetcher is not None:
+        prefetcher.close()
+
+
+def _load_target(target, secure, user, password, loader, parallel,
+                 block_size, load_settings, load_journal, load_report,
+                 ddl_runner, dry_run, progress_reporter):
+    """Load files into one host with the chosen loader
+    :param target: (tuple): Target from load_targets
+    """
+    host, port, ch, load_files, staged = target
+    if staged is not None:
+        # Files are journaled when their table publishes.
+        load_journal = staged
+    if loader == 'native':
+        _load_native(ch, load_files, parallel, block_size, load_settings,
+                     load_journal, load_report, ddl_runner, staged, dry_run,
+                     progress_reporter)
+    else:
+        _load_client(ch, host, port, secure, user, password, load_files,
+                     parallel, load_settings, load_journal, load_report,
+                     ddl_runner, staged, dry_run, progress_reporter)
+
+
+def _load_shards(targets, secure, user, password, loader, parallel,
+                 block_size, load_settings, load_journal, load_report,
+                 ddl_runner, dry_run, progress_reporter):
+    """Load the files of each shard on its own thread.  Each shard runs up
+       to parallel loads at once"""
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(targets)) as pool:
+        futures = {}
+        for target in targets:
+            _progress_and_info(
+                "Loading shard: host={0}, files={1}".format(
+                    target[0], len(target[3])), progress_reporter)
+            future = pool.submit(_load_target, target, secure, user,
+                                 password, loader, parallel, block_size,
+                                 load_settings, load_journal, load_report,
+                                 ddl_runner, dry_run, progress_reporter)
+            futures[future] = target
+        errors = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+                _progress_and_info(
+                    "Shard load failed: host={0}, error={1}".format(
+                        futures[future][0], e), progress_reporter)
+    if errors:
+        raise errors[0]
+
+
+def _load_server(name, repo_path, host, port, secure, verify, user, password,
+                 database, parallel, clean, source, partition_filter,
+                 settings_profile, insert_settings, load_report, dry_run,
+                 progress_reporter):
+    """Load a dataset on the server from object storage locations in its
+       manifest"""
+    ch, format, units, load_settings, ddl_runner = prepare_server_load(
+        name, repo_path, host, port, secure, verify, user, password,
+        database, parallel, clean, source, partition_filter,
+        settings_profile, insert_settings, dry_run, progress_reporter)
+    try:
+        _load_units(ch, units, format, load_settings, parallel, load_report,
+                    ddl_runner, dry_run, progress_reporter)
+        ddl_runner.wait()
+    finally:
+        ddl_runner.close()
+        ch.close()
+
+
+def prepare_server_load(name, repo_path, host, port, secure, verify, user,
+                        password, database, parallel, clean, source,
+                        partition_filter, settings_profile, insert_settings,
+                        dry_run, progress_reporter):
+    """Create the database, start DDL scripts and list the source files of
+       a server-side load.  Arguments are those of dataset_load
+    :return: Tuple of (ClickHouse connector for the database, input format,
+             list of LoadUnit, LoadSettings of the inserts, DdlRunner that
+             is creating the tables)
+    """
+    dataset = _find_dataset(name, repo_path)
+    _mirror_dataset(dataset, 1, False, progress_reporter)
+    statements = ddl.read_statements(dataset['path'])
+    tables = [s.name for s in statements if s.kind == 'TABLE']
+    locations = server_load.locations(dataset, source, tables)
+    if partition_filter and source != 'parquet_hive':
+        raise Exception(
+            "Partition filter needs a hive partitioned source: {0}".format(
+                source))
+    format = server_load.SOURCES[source]
+
+    database = name if database is None else database
+    logger.info("Loading on host: {0} database: {1}".format(host, database))
+    ch = _create_database(host, port, secure, verify, user, password,
+                          database, parallel, clean, dry_run,
+                          progress_reporter)
+    try:
+        load_settings = _load_settings(ch, dataset, settings_profile,
+                                       insert_settings, parallel,
+                                       server_load.DEFAULT_SETTINGS, dry_run,
+                                       progress_reporter)
+    except Exception:
+        ch.close()
+        raise
+    ddl_runner = ddl.DdlRunner(ch, statements, parallel, dry_run,
+                               progress_reporter).start()
+    try:
+        units = []
+        for table, url in locations:
+            _progress_and_info("Listing source files: {0}".format(url),
+                               progress_reporter)
+            if dry_run:
+                logger.info("Dry run: {0}".format(clickhouse.mask(
+                    server_load.listing_sql(url, format, partition_filter))))
+                units.append(
+                    server_load.LoadUnit(table, url,
+                                         server_load.FILE_GLOBS[format],
+                                         None, 0))
+            else:
+                units.extend(
+                    server_load.plan_units(ch, table, url, format,
+                                           partition_filter))
+    except Exception:
+        ddl_runner.close()
+        ch.close()
+        raise
+    return ch, format, units, load_settings, ddl_runner
+
+
+def _load_units(ch, units, format, load_settings, parallel, load_report,
+                ddl_runner, dry_run, progress_reporter):
+    """Run INSERT SELECT for each unit on a thread pool.  Each unit starts
+       once the DDL of its table is done"""
+    # Columns are matched by name once per table.
+    columns = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = {}
+        for unit in ddl_runner.ready(units, lambda u: u.table):
+            _progress_and_info(
+                "Loading data: table={0}, files={1}".format(
+                    unit.table, unit.name()), progress_reporter)
+            stats = load_report.add(unit.table, unit.name(), bytes=unit.bytes)
+            settings = load_settings.table(unit.table)
+            if dry_run:
+                logger.info("Dry run: {0}".format(clickhouse.mask(
+                    server_load.insert_sql(unit, format, None, settings))))
+                continue
+            if unit.table not in columns:
+                columns[unit.table] = server_load.insert_columns(
+                    ch, unit, format)
+            future = pool.submit(_run_timed, stats, time.monotonic(),
+                                 server_load.load_unit, ch, unit, format,
+                                 settings, columns[unit.table])
+            futures[future] = (unit, stats)
+        for future in concurrent.futures.as_completed(futures):
+            unit, stats = futures[future]
+            try:
+                stats.rows = future.result()
+            except Exception as e:
+                stats.status = 'failed'
+                _progress_and_info(
+                    "Load failed: files={0}, error={1}".format(
+                        unit.name(), e), progress_reporter)
+
+
+def prepare_load(name, repo_path, host, port, secure, verify, user, password,
+                 database, parallel, clean, loader, split_size, resume,
+                 journal_path, settings_profile, insert_settings, cluster,
+                 hosts, dry_run, progress_reporter):
+    """Create the database, start DDL scripts and plan files to load.  For
+       a cluster or list of hosts they run on every shard
+    :return: Tuple of (ClickHouse connector for the database, which is a
+             ShardedConnector for sharded loads, LoadJournal,
+             list of tuple(table, FileSplit) in execution order, DdlRunner
+             that is creating the tables, Prefetcher of remote data files or
+             None, LoadSettings of the inserts)
+    """
+    if loader not in LOADERS:
+        raise Exception("Unknown loader: {0}".format(loader))
+    if resume and clean:
+        raise Exception("Cannot resume a load that cleans the database")
+
+    dataset = _find_dataset(name, repo_path)
+    prefetcher = _mirror_dataset(dataset, parallel, not dry_run,
+                                 progress_reporter)
+
+    # Use name as the database unless overridden by caller.
+    database = name if database is None else database
+    logger.info("Loading to host: {0} database: {1}".format(host, database))
+
+    # Open the journal of completed files.  load_targets resets it for a
+    # new load.
+    if journal_path is None:
+        journal_path = journal.default_path(dataset['path'], host, database)
+    load_journal = journal.LoadJournal(journal_path)
+
+    # Connections are pooled across the DDL scripts and native load
+    # threads.  Files are planned while the DDL runs.
+    try:
+        if cluster is None and hosts is None:
+            ch = _create_database(host, port, secure, verify, user, password,
+                                  database, parallel, clean, dry_run,
+                                  progress_reporter)
+        else:
+            ch = _create_shards(host, port, secure, verify, user, password,
+                                database, parallel, clean, cluster, hosts,
+                                dry_run, progress_reporter)
+    except Exception:
+        if prefetcher is not None:
+            prefetcher.close()
+        raise
+    try:
+        load_settings = _load_settings(ch, dataset, settings_profile,
+                                       insert_settings, parallel, None,
+                                       dry_run, progress_reporter)
+    except Exception:
+        ch.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        raise
+    ddl_runner = _start_ddl(ch, dataset['path'], parallel, dry_run,
+                            progress_reporter)
+    try:
+        load_files = _plan_load_files(dataset, loader, split_size, resume,
+                                      load_journal, prefetcher,
+                                      progress_reporter)
+    except Exception:
+        ddl_runner.close()
+        ch.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        raise
+    return ch, load_journal, load_files, ddl_runner, prefetcher, load_settings
+
+
+def _load_settings(ch, dataset, profile, overrides, parallel, defaults,
+                   dry_run, progress_reporter):
+    """Merge insert settings for a load, reading server resources for the
+       auto profile
+    :return: LoadSettings
+    """
+    auto = None
+    if profile == 'auto' and dry_run:
+        logger.info("Dry run: not reading server resources for auto settings")
+    elif profile == 'auto':
+        resources = ch.fetch_server_resources()
+        auto = tuning.auto_settings(resources, parallel)
+        _progress_and_info(
+            "Auto settings for memory={0}, cores={1}: {2}".format(
+                resources['memory'], resources['cores'], auto),
+            progress_reporter)
+    return tuning.LoadSettings(dataset, profile, auto, overrides, defaults)
+
+
+def _mirror_dataset(dataset, parallel, fetch_data, progress_reporter):
+    """Fetch the manifest and DDL of a dataset from a remote repo and start
+       fetching its data files.  Local datasets need no mirror
+    :return: Prefetcher of data files or None for local datasets
+    """
+    if not dataset.get('url'):
+        return None
+    _progress_and_info("Mirroring dataset: {0}".format(dataset['url']),
+                       progress_reporter)
+    repo = remote.RemoteRepo(dataset['repo'])
+    return repo.mirror(dataset['name'], parallel, fetch_data,
+                       progress_reporter)
+
+
+def _plan_load_files(dataset, loader, split_size, resume, load_journal,
+                     prefetcher, progress_reporter):
+    """Find load files for each table and split large ones
+    :return: List of tuple(table, FileSplit) in execution order
+    """
+    load_files = []
+    for table, data_file, format, file_splits in _data_files(
+            dataset, split_size, prefetcher):
+        if format is None:
+            logger.info("Skipping non-data file: {0}".format(data_file))
+            continue
+        elif loader == 'native' and format != 'CSVWithNames':
+            raise Exception(
+                "Native loader only reads CSV files: {0}".format(data_file))
+        file_splits = file_splits()
+        if resume:
+            load_journal.check_ranges(table, file_splits)
+        for split in file_splits:
+            if resume and load_journal.is_done(table, split):
+                _progress_and_info(
+                    "Skipping loaded file: table={0}, file={1}".format(
+                        table, split.name()), progress_reporter)
+                continue
+            load_files.append((table, split))
+
+    # Start the biggest files first so that no large file is left to run
+    # alone at the end of the load.
+    return _largest_first(load_files, lambda op: op[1].size())
+
+
+def _data_files(dataset, split_size, prefetcher):
+    """Generate tuple(table, data file, format, function returning splits)
+       for files of a dataset.  Format is None for files that are not data.
+       Local files are classified by content.  Remote files are classified
+       by extension and not split, since they have not been fetched yet"""
+    if prefetcher is not None:
+        if split_size:
+            logger.info("Not splitting files of remote dataset")
+        for _, size, _, data_file in prefetcher.files:
+            table = os.path.basename(os.path.dirname(data_file))
+            detected = formats.detect(data_file)
+            if detected is None:
+                yield table, data_file, None, None
+                continue
+            yield table, data_file, detected[0], functools.partial(
+                _remote_splits, data_file, size, prefetcher, *detected)
+        return
+    data_path = os.path.join(dataset['path'], "data")
+    for table_dir in glob.glob(data_path + "/*"):
+        logger.info("Processing table data: {0}".format(table_dir))
+        table = os.path.basename(table_dir)
+        for data_file in sorted(glob.glob(table_dir + "/*")):
+            classified = formats.classify(data_file)
+            if classified is None:
+                yield table, data_file, None, None
+                continue
+            _, compression, format = classified
+            yield table, data_file, format, functools.partial(
+                splits.plan_splits, data_file, split_size, format,
+                compression)
+
+
+def _remote_splits(data_file, size, prefetcher, format, compression):
+    """Return a split for a whole remote file that waits for its fetch"""
+    return [
+        splits.FileSplit(data_file,
+                         format=format,
+                         compression=compression,
+                         file_size=size,
+                         ready=functools.partial(prefetcher.wait, data_file),
+                         release=functools.partial(prefetcher.release,
+                                                   data_file))
+    ]
+
+
+def _find_dataset(name, repo_path):
+    """Return the manifest of a dataset or raise if not found"""
     datasets = dataset_search(name, repo_path=repo_path)
     if len(datasets) == 0:
         raise Exception("Dataset not found: {0}".format(name))
@@ -124,13 +688,19 @@ def dataset_load(name,
         raise Exception(
             "Dataset name is ambiguous, must specify repo path: {0}".format(
                 name))
-    else:
-        dataset = datasets[0]
+    return datasets[0]
 
-    # Use name as the database unless overridden by caller.
-    database = name if database is None else database
-    logger.info("Loading to host: {0} database: {1}".format(host, database))
 
+def _create_database(host, port, secure, verify, user, password, database,
+                     pool_size, clean, dry_run, progress_reporter,
+                     cluster=None):
+    """Create the database, dropping it first if clean is set
+    :param cluster: (str): If specified create the database ON CLUSTER
+    :return: ClickHouse connector for the database
+    """
+    on_cluster = ""
+    if cluster is not None:
+        on_cluster = " ON CLUSTER `{0}`".format(cluster)
     # Clear database if requested. This connection cannot use the database
     # as it might not exist yet.
     ch_0 = clickhouse.ClickHouse(host=host,
@@ -138,77 +708,330 @@ def dataset_load(name,
                                  secure=secure,
                                  verify=verify,
                                  user=user,
-                                 password=password)
+                                 password=password,
+                                 pool_size=1)
     if clean:
         _progress_and_info(
             "Dropping database if it exists: {0}".format(database),
             progress_reporter)
-        ch_0.execute("DROP DATABASE IF EXISTS {0}".format(database),
-                     dry_run=dry_run)
+        ch_0.execute("DROP DATABASE IF EXISTS {0}{1}".format(
+            database, on_cluster), dry_run=dry_run)
 
     # Create database.
     _progress_and_info(
         "Creating database if it does not exist: {0}".format(database),
         progress_reporter)
-    ch_0.execute("CREATE DATABASE IF NOT EXISTS {0}".format(database), dry_run)
+    ch_0.execute("CREATE DATABASE IF NOT EXISTS {0}{1}".format(
+        database, on_cluster), dry_run=dry_run)
+    ch_0.close()
 
     # We can now safely reference the database.
-    ch = clickhouse.ClickHouse(host=host,
-                               port=port,
-                               secure=secure,
-                               verify=verify,
-                               user=user,
-                               password=password,
-                               database=database)
+    return clickhouse.ClickHouse(host=host,
+                                 port=port,
+                                 secure=secure,
+                                 verify=verify,
+                                 user=user,
+                                 password=password,
+                                 database=database,
+                                 pool_size=pool_size)
 
-    # Load table definitions in sequence.
-    ddl_path = os.path.join(dataset['path'], "ddl")
-    for sql_file in glob.glob(ddl_path + "/*"):
-        _progress_and_info("Executing DDL: {0}".format(sql_file),
-                           progress_reporter)
-        with open(sql_file, 'r') as f:
-            script = f.read()
-        ch.execute(script, dry_run=dry_run)
 
-    # Build options for the clickhouse-client.
-    opts = _build_ch_client_opts(host, port, secure, user, password, database)
+def _create_shards(host, port, secure, verify, user, password, database,
+                   pool_size, clean, cluster, hosts, dry_run,
+                   progress_reporter):
+    """Create the database on each shard of a cluster or list of hosts.
+       Shards of a cluster come from system.clusters on the host
+    :return: ShardedConnector for the database
+    """
+    if hosts is not None:
+        ch = None
+        shards = sharding.parse_hosts(hosts, port)
+    else:
+        ch = _create_database(host, port, secure, verify, user, password,
+                              database, pool_size, clean, dry_run,
+                              progress_reporter, cluster)
+        if dry_run:
+            logger.info("Dry run: loading cluster through host {0}".format(
+                host))
+            shards = [sharding.Shard(1, [(host, port)])]
+        else:
+            try:
+                shards = sharding.discover(ch, cluster)
+            except Exception:
+                ch.close()
+                raise
 
-    # Define load scripts for each CSV load file.
-    data_path = os.path.join(dataset['path'], "data")
-    load_operations = []
-    for table_dir in glob.glob(data_path + "/*"):
-        logger.info("Processing table data: {0}".format(table_dir))
-        table = os.path.basename(table_dir)
-        load_sql = "INSERT INTO {0} FORMAT CSVWithNames".format(table)
-        csv_files = glob.glob(table_dir + "/*csv*")
-        for csv_file in sorted(csv_files):
-            if re.match(r'^.*csv\.gz', csv_file):
-                cat_cmd = "gzip -d -c {0}".format(csv_file)
-            elif re.match(r'^.*csv', csv_file):
-                cat_cmd = "cat {0}".format(csv_file)
-            else:
-                raise (
-                    "Unable to open this type of file: {0}".format(csv_file))
+    def connect(shard_host, shard_port):
+        if hosts is not None:
+            return _create_database(shard_host, shard_port, secure, verify,
+                                    user, password, database, pool_size,
+                                    clean, dry_run, progress_reporter)
+        shard_ch = clickhouse.ClickHouse(host=shard_host,
+                                         port=shard_port,
+                                         secure=secure,
+                                         verify=verify,
+                                         user=user,
+                                         password=password,
+                                         database=database,
+                                         pool_size=pool_size)
+        if not dry_run:
+            # Fail over to the next replica if this one is down.
+            try:
+                shard_ch.execute("SELECT 1")
+            except Exception:
+                shard_ch.close()
+                raise
+        return shard_ch
+
+    shard_connectors = []
+    try:
+        for shard in shards:
+            shard_connectors.append((shard, shard.connect(connect)))
+    except Exception:
+        for _, shard_ch in shard_connectors:
+            shard_ch.close()
+        if ch is not None:
+            ch.close()
+        raise
+    _progress_and_info(
+        "Loading to shards: {0}".format(", ".join(
+            shard.name() for shard in shards)), progress_reporter)
+    if ch is None:
+        ch = shard_connectors[0][1]
+    return sharding.ShardedConnector(ch, shard_connectors, cluster)
 
-            client_cmd = ("clickhouse-client{0} --query='{1}'".format(
-                opts, load_sql))
 
-            load_command = cat_cmd + " | " + client_cmd
-            load_operations.append(
-                (table, os.path.basename(csv_file), load_command))
+def _start_ddl(ch, dataset_path, parallel, dry_run, progress_reporter):
+    """Start table definitions of a dataset in dependency order.  Sharded
+       loads run them on all shards
+    :return: DdlRunner to wait for tables
+    """
+    statements = ddl.read_statements(dataset_path)
+    if isinstance(ch, sharding.ShardedConnector):
+        ch = ch.ddl_connector()
+    return ddl.DdlRunner(ch, statements, parallel, dry_run,
+                         progress_reporter).start()
+
+
+def _load_client(ch, host, port, secure, user, password, load_files,
+                 parallel, load_settings, load_journal, load_report,
+                 ddl_runner, staged, dry_run, progress_reporter):
+    """Load files by piping each one to a clickhouse-client process.  Each
+       file starts once the DDL of its table is done.  Rows loaded come
+       from system.query_log once all files have loaded"""
+    # Build options for the clickhouse-client.
+    opts = build_ch_client_opts(host, port, secure, user, password,
+                                ch.database)
+    load_operations = load_commands(opts, load_files, load_settings, staged)
 
-    # Execute the load commands.
+    # Execute the load commands, journaling each file that succeeds.
     pool = ProcessPool(size=parallel, dry_run=dry_run)
-    for name, csv_file, cmd in load_operations:
-        _progress_and_info(
-            "Loading data: table={0}, file={1}".format(name, csv_file),
-            progress_reporter)
-        pool.exec(cmd)
-    pool.drain()
+    load_stats = []
+    try:
+        for name, split, cmd, query_id in ddl_runner.ready(
+                load_operations, lambda op: op[0]):
+            _progress_and_info(
+                "Loading data: table={0}, file={1}".format(
+                    name, split.name()), progress_reporter)
+            stats = load_report.add(name, split.name(), bytes=split.size())
+            load_stats.append((query_id, stats))
+            if staged is not None:
+                staged.create(name)
+            split.wait()
+            pool.exec(cmd, _load_callback(load_journal, stats, name, split))
+    finally:
+        pool.drain()
     logger.info(pool.outputs)
-    _progress_and_info(
-        "Operation summary: succeeded={0}, failed={1}".format(
-            pool.succeeded, pool.failed), progress_reporter)
+    if not dry_run:
+        set_load_rows(ch, load_stats)
+
+
+def load_commands(opts, load_files, load_settings, staged=None):
+    """Return tuple(table, split, command, query_id) with a clickhouse-client
+       shell command that loads each file, into its staging table if staged,
+       and the ID of its INSERT query"""
+    load_operations = []
+    for table, split in load_files:
+        query_id = str(uuid.uuid4())
+        table_opts = "{0}{1} --query_id={2}".format(
+            opts, tuning.client_options(load_settings.table(table)), query_id)
+        insert_table = table
+        if staged is not None:
+            insert_table = staged.insert_table(table, split)
+        if split.is_csv():
+            load_sql = "INSERT INTO {0} FORMAT CSVWithNames".format(
+                insert_table)
+            client_cmd = ("clickhouse-client{0} --query='{1}'".format(
+                table_opts, load_sql))
+            load_command = split.cat_command() + " | " + client_cmd
+        else:
+            # Let clickhouse-client read and decompress other formats.
+            load_sql = "INSERT INTO {0} FROM INFILE {1}".format(
+                insert_table, clickhouse.quote(os.path.abspath(split.path)))
+            if split.compression is not None:
+                load_sql += " COMPRESSION {0}".format(
+                    clickhouse.quote(split.compression))
+            load_sql += " FORMAT {0}".format(split.format)
+            load_command = "clickhouse-client{0} --query={1}".format(
+                table_opts, shlex.quote(load_sql))
+        load_operations.append((table, split, load_command, query_id))
+    return load_operations
+
+
+def _load_callback(load_journal, stats, table, split):
+    """Return pool callback that records timing and journals a successful
+       load"""
+
+    def callback(result):
+        status = 'succeeded' if result.returncode == 0 else 'failed'
+        stats.record(status, result.start, result.duration, result.queued)
+        if result.returncode == 0:
+            load_journal.record(table, split)
+        split.finish()
+
+    return callback
+
+
+def set_load_rows(ch, load_stats):
+    """Set rows of successful client loads from system.query_log
+    :param load_stats: (list): tuple(query_id, OperationStats) of each load
+    """
+    succeeded = [(query_id, stats) for query_id, stats in load_stats
+                 if stats.status == 'succeeded']
+    query_rows = ch.fetch_query_rows(
+        [query_id for query_id, _ in succeeded])
+    for query_id, stats in succeeded:
+        if query_id in query_rows:
+            stats.rows = query_rows[query_id][0]
+    if len(query_rows) < len(succeeded):
+        logger.warning(
+            "Query log has no entries for {0} loads, rows are unknown".format(
+                len(succeeded) - len(query_rows)))
+
+
+def _dump_callback(stats, file_path):
+    """Return pool callback that records timing and size of a dump"""
+
+    def callback(result):
+        status = 'succeeded' if result.returncode == 0 else 'failed'
+        stats.record(status, result.start, result.duration, result.queued)
+        if os.path.exists(file_path):
+            stats.bytes = os.path.getsize(file_path)
+
+    return callback
+
+
+def _run_timed(stats, queued, function, *args):
+    """Call a function and record its timing and status"""
+    start = time.monotonic()
+    try:
+        result = function(*args)
+    except Exception:
+        stats.record('failed', start, time.monotonic() - start, queued)
+        raise
+    stats.record('succeeded', start, time.monotonic() - start, queued)
+    return result
+
+
+def _run_split(split, stats, function, *args):
+    """Wait for the file of a split, call a function with timing and
+       release the file.  Remote files are fetched once a thread is free"""
+    try:
+        split.wait()
+        return _run_timed(stats, time.monotonic(), function, *args)
+    finally:
+        split.finish()
+
+
+def _load_native(ch, load_files, parallel, block_size, load_settings,
+                 load_journal, load_report, ddl_runner, staged, dry_run,
+                 progress_reporter):
+    """Load files in-process using the native protocol with a thread pool.
+       Each file starts once the DDL of its table is done"""
+    # Column types come from the tables created by the DDL scripts.
+    columns = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = {}
+        for table, split in ddl_runner.ready(load_files, lambda op: op[0]):
+            if table not in columns and not dry_run:
+                columns[table] = ch.fetch_columns(table)
+            _progress_and_info(
+                "Loading data: table={0}, file={1}".format(
+                    table, split.name()), progress_reporter)
+            stats = load_report.add(table, split.name(), bytes=split.size())
+            insert_table = table
+            if staged is not None:
+                staged.create(table)
+                insert_table = staged.insert_table(table, split)
+            if dry_run:
+                logger.info("Dry run: native load of {0}".format(
+                    split.name()))
+                continue
+            future = pool.submit(_run_split, split, stats,
+                                 native_load.load_split, ch, insert_table,
+                                 split, columns[table], block_size,
+                                 load_settings.table(table))
+            futures[future] = (table, split, stats)
+        for future in concurrent.futures.as_completed(futures):
+            table, split, stats = futures[future]
+            try:
+                stats.rows = future.result()
+                load_journal.record(table, split, stats.rows)
+            except Exception as e:
+                stats.status = 'failed'
+                _progress_and_info(
+                    "Load failed: file={0}, error={1}".format(
+                        split.name(), e), progress_reporter)
+
+
+def dataset_publish(name,
+                    host='localhost',
+                    port=None,
+                    secure=False,
+                    verify=True,
+                    user='default',
+                    password=None,
+                    database=None,
+                    dry_run=False,
+                    progress_reporter=None):
+    """Retry publishing tables of a staged load from the staging tables
+       that the load kept when they failed to publish
+    :param name: (str): Name of dataset
+    :param host: (str): ClickHouse server host
+    :param port: (int): ClickHouse server port
+    :param secure: (boolean): If True use secure connection
+    :param verify: (boolean): If True verify connection on secure server
+    :param user: (str): ClickHouse user name
+    :param password: (str): ClickHouse password
+    :param database: (str): Database (defaults to dataset name)
+    :param dry_run: (boolean): If True print commands instead of executing them
+    :param progress_reporter: (function): If specified call function with
+                                          string message showing progress
+    :return: Report with a publish operation of each table
+    """
+    database = name if database is None else database
+    load_report = report.Report('load', name, database)
+    ch = clickhouse.ClickHouse(host=host,
+                               port=port,
+                               secure=secure,
+                               verify=verify,
+                               user=user,
+                               password=password,
+                               database=database,
+                               pool_size=1)
+    staged = staging.StagingTables.leftover(ch, dry_run, progress_reporter)
+    try:
+        if not staged.staging:
+            _progress_and_info(
+                "No staging tables to publish: {0}".format(database),
+                progress_reporter)
+        kept = staged.publish_all(load_report)
+    finally:
+        staged.close()
+        ch.close()
+    load_report.finish()
+    staging.check_published(kept)
+    return load_report
 
 
 def dataset_dump(name,
@@ -223,7 +1046,15 @@ def dataset_dump(name,
                  table_regex=None,
                  parallel=5,
                  overwrite=False,
+                 incremental=False,
                  compress=True,
+                 seekable=False,
+                 file_size=None,
+                 format='CSVWithNames',
+                 codec=None,
+                 level=None,
+                 compressor=None,
+                 compress_threads=None,
                  verbose=False,
                  dry_run=False,
                  progress_reporter=None):
@@ -240,10 +1071,123 @@ def dataset_dump(name,
     :param table_regex: (str): Regex to select tables
     :param parallel: (int): Number of processes to run in parallel when dumping
     :param overwrite: (boolean): If True wipe out existing data
+    :param incremental: (boolean): If True update an earlier dump in the
+                                   repo.  Only partitions whose fingerprint
+                                   in the manifest changed are dumped, and
+                                   files of dropped partitions and tables
+                                   are deleted.  Other manifest fields are
+                                   kept.  Cannot be used with file_size
     :param compress: (boolean): If True compress data files
+    :param seekable: (boolean): If True write compressed files as multi-frame
+                                files with a frame index so that loads can
+                                split them.  Implies parallel compressor
+    :param file_size: (int): If specified plan output files of about this
+                             many bytes on disk by splitting large
+                             partitions and grouping small ones
+    :param format: (str): Data file format: CSVWithNames, Native, Parquet
+                          or ORC
+    :param codec: (str): Compression codec: none, gzip, zstd or lz4.
+                         Overrides gzip selected by compress
+    :param level: (int): Compression level for file codecs
+    :param compressor: (str): What compresses CSV and Native files: 'gzip'
+                              pipes to the gzip command, 'clickhouse' uses
+                              clickhouse-client output compression and
+                              'parallel' compresses frames on several
+                              threads.  Defaults to gzip for CSV gzip dumps
+                              and clickhouse otherwise
+    :param compress_threads: (int): Threads per file for the parallel
+                                    compressor.  Defaults to cores divided
+                                    by parallel
     :param dry_run: (boolean): If True print commands instead of executing them
     :param progress_reporter: (function): If specified call function with
                                           string message showing progress
+    :return: Report with rows, bytes and timings of each operation
+    """
+    dump_report = report.Report('dump', name,
+                                name if database is None else database)
+    codec, compressor, compress_threads = dump_options(
+        format, codec, compress, seekable, compressor, compress_threads,
+        parallel, incremental, file_size)
+    ch, tables, data_path, opts, state = prepare_dump(
+        name, repo_path, host, port, secure, verify, user, password,
+        database, table_regex, parallel, overwrite, incremental, dry_run,
+        progress_reporter)
+
+    try:
+        dump_operations = plan_dump(ch, tables, data_path, opts,
+                                    overwrite or incremental, format, codec,
+                                    level, compressor, compress_threads,
+                                    file_size, state)
+
+        # Execute the dump commands.
+        pool = ProcessPool(size=parallel,
+                           dry_run=dry_run,
+                           progress_reporter=progress_reporter)
+        for name, key, cmd, _, file_path, rows, _ in dump_operations:
+            _progress_and_info(
+                "Dumping data: table={0}, partition={1}".format(name, key),
+                progress_reporter)
+            stats = dump_report.add(name,
+                                    os.path.basename(file_path),
+                                    rows=rows)
+            pool.exec(cmd, _dump_callback(stats, file_path))
+        pool.drain()
+        if not dry_run:
+            check_dump_rows(ch, tables, dump_operations,
+                            dump_report.operations, not incremental,
+                            progress_reporter, state)
+    finally:
+        ch.close()
+        state.save()
+    logger.info(pool.outputs)
+    if not dry_run:
+        report_output_bytes([op[4] for op in dump_operations],
+                            progress_reporter)
+    summarize(dump_report, progress_reporter)
+    return dump_report
+
+
+def dump_options(format, codec, compress, seekable, compressor,
+                 compress_threads, parallel, incremental, file_size):
+    """Check dump options and fill in defaults
+    :return: Tuple of (codec, compressor, compress_threads)
+    """
+    if incremental and file_size:
+        raise Exception(
+            "Incremental dumps write one file per partition, file size "
+            "cannot be set")
+    if format not in formats.DUMP_FORMATS:
+        raise Exception("Unknown dump format: {0}".format(format))
+    if codec is not None and codec not in formats.CODECS:
+        raise Exception("Unknown compression codec: {0}".format(codec))
+    elif codec is None and compress:
+        if formats.internal_codec_setting(format) is None:
+            codec = 'gzip'
+    if seekable:
+        compressor = 'parallel'
+    elif compressor is None:
+        if codec == 'gzip' and format == 'CSVWithNames':
+            compressor = 'gzip'
+        else:
+            compressor = 'clickhouse'
+    if compressor not in COMPRESSORS:
+        raise Exception("Unknown compressor: {0}".format(compressor))
+    elif compressor == 'parallel' and format != 'CSVWithNames':
+        raise Exception("Parallel compressor only writes CSV files")
+    elif compressor == 'gzip' and codec not in (None, 'gzip'):
+        raise Exception("gzip compressor only writes gzip files")
+    if compress_threads is None:
+        compress_threads = max(1, (os.cpu_count() or 1) // parallel)
+
+    return codec, compressor, compress_threads
+
+
+def prepare_dump(name, repo_path, host, port, secure, verify, user,
+                 password, database, table_regex, parallel, overwrite,
+                 incremental, dry_run, progress_reporter):
+    """Write the manifest and DDL of a dataset dump
+    :return: Tuple of (ClickHouse connector, list of TableData, data
+             directory, clickhouse-client options, DumpState)
     """
     # Connect to database and fetch table metadata.
     database = name if database is None else database
@@ -253,12 +1197,13 @@ def dataset_dump(name,
                                verify=verify,
                                user=user,
                                password=password,
-                               database=database)
+                               database=database,
+                               pool_size=parallel)
 
     # Fetch tables to dump.
     tables = ch.fetch_tables(table_regex=table_regex)
     if len(tables) == 0:
-        raise ("No tables found")
+        raise Exception("No tables found")
 
     # Create the dataset directory.
     if repo_path:
@@ -269,25 +1214,29 @@ def dataset_dump(name,
     data_path = os.path.join(ds_path, 'data')
     _progress_and_info("Preparing dataset directory: {0}".format(ds_path),
                        progress_reporter)
+    overwrite = overwrite or incremental
     os.makedirs(ds_path, exist_ok=overwrite)
     os.makedirs(ddl_path, exist_ok=overwrite)
     os.makedirs(data_path, exist_ok=overwrite)
 
     # Write a draft manifest with location fields filled in and others
-    # with default values.
+    # with default values.  Incremental dumps keep the earlier manifest
+    # including its partition fingerprints.
     manifest = {}
-    manifest['title'] = "{0} Data Set".format(name)
-    manifest[
-        'description'] = "Data set dumped from host {0}, database {1}".format(
-            host, database)
-    manifest['sources'] = "(Add source URL here)"
+    if incremental:
+        manifest = dump_state.DumpState(ds_path).manifest
+    manifest.setdefault('title', "{0} Data Set".format(name))
+    manifest.setdefault(
+        'description', "Data set dumped from host {0}, database {1}".format(
+            host, database))
+    manifest.setdefault('sources', "(Add source URL here)")
 
     # Compute size of the dataset by scanning tables.
     _progress_and_info("Computing data set size", progress_reporter)
     size = 0
-    for table in tables:
-        logger.info('Counting table rows: {0}'.format(table.name))
-        table_rows = ch.fetch_row_count(table)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        row_counts = pool.map(ch.fetch_row_count, tables)
+    for table, table_rows in zip(tables, row_counts):
         _progress_and_info(
             'Table: {0} Rows: {1}'.format(table.name, table_rows),
             progress_reporter)
@@ -309,49 +1258,406 @@ def dataset_dump(name,
         with open(sql_path, 'w') as sql_file:
             sql_file.write(table.create_table)
 
+    # Remove tables dumped earlier that no longer exist.
+    state = dump_state.DumpState(ds_path, dry_run)
+    if incremental:
+        state.remove_tables([table.name for table in tables], table_regex)
+
     # Build options for the clickhouse-client.
-    opts = _build_ch_client_opts(host, port, secure, user, password, database)
+    opts = build_ch_client_opts(host, port, secure, user, password, database)
+
+    return ch, tables, data_path, opts, state
+
+
+def report_output_bytes(file_paths, progress_reporter):
+    """Report bytes written and, where known, bytes before compression"""
+    bytes_out = 0
+    indexed_in = 0
+    indexed_out = 0
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            continue
+        bytes_out += os.path.getsize(file_path)
+        index = splits.read_index(file_path)
+        if index is not None and 'bytes_in' in index:
+            indexed_in += index['bytes_in']
+            indexed_out += index['bytes_out']
+    _progress_and_info("Bytes written: {0}".format(bytes_out),
+                       progress_reporter)
+    if indexed_out > 0:
+        _progress_and_info(
+            "Parallel compression: bytes_in={0}, bytes_out={1}, "
+            "ratio={2:.2f}".format(indexed_in, indexed_out,
+                                   indexed_in / indexed_out),
+            progress_reporter)
 
-    # Define dump scripts for each partition of each table.
+
+def plan_dump(ch, tables, data_path, opts, overwrite, format, codec, level,
+              compressor, compress_threads, file_size, state):
+    """Define dump commands for each partition or shard of each table.
+       Partitions that the DumpState shows unchanged are skipped
+    :return: List of tuple(table_name, partition_key, command, cost,
+             file_path, estimated_rows, query_id) in execution order
+    """
+    # Formats like Parquet apply the codec internally.  Others compress the
+    # whole file.
+    setting = formats.internal_codec_setting(format)
+    compression = None
+    if setting is not None and codec is not None:
+        opts += " --{0}={1}".format(setting, codec)
+    elif codec != 'none':
+        compression = codec
+
+    # Parts of all tables are listed in one query.
+    partitions = ch.fetch_all_partition_data(tables)
     dump_operations = []
     for table in tables:
         logger.info("Generating table dump command: {0}".format(table.name))
         table_path = os.path.join(data_path, table.name)
         os.makedirs(table_path, exist_ok=overwrite)
-        partitions = ch.fetch_partitions(table)
-        for partition_key, select in partitions:
-            if partition_key is None:
-                tag = "all"
-            else:
-                # URL-encode and remove single quotes and forward slashes.
-                tag = urllib.parse.quote(str(partition_key))
-                tag = tag.replace("/", "_")
-            file_path = os.path.join(table_path, "data-{0}.csv".format(tag))
-            client_cmd = ("clickhouse-client{0} --query=\"{1}\"".format(
-                opts, select))
-            if compress:
-                client_cmd += "| gzip"
-                file_path += ".gz"
-            dump_command = client_cmd + " > " + file_path
-            dump_operations.append((table.name, partition_key, dump_command))
-
-    # Execute the load commands.
-    pool = ProcessPool(size=parallel,
-                       dry_run=dry_run,
-                       progress_reporter=progress_reporter)
-    for name, key, cmd in dump_operations:
+        table_partitions = partitions.get(table.name, [])
+        fingerprints = {}
+        partition_rows = {}
+        if file_size:
+            # Shards do not map to partitions, so they are not tracked.
+            selects = [(shard.tag, None, shard.tag, select, shard.bytes,
+                        shard.rows) for shard, select in ch.fetch_shards(
+                            table, file_size, format=format,
+                            partitions=table_partitions)]
+            state.forget(table.name)
+        else:
+            selects = _partition_selects(ch, table, format, table_partitions)
+            for partition in table_partitions:
+                fingerprints[partition.partition_id] = partition.fingerprint()
+                partition_rows[partition.partition_id] = partition.rows
+        partition_ids = []
+        for partition_key, partition_id, tag, select, cost, rows in selects:
+            file_path = os.path.join(
+                table_path, formats.file_name(tag, format, compression))
+            if partition_id is not None:
+                partition_ids.append(partition_id)
+                fingerprint = fingerprints.get(partition_id)
+                if state.unchanged(table.name, partition_id, fingerprint,
+                                   file_path):
+                    logger.info(
+                        "Skipping unchanged partition: table={0}, "
+                        "partition={1}".format(table.name, partition_key))
+                    continue
+                state.plan(table.name, partition_id, fingerprint, file_path,
+                           partition_rows.get(partition_id))
+            # The query ID finds the rows dumped in system.query_log.
+            query_id = str(uuid.uuid4())
+            dump_command = _dump_command(
+                opts + " --query_id={0}".format(query_id), select, file_path,
+                compression, level, compressor, compress_threads)
+            dump_operations.append((table.name, partition_key, dump_command,
+                                    cost, file_path, rows, query_id))
+        if not file_size:
+            state.remove_partitions(table.name, partition_ids)
+
+    # Drop records of partitions being dumped, so that an interrupted dump
+    # does not leave partial files recorded as unchanged.
+    state.save()
+
+    # Dump the biggest partitions of all tables first.
+    return _largest_first(dump_operations, lambda op: op[3])
+
+
+def _dump_command(opts, select, file_path, compression, level, compressor,
+                  compress_threads):
+    """Return shell command that writes the result of a select to a file.
+       Pipelines run with pipefail, so that a client that fails fails the
+       command rather than leaving a truncated file"""
+    client_cmd = "clickhouse-client{0} --query={1}".format(
+        opts, shlex.quote(select))
+    if compression is None:
+        return "{0} > {1}".format(client_cmd, shlex.quote(file_path))
+    elif compressor == 'parallel':
+        return _pipefail("{0} | {1}".format(
+            client_cmd,
+            splits.seekable_command(file_path,
+                                    codec=compression,
+                                    level=level,
+                                    threads=compress_threads)))
+    elif compressor == 'gzip':
+        gzip_cmd = "gzip" if level is None else "gzip -{0}".format(level)
+        return _pipefail("{0} | {1} > {2}".format(client_cmd, gzip_cmd,
+                                                  shlex.quote(file_path)))
+
+    # Let clickhouse-client compress the output file.
+    body, format_clause = select.rsplit(" FORMAT ", 1)
+    sql = "{0} INTO OUTFILE {1} COMPRESSION {2}".format(
+        body, clickhouse.quote(file_path), clickhouse.quote(compression))
+    if level is not None:
+        sql += " LEVEL {0}".format(level)
+    sql += " FORMAT {0}".format(format_clause)
+    return "rm -f {0} && clickhouse-client{1} --query={2}".format(
+        shlex.quote(file_path), opts, shlex.quote(sql))
+
+
+def _pipefail(command):
+    """Return a shell pipeline that fails if any of its commands fails"""
+    return "bash -o pipefail -c {0}".format(shlex.quote(command))
+
+
+def check_dump_rows(ch, tables, dump_operations, operation_stats,
+                    complete, progress_reporter, state=None):
+    """Set rows of each dump from system.query_log and record partitions
+       whose rows match their fingerprint.  If the dump covers whole
+       tables, raise unless the rows dumped from each table match its row
+       count
+    :param operation_stats: (list): OperationStats of each dump operation
+    :param complete: (boolean): If True every partition of each table was
+                                dumped
+    :param state: (DumpState): If specified record dumped partitions here.
+                               Dumps without a query log entry are not
+                               recorded
+    """
+    query_rows = ch.fetch_query_rows([op[6] for op in dump_operations])
+    dumped = collections.Counter()
+    unknown = set()
+    for op, stats in zip(dump_operations, operation_stats):
+        if stats.status == 'succeeded' and op[6] in query_rows:
+            stats.rows = query_rows[op[6]][1]
+            dumped[op[0]] += stats.rows
+            if state is not None and op[4] in state.pending:
+                state.record(op[4], stats.rows)
+        else:
+            unknown.add(op[0])
+    if not complete:
+        return
+    mismatched = []
+    for table in tables:
+        if table.name in unknown:
+            logger.warning(
+                "Unable to check rows dumped, query log has no entries or "
+                "dumps failed: {0}".format(table.name))
+            continue
+        count = ch.count_rows(table)
         _progress_and_info(
-            "Dumping data: table={0}, partition={1}".format(name, key),
-            progress_reporter)
-        pool.exec(cmd)
-    pool.drain()
-    logger.info(pool.outputs)
+            "Rows dumped: table={0}, dumped={1}, count={2}".format(
+                table.name, dumped[table.name], count), progress_reporter)
+        if dumped[table.name] != count:
+            mismatched.append("{0} (dumped={1}, count={2})".format(
+                table.name, dumped[table.name], count))
+    if mismatched:
+        raise Exception(
+            "Rows dumped do not match table row counts, tables changed "
+            "during the dump: {0}".format(", ".join(mismatched)))
+
+
+def _partition_selects(ch, table, format, partitions=None):
+    """Return a select for each partition of a table
+    :param partitions: (list): PartitionData of the table if already
+                               fetched
+    :return: List of tuple(partition_key, partition_id, file_tag, sql,
+             estimated_bytes, estimated_rows)
+    """
+    selects = []
+    for partition, select in ch.fetch_partition_selects(
+            table, format=format, partitions=partitions):
+        if partition is None:
+            partition_key = None
+            # Parts of unpartitioned tables belong to partition 'all'.
+            partition_id = "all"
+            tag = "all"
+            cost = table.total_bytes or 0
+            rows = table.total_rows
+        else:
+            # URL-encode and remove single quotes and forward slashes.
+            partition_key = partition.key()
+            partition_id = partition.partition_id
+            tag = urllib.parse.quote(partition_key)
+            tag = tag.replace("/", "_")
+            cost = partition.bytes
+            rows = partition.rows
+        selects.append((partition_key, partition_id, tag, select, cost,
+                        rows))
+    return selects
+
+
+def _largest_first(operations, cost):
+    """Order operations by decreasing estimated cost
+
+    Feeding a FIFO pool largest job first is the classic longest processing
+    time heuristic, which keeps the pool makespan close to optimal.
+    :param operations: (list): Operations to schedule
+    :param cost: (function): Returns estimated cost of an operation
+    :return: New list of operations in execution order
+    """
+    return sorted(operations, key=cost, reverse=True)
+
+
+def dataset_generate(name,
+                     scale,
+                     repo_path=None,
+                     output_path=None,
+                     overwrite=False,
+                     codec=None,
+                     file_rows=generate.DEFAULT_FILE_ROWS,
+                     seed=0,
+                     parallel=None,
+                     load=False,
+                     host='localhost',
+                     port=None,
+                     secure=False,
+                     verify=True,
+                     user='default',
+                     password=None,
+                     database=None,
+                     clean=False,
+                     progress_reporter=None):
+    """Generate synthetic data for a dataset from its DDL and the 'generate'
+       section of its manifest.  Data are written as a new dataset in
+       output_path or inserted directly into a database
+    :param name: (str): Name of dataset
+    :param scale: (float): Scale factor, about scale GB of CSV data
+    :param repo_path: (str): Repo directory or None to search built-ins
+    :param output_path: (str): Repo directory for the generated dataset
+    :param overwrite: (boolean): If True overwrite existing files
+    :param codec: (str): gzip, zstd or lz4 to compress files
+    :param file_rows: (int): Rows in each file or insert stream
+    :param seed: (int): Random seed.  The same seed and file_rows generate
+                        the same data
+    :param parallel: (int): Worker processes (defaults to CPU count)
+    :param load: (boolean): If True insert into a database instead of
+                            writing files
+    :param host: (str): ClickHouse server host
+    :param port: (int): ClickHouse server port
+    :param secure: (boolean): If True use secure connection
+    :param verify: (boolean): If True verify connection on secure server
+    :param user: (str): ClickHouse user name
+    :param password: (str): ClickHouse password
+    :param database: (str): Database (defaults to dataset name)
+    :param clean: (boolean): If True wipe out existing data before loading
+    :param progress_reporter: (function): If specified call function with
+                                          string message showing progress
+    :return: Report with rows, bytes and timings of each file or stream
+    """
+    if (output_path is None) == (not load):
+        raise Exception("Specify either an output path or load")
+    if codec is not None and codec not in formats.CODECS:
+        raise Exception("Unknown compression codec: {0}".format(codec))
+    dataset = _find_dataset(name, repo_path)
+    # Remote datasets need only their DDL.
+    _mirror_dataset(dataset, 1, False, progress_reporter)
+    parallel = parallel or os.cpu_count()
+    database = name if database is None else database
+
+    # Plan row counts from the DDL and hints.
+    scripts = []
+    for sql_file in sorted(glob.glob(os.path.join(dataset['path'], 'ddl',
+                                                  '*'))):
+        with open(sql_file, 'r') as f:
+            scripts.append(f.read())
+    tables = generate.plan_tables(scripts, dataset.get('generate'), scale)
+    if len(tables) == 0:
+        raise Exception("No tables with columns in DDL: {0}".format(name))
+    total_rows = 0
+    for table, _, rows in tables:
+        _progress_and_info('Table: {0} Rows: {1}'.format(table, rows),
+                           progress_reporter)
+        total_rows += rows
+
+    gen_report = report.Report('generate', name, database)
+    if load:
+        ch = _create_database(host, port, secure, verify, user, password,
+                              database, parallel, clean, False,
+                              progress_reporter)
+        ddl_runner = _start_ddl(ch, dataset['path'], parallel, False,
+                                progress_reporter)
+        try:
+            ddl_runner.wait()
+        finally:
+            ddl_runner.close()
+            ch.close()
+        connection = {
+            'host': host,
+            'port': port,
+            'secure': secure,
+            'verify': verify,
+            'user': user,
+            'password': password,
+            'database': database
+        }
+    else:
+        data_path = _prepare_generated(dataset, output_path, overwrite,
+                                       scale, total_rows, progress_reporter)
+
+    operations = []
+    queued = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as pool:
+        for table, columns, number, first_row, rows in generate.plan_parts(
+                tables, file_rows):
+            if load:
+                stats = gen_report.add(table, str(number))
+                future = pool.submit(generate.insert_part, table, columns,
+                                     connection, first_row, rows, seed)
+            else:
+                file_name = formats.file_name(str(number), 'CSVWithNames',
+                                              codec)
+                stats = gen_report.add(table, file_name, rows=rows)
+                table_path = os.path.join(data_path, table)
+                os.makedirs(table_path, exist_ok=True)
+                future = pool.submit(generate.write_part, table, columns,
+                                     os.path.join(table_path, file_name),
+                                     first_row, rows, seed, codec)
+            operations.append((future, stats))
+
+        for future, stats in operations:
+            try:
+                result, start, duration = future.result()
+                if load:
+                    stats.rows = result
+                else:
+                    stats.bytes = result
+                stats.record('succeeded', start, duration, queued)
+                _progress_and_info(
+                    "Generated: table={0}, part={1}".format(
+                        stats.table, stats.name), progress_reporter)
+            except Exception as e:
+                stats.status = 'failed'
+                _progress_and_info(
+                    "Generate failed: table={0}, part={1}, error={2}".format(
+                        stats.table, stats.name, e), progress_reporter)
+    gen_report.finish()
     _progress_and_info(
-        "Operation summary: succeeded={0}, failed={1}".format(
-            pool.succeeded, pool.failed), progress_reporter)
+        "Operation summary: succeeded={0}, failed={1}, skipped={2}".format(
+            gen_report.succeeded, gen_report.failed,
+            gen_report.skipped), progress_reporter)
+    return gen_report
+
+
+def _prepare_generated(dataset, output_path, overwrite, scale, rows,
+                       progress_reporter):
+    """Write the manifest and DDL of a generated dataset
+    :return: Data directory
+    """
+    ds_path = os.path.join(output_path, dataset['name'])
+    ddl_path = os.path.join(ds_path, 'ddl')
+    data_path = os.path.join(ds_path, 'data')
+    _progress_and_info("Preparing dataset directory: {0}".format(ds_path),
+                       progress_reporter)
+    os.makedirs(ds_path, exist_ok=overwrite)
+    os.makedirs(data_path, exist_ok=overwrite)
+    if os.path.exists(ddl_path):
+        shutil.rmtree(ddl_path)
+    shutil.copytree(os.path.join(dataset['path'], 'ddl'), ddl_path)
+
+    # Copy the manifest without location fields.
+    manifest = {
+        key: value
+        for key, value in dataset.items()
+        if key not in ('name', 'path', 'repo')
+    }
+    manifest['size'] = '{0} rows (generated at scale {1})'.format(rows, scale)
+    with open(os.path.join(ds_path, 'manifest.yaml'), 'w') as f:
+        yaml.dump(manifest, f)
+    return data_path
 
 
-def _build_ch_client_opts(host, port, secure, user, password, database):
+def build_ch_client_opts(host, port, secure, user, password, database):
+    """Return clickhouse-client command line options for a connection"""
     opts = ''
     if host:
         opts += " --host={0}".format(host)
@@ -0,0 +1,517 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import re
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from altinity_datasets import formats
+"""Benchmarks dataset loads and dumps on synthetic datasets.  Runs against
+   a ClickHouse server or against a sink that stands in for the server.  The
+   sink replaces the ClickHouse connector in-process with SinkConnector and
+   puts a fake clickhouse-client on the PATH, so loads and dumps run their
+   usual planning and client pipelines without a server.  Results are
+   appended to a JSON lines file so that runs can be compared between
+   commits.  The api and driver are imported on use to keep the fake client
+   fast"""
+
+# Default file for benchmark results.
+DEFAULT_RESULTS = 'bench-results.jsonl'
+
+# Environment variable that points the fake clickhouse-client to the spec.
+SINK_SPEC_ENV = 'ALTINITY_BENCH_SPEC'
+
+# Environment variable with the file where the fake clickhouse-client logs
+# rows of each query for the sink connector's query log lookups.
+SINK_QUERY_LOG_ENV = 'ALTINITY_BENCH_QUERY_LOG'
+
+# Columns of synthetic tables.  The payload pads rows to the row width.
+COLUMNS = [('id', 'UInt64'), ('ts', 'DateTime'), ('payload', 'String')]
+
+# Rows generated at once when writing data files.
+_CHUNK_ROWS = 10000
+
+
+class BenchSpec:
+    """Parameters of a synthetic benchmark dataset"""
+
+    def __init__(self,
+                 tables=2,
+                 files=4,
+                 file_size=1024 * 1024,
+                 row_width=100,
+                 compression=None,
+                 partitions=12):
+        """Define a dataset
+        :param tables: (int): Number of tables
+        :param files: (int): Data files per table
+        :param file_size: (int): Uncompressed bytes per data file
+        :param row_width: (int): Bytes per CSV row
+        :param compression: (str): None, gzip, zstd or lz4
+        :param partitions: (int): Monthly partitions per table
+        """
+        self.tables = tables
+        self.files = files
+        self.file_size = file_size
+        self.row_width = max(row_width, 40)
+        self.compression = compression
+        self.partitions = max(1, min(partitions, 12))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def to_dict(self):
+        return {
+            'tables': self.tables,
+            'files': self.files,
+            'file_size': self.file_size,
+            'row_width': self.row_width,
+            'compression': self.compression,
+            'partitions': self.partitions
+        }
+
+    def name(self):
+        """Return dataset name that encodes the parameters"""
+        return "bench_t{0}_f{1}_s{2}_w{3}_{4}".format(
+            self.tables, self.files, self.file_size, self.row_width,
+            self.compression or 'none')
+
+    def table_names(self):
+        return ["t{0}".format(i) for i in range(self.tables)]
+
+    def rows_per_file(self):
+        return max(1, self.file_size // self.row_width)
+
+    def table_rows(self):
+        return self.files * self.rows_per_file()
+
+    def partition_rows(self):
+        """Return rows in each partition keyed by partition ID"""
+        rows = self.table_rows()
+        counts = {}
+        for i in range(self.partitions):
+            partition_id = "2019{0:02d}".format(i + 1)
+            extra = 1 if i < rows % self.partitions else 0
+            counts[partition_id] = rows // self.partitions + extra
+        return counts
+
+
+def create_table_sql(table):
+    columns = ", ".join("{0} {1}".format(n, t) for n, t in COLUMNS)
+    return ("CREATE TABLE {0} ({1}) ENGINE = MergeTree "
+            "PARTITION BY toYYYYMM(ts) ORDER BY id").format(table, columns)
+
+
+def generate(spec, repo_path):
+    """Write a synthetic dataset in repo layout
+    :param spec: (BenchSpec): Dataset parameters
+    :param repo_path: (str): Repo directory
+    :return: Dataset directory
+    """
+    import yaml
+    ds_path = os.path.join(repo_path, spec.name())
+    os.makedirs(os.path.join(ds_path, 'ddl'))
+    with open(os.path.join(ds_path, 'manifest.yaml'), 'w') as f:
+        yaml.dump(
+            {
+                'title': 'Benchmark dataset {0}'.format(spec.name()),
+                'description': 'Synthetic data for benchmarks',
+                'size': '{0} rows'.format(spec.tables * spec.table_rows())
+            }, f)
+    for table in spec.table_names():
+        with open(os.path.join(ds_path, 'ddl', table + '.sql'), 'w') as f:
+            f.write(create_table_sql(table))
+        table_path = os.path.join(ds_path, 'data', table)
+        os.makedirs(table_path)
+        for i in range(spec.files):
+            file_path = os.path.join(
+                table_path,
+                formats.file_name(str(i), 'CSVWithNames', spec.compression))
+            _write_file(spec, file_path, i * spec.rows_per_file())
+    return ds_path
+
+
+def _write_file(spec, file_path, first_id):
+    from altinity_datasets import splits
+    compress = None
+    if spec.compression is not None:
+        compress = splits.compressor(spec.compression, level=1)
+    with open(file_path, 'wb') as f:
+        header = ",".join(n for n, _ in COLUMNS) + "\n"
+        f.write(compress(header.encode()) if compress else header.encode())
+        rows = spec.rows_per_file()
+        for lo in range(0, rows, _CHUNK_ROWS):
+            data = _csv_rows(spec, first_id + lo,
+                             min(_CHUNK_ROWS, rows - lo)).encode()
+            f.write(compress(data) if compress else data)
+
+
+def _csv_rows(spec, first_id, count, partition_id=None):
+    """Return CSV rows of about row_width bytes each"""
+    lines = []
+    for row_id in range(first_id, first_id + count):
+        if partition_id is None:
+            month = row_id % spec.partitions + 1
+        else:
+            month = int(partition_id[4:])
+        prefix = "{0},2019-{1:02d}-01 00:00:00,".format(row_id, month)
+        lines.append(prefix + "x" * (spec.row_width - len(prefix) - 1))
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def sink(spec, workdir):
+    """Replace the ClickHouse connector and clickhouse-client with the
+       sink"""
+    from altinity_datasets import clickhouse
+    from altinity_datasets.sink import SinkConnector
+    bin_path = os.path.join(workdir, 'bin')
+    os.makedirs(bin_path, exist_ok=True)
+    script = os.path.join(bin_path, 'clickhouse-client')
+    with open(script, 'w') as f:
+        f.write("#!/bin/sh\nexec {0} -m altinity_datasets.bench "
+                "fake-client \"$@\"\n".format(shlex.quote(sys.executable)))
+    os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+
+    package_root = os.path.dirname(os.path.dirname(__file__))
+    saved_env = dict(os.environ)
+    saved_connector = clickhouse.ClickHouse
+    os.environ['PATH'] = bin_path + os.pathsep + os.environ.get('PATH', '')
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        p for p in (package_root, os.environ.get('PYTHONPATH')) if p)
+    os.environ[SINK_SPEC_ENV] = json.dumps(spec.to_dict())
+    os.environ[SINK_QUERY_LOG_ENV] = os.path.join(workdir, 'query_log.txt')
+    clickhouse.ClickHouse = SinkConnector
+    SinkConnector.spec = spec
+    try:
+        yield
+    finally:
+        clickhouse.ClickHouse = saved_connector
+        SinkConnector.spec = None
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+def fake_client(args):
+    """Act as clickhouse-client for the sink.  Inserts read and discard
+       their input and log its rows.  Selects write synthetic CSV rows for
+       the selected partitions
+    :return: Process exit code
+    """
+    query = None
+    query_id = None
+    for arg in args:
+        if arg.startswith('--query='):
+            query = arg[len('--query='):]
+        elif arg.startswith('--query_id='):
+            query_id = arg[len('--query_id='):]
+    if query is None:
+        sys.stderr.write("fake clickhouse-client needs --query\n")
+        return 1
+    spec = BenchSpec.from_dict(json.loads(os.environ[SINK_SPEC_ENV]))
+    if query.startswith('INSERT'):
+        # Rows of files that the client reads itself are not counted.
+        lines = 0
+        if ' FROM INFILE ' not in query:
+            while True:
+                chunk = sys.stdin.buffer.read(1024 * 1024)
+                if not chunk:
+                    break
+                lines += chunk.count(b'\n')
+        _log_query(query_id, max(0, lines - 1), 0)
+        return 0
+    format = query.rsplit(' FORMAT ', 1)[-1].strip()
+    if format != 'CSVWithNames':
+        sys.stderr.write("fake clickhouse-client only writes CSV\n")
+        return 1
+
+    outfile = re.search(r"INTO OUTFILE '([^']*)'(?: COMPRESSION '(\w+)')?",
+                        query)
+    if outfile is None:
+        out = sys.stdout.buffer
+    elif outfile.group(2) in (None, 'none'):
+        out = open(outfile.group(1), 'wb')
+    elif outfile.group(2) == 'gzip':
+        out = gzip.open(outfile.group(1), 'wb', compresslevel=1)
+    else:
+        sys.stderr.write("fake clickhouse-client only writes gzip\n")
+        return 1
+    with out:
+        out.write((",".join(n for n, _ in COLUMNS) + "\n").encode())
+        selected = re.findall(r"'(\d{6})'", query.split(' WHERE ')[-1])
+        partitions = spec.partition_rows()
+        if ' WHERE ' not in query:
+            selected = sorted(partitions)
+        first_id = 0
+        for partition_id in selected:
+            rows = partitions.get(partition_id[:6], 0)
+            for lo in range(0, rows, _CHUNK_ROWS):
+                count = min(_CHUNK_ROWS, rows - lo)
+                out.write(
+                    _csv_rows(spec, first_id, count, partition_id).encode())
+                first_id += count
+    _log_query(query_id, 0, first_id)
+    return 0
+
+
+def _log_query(query_id, written_rows, result_rows):
+    """Record rows of a fake client query for the sink connector"""
+    if query_id is not None:
+        with open(os.environ[SINK_QUERY_LOG_ENV], 'a') as f:
+            f.write("{0} {1} {2}\n".format(query_id, written_rows,
+                                           result_rows))
+
+
+def run(spec,
+        target='sink',
+        host='localhost',
+        port=None,
+        user='default',
+        password=None,
+        loader='client',
+        parallel=4,
+        split_size=None,
+        workdir=None,
+        results_path=None,
+        progress_reporter=None):
+    """Generate a dataset, then load and dump it and record results
+    :param spec: (BenchSpec): Dataset parameters
+    :param target: (str): 'sink' or 'server'
+    :param host: (str): Server host for the server target
+    :param port: (int): Server port
+    :param user: (str): Server user
+    :param password: (str): Server password
+    :param loader: (str): Loader used by dataset_load
+    :param parallel: (int): Parallel operations
+    :param split_size: (int): Split size for loads
+    :param workdir: (str): Directory for generated and dumped files.  A
+                           temporary directory is used and removed if None
+    :param results_path: (str): If specified append the result to this file
+    :param progress_reporter: (function): Called with progress messages
+    :return: Result dictionary
+    """
+    from altinity_datasets import api
+    if target not in ('sink', 'server'):
+        raise Exception("Unknown benchmark target: {0}".format(target))
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix='altinity-bench-')
+    rss_before = _peak_rss()
+    try:
+        repo_path = os.path.join(workdir, 'repo')
+        dump_path = os.path.join(workdir, 'dumps')
+        os.makedirs(dump_path, exist_ok=True)
+        start = time.monotonic()
+        generate(spec, repo_path)
+        generate_seconds = time.monotonic() - start
+
+        name = spec.name()
+        context = sink(spec, workdir) if target == 'sink' else (
+            contextlib.suppress())
+        with context:
+            load_report = api.dataset_load(name,
+                                           repo_path=repo_path,
+                                           host=host,
+                                           port=port,
+                                           user=user,
+                                           password=password,
+                                           parallel=parallel,
+                                           clean=True,
+                                           loader=loader,
+                                           split_size=split_size,
+                                           progress_reporter=progress_reporter)
+            dump_report = api.dataset_dump(
+                name,
+                repo_path=dump_path,
+                host=host,
+                port=port,
+                user=user,
+                password=password,
+                parallel=parallel,
+                overwrite=True,
+                compress=spec.compression is not None,
+                progress_reporter=progress_reporter)
+    finally:
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'commit': _git_commit(),
+        'timestamp': time.time(),
+        'target': target,
+        'spec': spec.to_dict(),
+        'loader': loader,
+        'parallel': parallel,
+        'split_size': split_size,
+        'generate_seconds': generate_seconds,
+        'load': _metrics(load_report),
+        'dump': _metrics(dump_report),
+    }
+    result.update(_run_peak_rss(rss_before, _peak_rss()))
+    if results_path is not None:
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(result) + "\n")
+    return result
+
+
+def _metrics(report):
+    """Summarize a load or dump report.  Planning time is the time before
+       the first operation started"""
+    starts = [op.start for op in report.operations if op.start is not None]
+    data_bytes = sum(op.bytes or 0 for op in report.operations)
+    return {
+        'wall_seconds': report.wall_time,
+        'planning_seconds': min(starts) if starts else report.wall_time,
+        'bytes': data_bytes,
+        'rows': sum(op.rows or 0 for op in report.operations),
+        'throughput_mb_s': (data_bytes / report.wall_time / 1e6
+                            if report.wall_time else None),
+        'succeeded': report.succeeded,
+        'failed': report.failed
+    }
+
+
+def _peak_rss():
+    """Return peak resident set size in KB of this process and of its
+       largest child over the life of the process"""
+    try:
+        import resource
+    except ImportError:
+        return {}
+    return {
+        'peak_rss_kb':
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_child_rss_kb':
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+
+
+def _run_peak_rss(before, after):
+    """Return peak RSS of a run from process peaks before and after it.  A
+       peak that did not grow was reached before the run, e.g., by an
+       earlier run in the same process, so the run's own peak is unknown
+       and reported as None"""
+    return {
+        key: value if value > before[key] else None
+        for key, value in after.items()
+    }
+
+
+def _git_commit():
+    """Return the commit of the source tree or None outside of git"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results_path, metrics=('load.throughput_mb_s',
+                                   'dump.throughput_mb_s')):
+    """Return lines comparing results of the same scenario across commits.
+       Results of the same commit and scenario show the latest run"""
+    scenarios = {}
+    with open(results_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            key = "{0} {1} loader={2} parallel={3}".format(
+                result['target'],
+                BenchSpec.from_dict(result['spec']).name(), result['loader'],
+                result['parallel'])
+            scenarios.setdefault(key, {})[result['commit']] = result
+
+    lines = []
+    for key in sorted(scenarios):
+        lines.append(key)
+        for commit, result in sorted(scenarios[key].items(),
+                                     key=lambda item: item[1]['timestamp']):
+            values = []
+            for metric in metrics:
+                section, field = metric.split('.')
+                value = result[section][field]
+                values.append("{0}={1}".format(
+                    metric, "-" if value is None else "{0:.3f}".format(value)))
+            lines.append("  {0:<10} {1}".format(commit or '-',
+                                                " ".join(values)))
+    return lines
+
+
+def main():
+    # Client options pass through as is rather than through argparse.
+    if sys.argv[1:2] == ['fake-client']:
+        sys.exit(fake_client(sys.argv[2:]))
+    parser = argparse.ArgumentParser(
+        description='Benchmark dataset loads and dumps')
+    commands = parser.add_subparsers(dest='command')
+    bench = commands.add_parser('run', help='Run a benchmark')
+    bench.add_argument('--target', default='sink', choices=['sink', 'server'])
+    bench.add_argument('--host', default='localhost')
+    bench.add_argument('--port', type=int)
+    bench.add_argument('--user', default='default')
+    bench.add_argument('--password')
+    bench.add_argument('--tables', type=int, default=2)
+    bench.add_argument('--files', type=int, default=4)
+    bench.add_argument('--file-size',
+                       type=int,
+                       default=1024 * 1024,
+                       help='Uncompressed bytes per data file')
+    bench.add_argument('--row-width', type=int, default=100)
+    bench.add_argument('--compression', choices=['gzip', 'zstd', 'lz4'])
+    bench.add_argument('--loader',
+                       default='client',
+                       choices=formats.LOADERS)
+    bench.add_argument('--parallel', type=int, default=4)
+    bench.add_argument('--split-size', type=int)
+    bench.add_argument('--workdir', help='Keep generated files here')
+    bench.add_argument('--results', default=DEFAULT_RESULTS)
+    report = commands.add_parser('compare',
+                                 help='Compare results across commits')
+    report.add_argument('--results', default=DEFAULT_RESULTS)
+    report.add_argument('--metric',
+                        action='append',
+                        help='Metric such as load.wall_seconds')
+    commands.add_parser('fake-client',
+                        help='Fake clickhouse-client used by the sink')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        spec = BenchSpec(args.tables, args.files, args.file_size,
+                         args.row_width, args.compression)
+        result = run(spec, args.target, args.host, args.port, args.user,
+                     args.password, args.loader, args.parallel,
+                     args.split_size, args.workdir, args.results)
+        print(json.dumps(result, indent=2))
+    elif args.command == 'compare':
+        metrics = args.metric or ['load.throughput_mb_s',
+                                  'dump.throughput_mb_s']
+        for line in compare(args.results, metrics):
+            print(line)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from altinity_datasets import formats
+"""Cached index of the datasets in a repo.  The index holds parsed
+   manifests and data file inventories so that searches do not list and
+   parse every dataset on each call"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Version of the index layout.  Indexes with another version are rebuilt.
+INDEX_VERSION = 2
+
+# A list of built-in repo locations.
+BUILT_INS = [
+    {
+        'name': 'built-ins',
+        'description': 'Built-in dataset repository',
+        'path':
+        os.path.realpath(os.path.join(os.path.dirname(__file__), 'built-ins'))
+    },
+]
+
+
+def load_yaml(f):
+    """Parse a YAML file with the C parser if PyYAML was built with
+       libyaml.  yaml is imported here to keep CLI startup fast"""
+    import yaml
+    return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def repos():
+    """List built-in repos and repos configured in repos.yaml"""
+    return BUILT_INS + configured_repos()
+
+
+def configured_repos():
+    """Return repos listed in the user's repos.yaml.  Each has a name,
+       description and path, which may be a directory or remote URL"""
+    config_home = os.environ.get('XDG_CONFIG_HOME',
+                                 os.path.join(os.path.expanduser('~'),
+                                              '.config'))
+    repos_yaml = os.path.join(config_home, 'altinity-datasets', 'repos.yaml')
+    if not os.path.exists(repos_yaml):
+        return []
+    with open(repos_yaml, 'r') as f:
+        entries = load_yaml(f) or []
+    return [{
+        'name': entry['name'],
+        'description': entry.get('description', ''),
+        'path': entry['path']
+    } for entry in entries]
+
+
+def default_cache_dir():
+    """Return directory for catalog indexes.  Indexes are kept outside
+       repos because writing into a repo would change its mtime"""
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache'))
+    return os.path.join(cache_home, 'altinity-datasets')
+
+
+def _stat(path):
+    """Return (mtime_ns, size) of a path or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class Catalog:
+    """Index of the datasets in one repo directory"""
+
+    def __init__(self, repo_path, cache_dir=None):
+        """Open the index of a repo, which is read from the cache if present
+        :param repo_path: (str): Repo directory
+        :param cache_dir: (str): Directory for indexes or None for default
+        """
+        self.repo_path = os.path.realpath(repo_path)
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        digest = hashlib.sha1(self.repo_path.encode('utf-8')).hexdigest()
+        self.index_path = os.path.join(
+            cache_dir, "catalog-{0}.json".format(digest[:16]))
+        self.rebuilt = []
+        self._changed = False
+        self._index = self._read_index()
+
+    def get(self, name):
+        """Return the index entry of a dataset or None if it does not exist
+        :param name: (str): Dataset name
+        """
+        entry = self._entry(name)
+        self.save()
+        return entry
+
+    def datasets(self):
+        """Return index entries of all datasets in name order"""
+        repo_stat = _stat(self.repo_path)
+        if repo_stat != self._index['repo']:
+            # Datasets were added or removed.
+            names = [
+                child for child in os.listdir(self.repo_path)
+                if os.path.isdir(os.path.join(self.repo_path, child))
+            ]
+            for name in set(self._index['datasets']) - set(names):
+                del self._index['datasets'][name]
+            self._index['repo'] = repo_stat
+            self._changed = True
+        else:
+            names = list(self._index['datasets'])
+        entries = []
+        for name in sorted(names):
+            entry = self._entry(name)
+            if entry is not None:
+                entries.append(entry)
+        self.save()
+        return entries
+
+    def save(self):
+        """Write the index if it changed.  Failures are logged, since the
+           index is only a cache"""
+        if not self._changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.index_path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self.index_path)
+            self._changed = False
+        except OSError as e:
+            logger.warning("Unable to write catalog index: {0}: {1}".format(
+                self.index_path, e))
+
+    def _read_index(self):
+        empty = {'version': INDEX_VERSION, 'repo': None, 'datasets': {}}
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return empty
+        if index.get('version') != INDEX_VERSION:
+            return empty
+        return index
+
+    def _entry(self, name):
+        """Return a current entry, rebuilding it if the dataset changed"""
+        path = os.path.join(self.repo_path, name)
+        entry = self._index['datasets'].get(name)
+        if os.path.basename(name) != name or name in ('', '.', '..'):
+            return None
+        elif not os.path.isdir(path):
+            if entry is not None:
+                del self._index['datasets'][name]
+                self._changed = True
+            return None
+        elif entry is not None and self._is_current(entry):
+            return entry
+        entry = self._build_entry(name, path)
+        self._index['datasets'][name] = entry
+        self.rebuilt.append(name)
+        self._changed = True
+        return entry
+
+    def _is_current(self, entry):
+        """Check stored stats of the dataset's manifest and directories.
+           Files replaced in place with the same name do not change
+           directory times, so their inventory sizes may be stale"""
+        for path, stat in entry['stats'].items():
+            if _stat(path) != stat:
+                return False
+        return True
+
+    def _build_entry(self, name, path):
+        """Parse the manifest and list data files of a dataset"""
+        logger.debug("Indexing dataset: {0}".format(path))
+        manifest_yaml = os.path.join(path, 'manifest.yaml')
+        data_path = os.path.join(path, 'data')
+        stats = {}
+        for stat_path in (path, manifest_yaml, data_path):
+            stats[stat_path] = _stat(stat_path)
+
+        manifest = {}
+        if stats[manifest_yaml] is not None:
+            with open(manifest_yaml, 'r') as f:
+                # Values that JSON cannot hold, such as YAML dates, become
+                # strings now, so entries look the same when read from
+                # the cache.
+                manifest = json.loads(
+                    json.dumps(load_yaml(f) or {}, default=str))
+
+        tables = {}
+        if os.path.isdir(data_path):
+            for table in sorted(os.listdir(data_path)):
+                table_path = os.path.join(data_path, table)
+                if not os.path.isdir(table_path):
+                    continue
+                stats[table_path] = _stat(table_path)
+                files = []
+                for file_name in sorted(os.listdir(table_path)):
+                    file_path = os.path.join(table_path, file_name)
+                    if not os.path.isfile(file_path):
+                        continue
+                    # Classify files as loads do.
+                    classified = formats.classify(file_path)
+                    if classified is None:
+                        continue
+                    files.append({
+                        'file': file_name,
+                        'size': os.path.getsize(file_path),
+                        'container': classified[0],
+                        'format': classified[2],
+                        'compression': classified[1]
+                    })
+                tables[table] = files
+
+        return {
+            'name': name,
+            'path': path,
+            'manifest': manifest,
+            'tables': tables,
+            'stats': stats
+        }
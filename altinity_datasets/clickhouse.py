@@ -9,16 +9,50 @@
 # code for the these subcomponents is subject to the terms and
 # conditions of the subcomponent's license, as noted in the LICENSE file.
 
+import collections
+import datetime
+import decimal
 import logging
+import math
 import re
+import threading
+import time
+import uuid
 
 from clickhouse_driver import Client
+from clickhouse_driver.errors import ServerException
 """Implements a driver module for ClickHouse that encapsulates driver
    API calls and SQL execution conventions"""
 
 # Define logger
 logger = logging.getLogger(__name__)
 
+# Default maximum number of connections held by a ClickHouse instance.
+DEFAULT_POOL_SIZE = 8
+
+# Seconds after which an unused connection is closed.
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Seconds a connection may sit unused before it is pinged on reuse.
+DEFAULT_CHECK_INTERVAL = 10
+
+# Seconds to wait for finished queries to appear in system.query_log, which
+# the server flushes every few seconds.
+QUERY_LOG_TIMEOUT = 30
+
+# Seconds between reads of system.query_log while waiting.
+QUERY_LOG_POLL_INTERVAL = 1
+
+# Key values sampled from a partition to find shard boundaries.
+KEY_SAMPLE_ROWS = 10000
+
+# Shown in place of hidden values in logged statements.
+SECRET_MASK = '[HIDDEN]'
+
+# Hidden values, e.g., credentials inlined in statements, as they appear
+# in statements.
+_secrets = set()
+
 
 class TableData:
     """Metadata for a table in Clickhouse"""
@@ -29,20 +63,366 @@ class TableData:
         self.partition_key = partition_key
         self.sorting_key = sorting_key
         self.create_table = None
+        # Row and byte totals from system tables, or None if unknown.
+        self.total_rows = None
+        self.total_bytes = None
+
+
+class PartitionData:
+    """Totals of the active parts in a partition of a MergeTree table"""
+
+    def __init__(self, name, partition_id, rows, bytes, min_block=None,
+                 max_block=None, mutation=None):
+        """Define a partition
+        :param name: (str): Partition value as shown in system.parts
+        :param partition_id: (str): Partition ID used by _partition_id
+        :param rows: (int): Rows in active parts
+        :param bytes: (int): Bytes on disk of active parts
+        :param min_block: (int): Lowest block number of active parts
+        :param max_block: (int): Highest block number of active parts
+        :param mutation: (int): Highest data version of mutated parts or 0
+        """
+        self.name = name
+        self.partition_id = partition_id
+        self.rows = rows
+        self.bytes = bytes
+        self.min_block = min_block
+        self.max_block = max_block
+        self.mutation = mutation
+
+    def fingerprint(self):
+        """Return a string that changes when rows are inserted, deleted or
+           mutated but not when parts merge, or None without block numbers
+        """
+        if self.min_block is None:
+            return None
+        return "rows={0},blocks={1}-{2},mutation={3}".format(
+            self.rows, self.min_block, self.max_block, self.mutation)
+
+    def key(self):
+        """Return partition value without quotes around a single string"""
+        if len(self.name) > 1 and self.name[0] == self.name[-1] == "'":
+            return self.name[1:-1].replace("\\'", "'")
+        return self.name
+
+
+class Shard:
+    """A range of table data that dumps to a single file"""
+
+    def __init__(self, tag, condition, bytes, rows=None):
+        """Define a shard
+        :param tag: (str): File name tag that is unique within the table
+        :param condition: (str): WHERE condition that selects shard rows
+        :param bytes: (int): Estimated bytes on disk
+        :param rows: (int): Estimated rows or None if unknown
+        """
+        self.tag = tag
+        self.condition = condition
+        self.bytes = bytes
+        self.rows = rows
+
+
+def quote(value):
+    """Return value as a ClickHouse string literal"""
+    return "'{0}'".format(
+        str(value).replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def hide(value):
+    """Mask a value wherever statements are logged, including statements
+       that clickhouse_driver logs.  Use for credentials that a statement
+       must carry inline
+    :param value: (str): Value to mask
+    """
+    if value:
+        _secrets.add(str(value))
+        _secrets.add(quote(value)[1:-1])
+
+
+def mask(text):
+    """Return text with hidden values masked for logging"""
+    for secret in sorted(_secrets, key=len, reverse=True):
+        text = text.replace(secret, SECRET_MASK)
+    return text
+
+
+class _MaskFilter(logging.Filter):
+    """Masks hidden values in records of a logger"""
+
+    def filter(self, record):
+        if _secrets:
+            record.msg = mask(record.getMessage())
+            record.args = ()
+        return True
+
+
+# The driver logs each query at debug level.
+logging.getLogger('clickhouse_driver.connection').addFilter(_MaskFilter())
+
+
+def literal(value):
+    """Return a ClickHouse literal for a value read from a table or None if
+       the value has no simple literal"""
+    if isinstance(value, bool):
+        return str(int(value))
+    elif isinstance(value, (int, decimal.Decimal)):
+        return str(value)
+    elif isinstance(value, float):
+        return repr(value) if math.isfinite(value) else None
+    elif isinstance(value, (str, datetime.date, uuid.UUID)):
+        return quote(value)
+    elif isinstance(value, tuple):
+        values = [literal(v) for v in value]
+        if None in values:
+            return None
+        return "({0})".format(", ".join(values))
+    return None
+
+
+def sorting_keys(sorting_key):
+    """Return the expressions of a sorting key"""
+    keys = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(sorting_key):
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            keys.append(sorting_key[start:i].strip())
+            start = i + 1
+    keys.append(sorting_key[start:].strip())
+    return keys
+
+
+def key_ranges(key, boundaries):
+    """Return conditions that split rows at boundary values of a key.  Each
+       condition selects rows from one boundary up to the next, so together
+       they select every row once
+    :param key: (str): Key expression
+    :param boundaries: (list): Increasing literals of the key
+    """
+    conditions = []
+    lower = None
+    for upper in list(boundaries) + [None]:
+        if lower is None:
+            # Rows with a NULL key compare false and go in the first range.
+            condition = "({0} < {1} OR {0} IS NULL)".format(key, upper)
+        elif upper is None:
+            condition = "{0} >= {1}".format(key, lower)
+        else:
+            condition = "{0} >= {1} AND {0} < {2}".format(key, lower, upper)
+        conditions.append(condition)
+        lower = upper
+    return conditions
+
+
+def plan_shards(partitions, target_bytes, split=None):
+    """Group partitions into shards of roughly target_bytes each
+
+    Partitions larger than the target split into ranges of the sorting key
+    where split provides them and otherwise dump whole.  Consecutive
+    partitions smaller than the target coalesce into shared shards.  Shards
+    select rows by partition ID and key values, so merges and mutations
+    during the dump do not move rows between shards.
+    :param partitions: (list): PartitionData instances
+    :param target_bytes: (int): Target bytes on disk per shard
+    :param split: (function): Called with a large PartitionData and the
+                              number of shards it should split into.
+                              Returns a condition for each shard or None
+                              to dump the partition whole
+    :return: List of Shard instances
+    """
+    shards = []
+    small = []
+    small_bytes = 0
+    small_rows = 0
+
+    def flush_small():
+        if len(small) == 1:
+            shards.append(
+                Shard(small[0], "_partition_id = {0}".format(
+                    quote(small[0])), small_bytes, small_rows))
+        elif len(small) > 1:
+            shards.append(
+                Shard(
+                    "{0}-{1}".format(small[0], small[-1]),
+                    "_partition_id IN ({0})".format(", ".join(
+                        quote(p) for p in small)), small_bytes, small_rows))
+
+    for partition in sorted(partitions, key=lambda p: p.partition_id):
+        partition_id = partition.partition_id
+        if partition.bytes <= target_bytes:
+            if small_bytes + partition.bytes > target_bytes:
+                flush_small()
+                small, small_bytes, small_rows = [], 0, 0
+            small.append(partition_id)
+            small_bytes += partition.bytes
+            small_rows += partition.rows
+            continue
+
+        condition = "_partition_id = {0}".format(quote(partition_id))
+        count = -(-partition.bytes // target_bytes)
+        ranges = split(partition, count) if split is not None else None
+        if not ranges or len(ranges) == 1:
+            shards.append(
+                Shard(partition_id, condition, partition.bytes,
+                      partition.rows))
+            continue
+        for i, range_condition in enumerate(ranges):
+            shards.append(
+                Shard("{0}-{1}".format(partition_id, i),
+                      "{0} AND {1}".format(condition, range_condition),
+                      partition.bytes // len(ranges),
+                      partition.rows // len(ranges)))
+    flush_small()
+    return shards
+
+
+class ConnectionPool:
+    """Thread-safe bounded pool of driver clients.  Clients keep their
+       connections open between uses so that repeated queries do not pay
+       for TCP and TLS handshakes each time"""
+
+    def __init__(self,
+                 factory,
+                 max_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 check_interval=DEFAULT_CHECK_INTERVAL,
+                 clock=time.monotonic):
+        """Set up an empty pool
+        :param factory: Function that returns a new client
+        :param max_size: (int): Maximum clients in use or idle at once
+        :param idle_timeout: (float): Seconds before idle clients close
+        :param check_interval: (float): Seconds idle before a client is
+                                        pinged when it is reused
+        :param clock: Function that returns current time in seconds
+        """
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.clock = clock
+        self.created = 0
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Return a client, waiting if all clients are in use"""
+        expired = []
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Exception("Connection pool is closed")
+                expired.extend(self._evict_expired())
+                if self._idle:
+                    client, last_used = self._idle.pop()
+                    break
+                elif self._size < self.max_size:
+                    self._size += 1
+                    client, last_used = None, None
+                    break
+                self._cond.wait()
+        self._disconnect_all(expired)
+
+        if client is not None:
+            idle_time = self.clock() - last_used
+            if idle_time < self.check_interval or self._is_healthy(client):
+                return client
+            logger.info("Replacing unhealthy connection")
+            self._disconnect_all([client])
+        try:
+            client = self.factory()
+        except Exception:
+            self._forget()
+            raise
+        with self._cond:
+            self.created += 1
+        return client
+
+    def release(self, client, broken=False):
+        """Return a client to the pool
+        :param client: Client from acquire()
+        :param broken: (bool): If True close the client instead of reusing it
+        """
+        with self._cond:
+            if broken or self._closed:
+                discard = [client]
+                self._size -= 1
+            else:
+                self._idle.append((client, self.clock()))
+                discard = self._evict_expired()
+            self._cond.notify()
+        self._disconnect_all(discard)
+
+    def connection(self):
+        """Return context manager that holds a client for a with clause"""
+        return ClientWrapper(self)
+
+    def close(self):
+        """Close idle clients.  Clients in use close when released"""
+        with self._cond:
+            self._closed = True
+            discard = [client for client, _ in self._idle]
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        self._disconnect_all(discard)
+
+    def _evict_expired(self):
+        """Remove clients idle longer than the timeout.  Call with lock held
+        :return: List of removed clients to disconnect outside the lock
+        """
+        expired = []
+        now = self.clock()
+        while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+        self._size -= len(expired)
+        return expired
+
+    def _forget(self):
+        """Give up the slot of a client that could not be created"""
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, client):
+        """Ping the server.  Clients that were never connected are healthy
+           since they connect on next use"""
+        try:
+            return client.connection.ping() is not False
+        except Exception as e:
+            logger.debug("Connection ping failed: {0}".format(e))
+            return False
+
+    def _disconnect_all(self, clients):
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception as e:
+                logger.debug("Disconnect failed: {0}".format(e))
 
 
 class ClientWrapper:
-    """Context manager to allow use of ClickHouse connections in with clause"""
+    """Context manager to allow use of pooled ClickHouse connections in with
+       clause"""
 
-    def __init__(self, *args, **kwargs):
-        self.client = Client(*args, **kwargs)
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = None
 
     def __enter__(self):
+        self.client = self.pool.acquire()
         return self.client
 
-    def __exit__(self, *args):
-        """Disconnect from server to up free socket"""
-        self.client.disconnect()
+    def __exit__(self, exc_type, *args):
+        """Return connection to the pool.  Connections that raised errors
+        are closed, since the session might be left in an unknown state"""
+        self.pool.release(self.client, broken=exc_type is not None)
+        self.client = None
 
 
 class ClickHouse:
@@ -55,8 +435,10 @@ class ClickHouse:
                  verify=None,
                  user=None,
                  password=None,
-                 database=None):
-        """Set up the connector.  Arguments have no defaults
+                 database=None,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """Set up the connector.  Connection arguments have no defaults
         :param host: (str): ClickHouse server host
         :param port: (int): ClickHouse server port
         :param secure: (int): If True use secure connection
@@ -64,6 +446,8 @@ class ClickHouse:
         :param user: (str): ClickHouse user
         :param password: (str): ClickHouse password
         :param database: (str): Default database
+        :param pool_size: (int): Maximum connections to hold open
+        :param idle_timeout: (float): Seconds before unused connections close
         """
         self.host = host
         self.port = port
@@ -72,53 +456,127 @@ class ClickHouse:
         self.user = user
         self.password = password
         self.database = database
+        self.pool = ConnectionPool(self._new_client,
+                                   max_size=pool_size,
+                                   idle_timeout=idle_timeout)
+
+    def close(self):
+        """Close pooled connections"""
+        self.pool.close()
 
     def fetch_tables(self, table_regex=None):
-        """Fetch table metadata
+        """Fetch table metadata including CREATE TABLE statements and row
+           totals in one query on system.tables.  Totals missing from
+           system.tables come from a second query on system.parts
         :param table_regex: (str): Regex to select tables
         :return: A list of Table instances
         """
         # Connect to database and fetch tables.
         logger.info("Fetch tables from host: {0} database: {1}".format(
             self.host, self.database))
-        with self._get_wrapped_connection() as client:
-            table_query = ("select name, partition_key, sorting_key "
-                           "from system.tables where database='{0}' "
-                           "and engine not like 'Materialized%' "
-                           "and name not like '.%'")
-            result, types = client.execute(table_query.format(self.database),
-                                           with_column_types=True)
-            tables = []
-            for row in result:
-                name = row[0]
-                if table_regex is not None:
-                    if not re.search(table_regex, name):
-                        continue
-                partition_key = row[1]
-                sorting_key = row[2]
-                table = TableData(self.database, name, partition_key,
-                                  sorting_key)
-                tables.append(table)
-
-        # Add CREATE TABLE definitions.
-        with self._get_wrapped_connection() as client:
-            for table in tables:
-                # Fetch CREATE TABLE definition.
-                show_create_query = "show create table {0}"
-                result = client.execute(show_create_query.format(table.name))
-                for row in result:
-                    # Remove the database name.
-                    pattern = re.compile('CREATE TABLE {0}\\.'.format(
-                        self.database))
-                    table.create_table = pattern.sub('CREATE TABLE ', row[0])
+        table_query = ("SELECT name, partition_key, sorting_key, "
+                       "create_table_query{0} "
+                       "FROM system.tables WHERE database={1} "
+                       "AND engine NOT LIKE 'Materialized%' "
+                       "AND name NOT LIKE '.%'")
+        try:
+            with self._get_wrapped_connection() as client:
+                result = client.execute(
+                    table_query.format(", total_rows, total_bytes",
+                                       quote(self.database)))
+        except ServerException as e:
+            # Servers before 19.15 do not have total_rows and total_bytes.
+            logger.info("Unable to read table totals: {0}".format(e))
+            with self._get_wrapped_connection() as client:
+                result = [
+                    row + (None, None) for row in client.execute(
+                        table_query.format("", quote(self.database)))
+                ]
+
+        # Remove the database name from CREATE TABLE.
+        pattern = re.compile('CREATE TABLE {0}\\.'.format(
+            re.escape(self.database)))
+        tables = []
+        for row in result:
+            name = row[0]
+            if table_regex is not None:
+                if not re.search(table_regex, name):
+                    continue
+            # Tables without keys show empty strings.
+            partition_key = row[1] or None
+            sorting_key = row[2] or None
+            table = TableData(self.database, name, partition_key,
+                              sorting_key)
+            table.create_table = pattern.sub('CREATE TABLE ', row[3])
+            table.total_rows = row[4]
+            table.total_bytes = row[5]
+            tables.append(table)
 
+        if any(table.total_rows is None for table in tables):
+            part_totals = self.fetch_part_totals()
+            for table in tables:
+                if table.total_rows is None and table.name in part_totals:
+                    table.total_rows, table.total_bytes = part_totals[
+                        table.name]
         return tables
 
+    def fetch_part_totals(self):
+        """Return rows and bytes of active parts for tables in the database
+        :return: Dictionary of tuple(rows, bytes) keyed by table name
+        """
+        with self._get_wrapped_connection() as client:
+            sql = ("SELECT table, sum(rows), sum(bytes_on_disk) "
+                   "FROM system.parts WHERE active AND database={0} "
+                   "GROUP BY table").format(quote(self.database))
+            result = client.execute(sql)
+            return {row[0]: (row[1], row[2]) for row in result}
+
+    def fetch_server_resources(self):
+        """Return memory and CPU available to queries.  Container limits
+           apply if lower than host totals
+        :return: Dictionary with memory and max_memory_usage in bytes and
+                 cores, each None if unknown
+        """
+        with self._get_wrapped_connection() as client:
+            metrics = dict(
+                client.execute(
+                    "SELECT metric, value FROM system.asynchronous_metrics "
+                    "WHERE metric IN ('OSMemoryTotal', 'CGroupMemoryTotal', "
+                    "'CGroupMaxCPU', 'NumberOfLogicalCores')"))
+            settings = dict(
+                client.execute(
+                    "SELECT name, value FROM system.settings "
+                    "WHERE name IN ('max_threads', 'max_memory_usage')"))
+        memory = [
+            int(metrics[m]) for m in ('OSMemoryTotal', 'CGroupMemoryTotal')
+            if metrics.get(m)
+        ]
+        # max_threads is 'auto(N)' with N cores unless set explicitly.
+        cores = re.search(r'\d+', settings.get('max_threads', ''))
+        if cores is not None:
+            cores = int(cores.group(0))
+        else:
+            cores = [
+                int(metrics[m])
+                for m in ('CGroupMaxCPU', 'NumberOfLogicalCores')
+                if metrics.get(m)
+            ]
+            cores = min(cores) if cores else None
+        max_memory_usage = int(settings.get('max_memory_usage') or 0)
+        return {
+            'memory': min(memory) if memory else None,
+            'cores': cores,
+            'max_memory_usage': max_memory_usage or None
+        }
+
     def fetch_row_count(self, table):
-        """Return number of rows in table
+        """Return number of rows in table.  Uses totals from fetch_tables if
+           available, otherwise counts rows
         :param table: (TableData): TableData instance with table data
         :return: Count of row
         """
+        if table.total_rows is not None:
+            return table.total_rows
         with self._get_wrapped_connection() as client:
             sql = "SELECT count(*) FROM {0}.{1}".format(
                 table.database, table.name)
@@ -129,64 +587,333 @@ class ClickHouse:
         """Return partition keys and SQL statement to fetch them
         :param table: (TableData): TableData instance with table data
         :param format: (str): Output format
-        :param collapse_partitions: If True merge small tables to one partition
         :return: Array of tuple(partition_key, sql_statement). If table
-                 is collapsed or has no partitions the partition key will
-                 be None
+                 has no partitions the partition key will be None
+        """
+        partition_list = []
+        for partition, sql in self.fetch_partition_selects(table, format):
+            if partition is None:
+                partition_list.append((None, sql))
+            elif re.match(r'^-?\d+$', partition.name):
+                # Numeric keys are numbers as when read from the table.
+                partition_list.append((int(partition.name), sql))
+            else:
+                partition_list.append((partition.key(), sql))
+        return partition_list
+
+    def fetch_partition_selects(self, table, format="CSVWithNames",
+                                partitions=None):
+        """Return partitions and SQL statements to fetch them.  Partitions
+           are listed from system.parts and selected by _partition_id, so
+           the partition expression is not evaluated over table rows
+        :param table: (TableData): TableData instance with table data
+        :param format: (str): Output format
+        :param partitions: (list): PartitionData of the table if already
+                                   fetched
+        :return: Array of tuple(PartitionData, sql_statement). If the table
+                 has no partitions the partition will be None
         """
         partition_list = []
+        select_sql = "SELECT * FROM {0}.{1}".format(table.database,
+                                                    table.name)
+        order_sql = " FORMAT {0}".format(format)
+        if table.sorting_key is not None:
+            order_sql = " ORDER BY {0}".format(table.sorting_key) + order_sql
 
         # If there is no partition key, return a select on all data including
         # a sort order if key is available.
         if table.partition_key is None:
+            partition_list.append((None, select_sql + order_sql))
+        else:
+            if partitions is None:
+                partitions = self.fetch_partition_data(table)
+            for partition in partitions:
+                sql = "{0} WHERE _partition_id = {1}{2}".format(
+                    select_sql, quote(partition.partition_id), order_sql)
+                partition_list.append((partition, sql))
+        return partition_list
+
+    def fetch_partition_data(self, table):
+        """Return partitions of a table with totals of their active parts
+        :param table: (TableData): TableData instance with table data
+        :return: List of PartitionData instances ordered by partition ID
+        """
+        return self.fetch_all_partition_data([table]).get(table.name, [])
+
+    def fetch_all_partition_data(self, tables):
+        """Return partitions of tables in one database with totals and
+           block numbers of their active parts in one query on system.parts
+        :param tables: (list): TableData instances with table data
+        :return: Dictionary of lists of PartitionData instances ordered by
+                 partition ID keyed by table name.  Tables without parts
+                 are missing
+        """
+        if not tables:
+            return {}
+        partitions = {}
+        with self._get_wrapped_connection() as client:
+            # Mutated parts have a data version above their first block.
+            sql = ("SELECT table, partition, partition_id, sum(rows), "
+                   "sum(bytes_on_disk), min(min_block_number), "
+                   "max(max_block_number), max(if(data_version > "
+                   "min_block_number, data_version, 0)) FROM system.parts "
+                   "WHERE active AND database={0} AND table IN ({1}) "
+                   "GROUP BY table, partition, partition_id "
+                   "ORDER BY table, partition_id").format(
+                       quote(tables[0].database),
+                       ", ".join(quote(t.name) for t in tables))
+            for row in client.execute(sql):
+                partitions.setdefault(row[0], []).append(
+                    PartitionData(*row[1:]))
+        return partitions
+
+    def fetch_shards(self, table, target_bytes, format="CSVWithNames",
+                     partitions=None):
+        """Return shards of a table and SQL statements to fetch them
+        :param table: (TableData): TableData instance with table data
+        :param target_bytes: (int): Target bytes on disk per shard
+        :param format: (str): Output format
+        :param partitions: (list): PartitionData of the table if already
+                                   fetched
+        :return: Array of tuple(Shard, sql_statement).  Tables without parts
+                 return a single shard for all data
+        """
+        if partitions is None:
+            partitions = self.fetch_partition_data(table)
+        keys = []
+        if table.sorting_key is not None:
+            # Split on the first sorting key column, or on the whole key if
+            # the column has too few distinct values.
+            columns = sorting_keys(table.sorting_key)
+            keys.append(columns[0])
+            if len(columns) > 1:
+                keys.append("({0})".format(", ".join(columns)))
+
+        def boundaries_of(partition, key, count):
+            boundaries = []
+            for value in self.fetch_key_values(table, key,
+                                               partition.partition_id,
+                                               count):
+                value = literal(value)
+                if value is None:
+                    return None
+                elif value not in boundaries[-1:]:
+                    boundaries.append(value)
+            return boundaries
+
+        def split(partition, count):
+            key, boundaries = None, []
+            for next_key in keys:
+                next_boundaries = boundaries_of(partition, next_key, count)
+                if next_boundaries is None:
+                    break
+                elif len(next_boundaries) > len(boundaries):
+                    key, boundaries = next_key, next_boundaries
+                if len(boundaries) == count - 1:
+                    break
+            if not boundaries:
+                logger.info(
+                    "Sorting key has too few values to split, dumping whole: "
+                    "table={0}, partition={1}".format(
+                        table.name, partition.partition_id))
+                return None
+            elif len(boundaries) < count - 1:
+                logger.info(
+                    "Sorting key has few values, splitting into {0} shards "
+                    "instead of {1}: table={2}, partition={3}".format(
+                        len(boundaries) + 1, count, table.name,
+                        partition.partition_id))
+            return key_ranges(key, boundaries)
+
+        if len(partitions) == 0:
+            shards = [
+                Shard("all", None, table.total_bytes or 0, table.total_rows)
+            ]
+        else:
+            shards = plan_shards(partitions, target_bytes,
+                                 split if keys else None)
+
+        shard_list = []
+        for shard in shards:
             sql = "SELECT * FROM {0}.{1}".format(table.database, table.name)
-            if table.sorting_key is not None:
+            if shard.condition is not None:
+                sql += " WHERE {0}".format(shard.condition)
+            if table.sorting_key:
                 sql += " ORDER BY {0}".format(table.sorting_key)
             sql += " FORMAT {0}".format(format)
-            partition_list.append((None, sql))
-        else:
-            # Fetch keys and generate the type format. String types require
-            # quotes.
-            with self._get_wrapped_connection() as client:
-                partition_sql = ("SELECT {0} AS key FROM {1}.{2}"
-                                 " GROUP BY key ORDER BY key").format(
-                                     table.partition_key, table.database,
-                                     table.name)
-                partition_keys, partition_key_type = self._select_array(
-                    client, partition_sql)
-
-            if partition_key_type == "String":
-                key_fmt = "'{0}'"
-            else:
-                key_fmt = "{0}"
+            shard_list.append((shard, sql))
+        return shard_list
 
-            # Construct select template for partitioned data.
-            partition_sql = "SELECT * FROM {0}.{1}".format(
+    def fetch_key_values(self, table, key, partition_id, count):
+        """Return values of a key expression that split a partition into
+           count ranges of about the same rows.  Values come from a sample
+           of the partition read in one pass
+        :param table: (TableData): TableData instance with table data
+        :param key: (str): Key expression, usually in the sorting key
+        :param partition_id: (str): Partition ID
+        :param count: (int): Number of ranges
+        :return: List of up to count - 1 values in key order, without the
+                 smallest value sampled
+        """
+        with self._get_wrapped_connection() as client:
+            sql = ("SELECT arraySort(groupArraySample({0})({1})) "
+                   "FROM {2}.{3} WHERE _partition_id = {4}").format(
+                       KEY_SAMPLE_ROWS, key, table.database, table.name,
+                       quote(partition_id))
+            result = client.execute(sql)
+        sample = result[0][0] if result else []
+        # Ranges below the smallest value would be empty.
+        return [sample[len(sample) * i // count] for i in range(1, count)
+                if sample[len(sample) * i // count] != sample[0]]
+
+    def count_rows(self, table):
+        """Count rows in a table now, ignoring totals from fetch_tables
+        :param table: (TableData): TableData instance with table data
+        :return: Count of rows
+        """
+        with self._get_wrapped_connection() as client:
+            sql = "SELECT count(*) FROM {0}.{1}".format(
                 table.database, table.name)
-            partition_sql += " WHERE {0} = {1}".format(table.partition_key,
-                                                       key_fmt)
-            if table.sorting_key is not None:
-                partition_sql += " ORDER BY {0}".format(table.sorting_key)
-            partition_sql += " FORMAT {0}".format(format)
-
-            # Generate SQL statements.
-            for key in partition_keys:
-                if partition_key_type == "String":
-                    key = key.replace("'", "\\'")
-                partition_list.append((key, partition_sql.format(key)))
+            count, _ = self._select_scalar(client, sql)
+            return count
 
-        return partition_list
+    def fetch_query_rows(self, query_ids, timeout=QUERY_LOG_TIMEOUT):
+        """Return rows of finished queries from system.query_log.  Logs are
+           flushed if the user may, and entries are awaited until timeout
+        :param query_ids: (list): IDs of queries that have finished
+        :param timeout: (float): Seconds to wait for log entries
+        :return: Dictionary of tuple(written_rows, result_rows) keyed by
+                 query ID.  Queries missing from the log are left out
+        """
+        rows = {}
+        pending = set(query_ids)
+        deadline = time.monotonic() + timeout
+        with self._get_wrapped_connection() as client:
+            enabled = client.execute(
+                "SELECT value FROM system.settings "
+                "WHERE name = 'log_queries'")
+            if not pending or (enabled and enabled[0][0] == '0'):
+                return rows
+            try:
+                client.execute("SYSTEM FLUSH LOGS")
+            except ServerException as e:
+                logger.info("Unable to flush logs: {0}".format(e))
+            while True:
+                result = client.execute(
+                    "SELECT query_id, written_rows, result_rows "
+                    "FROM system.query_log WHERE type = 'QueryFinish' "
+                    "AND query_id IN ({0})".format(", ".join(
+                        quote(query_id) for query_id in sorted(pending))))
+                for query_id, written_rows, result_rows in result:
+                    rows[query_id] = (written_rows, result_rows)
+                    pending.discard(query_id)
+                if not pending or time.monotonic() >= deadline:
+                    return rows
+                time.sleep(QUERY_LOG_POLL_INTERVAL)
+
+    def fetch_engine(self, table_name):
+        """Return the engine of a table
+        :param table_name: (str): Table name in the default database
+        :return: Tuple of (engine, engine_full) from system.tables or None if
+                 the table does not exist
+        """
+        with self._get_wrapped_connection() as client:
+            result = client.execute(
+                "SELECT engine, engine_full FROM system.tables WHERE "
+                "database={0} AND name={1}".format(quote(self.database),
+                                                   quote(table_name)))
+            return result[0] if result else None
+
+    def fetch_table_names(self, prefix):
+        """Return names of tables in the default database that start with
+           a prefix
+        :param prefix: (str): Name prefix
+        """
+        with self._get_wrapped_connection() as client:
+            result = client.execute(
+                "SELECT name FROM system.tables WHERE database={0} AND "
+                "startsWith(name, {1})".format(quote(self.database),
+                                               quote(prefix)))
+            return [row[0] for row in result]
+
+    def fetch_partition_ids(self, table_names):
+        """Return partition IDs with active parts in tables
+        :param table_names: (list): Table names in the default database
+        :return: List of tuple(table name, partition ID)
+        """
+        with self._get_wrapped_connection() as client:
+            result = client.execute(
+                "SELECT DISTINCT table, partition_id FROM system.parts WHERE "
+                "active AND database={0} AND table IN ({1})".format(
+                    quote(self.database),
+                    ", ".join(quote(name) for name in table_names)))
+            return [(row[0], row[1]) for row in result]
+
+    def fetch_cluster(self, cluster):
+        """Return replicas of a cluster configured on the server
+        :param cluster: (str): Cluster name in system.clusters
+        :return: List of tuple(shard_num, shard_weight, host_name, port)
+                 ordered by shard and replica
+        """
+        with self._get_wrapped_connection() as client:
+            return client.execute(
+                "SELECT shard_num, shard_weight, host_name, port "
+                "FROM system.clusters WHERE cluster = {0} "
+                "ORDER BY shard_num, replica_num".format(quote(cluster)))
+
+    def fetch_columns(self, table_name):
+        """Return column names and types of a table
+        :param table_name: (str): Table name in the default database
+        :return: List of tuple(name, type)
+        """
+        with self._get_wrapped_connection() as client:
+            result = client.execute("DESCRIBE TABLE {0}".format(table_name))
+            return [(row[0], row[1]) for row in result]
+
+    def insert_blocks(self, table_name, blocks, settings=None):
+        """Insert columnar blocks of data using the native protocol
+        :param table_name: (str): Table name in the default database
+        :param blocks: Iterable of tuple(column_names, list of column value
+                       lists)
+        :param settings: (dict): Query settings for the inserts
+        :return: Number of rows inserted
+        """
+        rows = 0
+        with self._get_wrapped_connection() as client:
+            for column_names, columns in blocks:
+                sql = "INSERT INTO {0} ({1}) VALUES".format(
+                    table_name, ", ".join(column_names))
+                rows += client.execute(sql,
+                                       columns,
+                                       columnar=True,
+                                       settings=settings)
+        return rows
+
+    def insert_select(self, sql):
+        """Run an INSERT SELECT on the server
+        :return: Number of rows written if the server reported progress
+        """
+        with self._get_wrapped_connection() as client:
+            client.execute(sql)
+            last_query = getattr(client, 'last_query', None)
+            if last_query is None:
+                return None
+            return last_query.progress.written_rows
 
     def execute(self, sql, verbose=False, dry_run=False):
         """Execute a SQL query"""
         with self._get_wrapped_connection() as client:
             if verbose:
-                logger.debug("SQL: {0}".format(sql))
+                logger.debug("SQL: {0}".format(mask(sql)))
             if not dry_run:
                 return client.execute(sql)
 
     def _get_wrapped_connection(self):
-        """Create connection using available non-null arguments"""
+        """Return pooled connection for use in a with clause"""
+        return self.pool.connection()
+
+    def _new_client(self):
+        """Create client using available non-null arguments"""
         kwargs = {}
         if self.host:
             kwargs['host'] = self.host
@@ -203,20 +930,7 @@ class ClickHouse:
             kwargs['password'] = self.password
         if self.database:
             kwargs['database'] = self.database
-        return ClientWrapper(**kwargs)
-
-    def _select_array(self, conn, sql):
-        """Return select on a single column as an array
-        :param table: (TableData): TableData instance with table data
-        :param sql: (str): Query
-        :return: Tuple with two elements: array of values and SQL type
-        """
-        result, types = conn.execute(sql, with_column_types=True)
-        array = []
-        for row in result:
-            array.append(row[0])
-        # Type value is 1st value in list of tuples, 2nd value in the tuple.
-        return array, types[0][1]
+        return Client(**kwargs)
 
     def _select_scalar(self, conn, sql):
         """Return single value from select
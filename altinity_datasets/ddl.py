@@ -0,0 +1,267 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import concurrent.futures
+import glob
+import logging
+import os
+import re
+import threading
+"""Runs the DDL scripts of a dataset in dependency order.  Each script
+   creates one table, view or dictionary.  Scripts that reference objects
+   created by other scripts run after them.  Independent scripts run at
+   the same time, and loads can wait for just the tables they need"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+_NAME = r'((?:`[^`]+`|"[^"]+"|[\w$]+)(?:\.(?:`[^`]+`|"[^"]+"|[\w$]+))?)'
+_CREATE = re.compile(
+    r'^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMPORARY\s+)?'
+    r'(TABLE|(?:MATERIALIZED\s+|LIVE\s+|WINDOW\s+)?VIEW|DICTIONARY)\s+'
+    r'(?:IF\s+NOT\s+EXISTS\s+)?' + _NAME, re.IGNORECASE)
+_REFERENCES = [
+    # Sources of selects and joins, views' TO tables and CREATE TABLE AS.
+    re.compile(r'\b(?:FROM|JOIN|TO|AS)\s+' + _NAME, re.IGNORECASE),
+    re.compile(r"\bDistributed\s*\(\s*[^,]+,\s*[^,]+,\s*'?([\w$.`]+)'?",
+               re.IGNORECASE),
+    # Dictionary sources.
+    re.compile(r"\bTABLE\s+'([^']+)'", re.IGNORECASE),
+    re.compile(r"\b(?:dictGet\w*|dictHas|joinGet\w*)\s*\(\s*'([^']+)'",
+               re.IGNORECASE),
+]
+
+# Keywords that follow AS in views.
+_KEYWORDS = {'SELECT', 'WITH'}
+
+# Comments and white space before a statement.
+_LEADING = re.compile(r'(?:\s+|--[^\n]*|/\*.*?\*/)*', re.DOTALL)
+_ON_CLUSTER = re.compile(r'\s+ON\s+CLUSTER\b', re.IGNORECASE)
+
+
+def _unqualified(name):
+    """Return name without database or quotes"""
+    return name.split('.')[-1].strip('`"')
+
+
+class DdlStatement:
+    """A DDL script with the object it creates and the names it uses"""
+
+    def __init__(self, path, sql):
+        """Parse a script
+        :param path: (str): Script file
+        :param sql: (str): Script text
+        """
+        self.path = path
+        self.sql = sql
+        text = _COMMENTS.sub(' ', sql)
+        create = _CREATE.match(text)
+        if create is None:
+            self.kind = None
+            self.name = None
+        else:
+            self.kind = " ".join(create.group(1).upper().split())
+            self.name = _unqualified(create.group(2))
+            text = text[create.end():]
+        self.references = set()
+        for pattern in _REFERENCES:
+            for match in pattern.finditer(text):
+                if match.group(1).upper() not in _KEYWORDS:
+                    self.references.add(_unqualified(match.group(1)))
+        self.references.discard(self.name)
+        self.depends = []
+
+    def __repr__(self):
+        return "DdlStatement({0})".format(self.path)
+
+
+def on_cluster(sql, cluster):
+    """Return a CREATE statement that runs on all hosts of a cluster.
+       Statements that create nothing recognizable or already name a
+       cluster are returned unchanged
+    :param sql: (str): DDL statement
+    :param cluster: (str): Cluster name from system.clusters
+    """
+    start = _LEADING.match(sql).end()
+    create = _CREATE.match(sql[start:])
+    if create is None:
+        return sql
+    end = start + create.end()
+    if _ON_CLUSTER.match(sql, end):
+        return sql
+    return "{0} ON CLUSTER `{1}`{2}".format(sql[:end], cluster, sql[end:])
+
+
+def read_statements(dataset_path):
+    """Read DDL scripts of a dataset and link each to the scripts that
+       create objects it references.  Scripts that create nothing
+       recognizable depend on all others
+    :param dataset_path: (str): Dataset directory
+    :return: List of DdlStatement in file name order
+    """
+    statements = []
+    for sql_file in sorted(glob.glob(os.path.join(dataset_path, 'ddl',
+                                                  '*'))):
+        with open(sql_file, 'r') as f:
+            statements.append(DdlStatement(sql_file, f.read()))
+    return link(statements)
+
+
+def link(statements):
+    """Fill in depends of each statement
+    :return: statements
+    """
+    creators = {s.name: s for s in statements if s.name is not None}
+    for statement in statements:
+        if statement.name is None:
+            statement.depends = list(creators.values())
+        else:
+            statement.depends = [
+                creators[name] for name in sorted(statement.references)
+                if name in creators
+            ]
+    return statements
+
+
+class DdlRunner:
+    """Runs DDL statements on a thread pool.  A statement starts once the
+       statements it depends on have succeeded.  After a failure no new
+       statements start and waits raise the error"""
+
+    def __init__(self,
+                 ch,
+                 statements,
+                 parallel,
+                 dry_run=False,
+                 progress_reporter=None):
+        """Set up a runner
+        :param ch: (ClickHouse): Connector for the database
+        :param statements: (list): Linked DdlStatement instances
+        :param parallel: (int): Maximum statements at once
+        :param dry_run: (boolean): If True only log statements
+        :param progress_reporter: (function): Called with progress messages
+        """
+        self.ch = ch
+        self.dry_run = dry_run
+        self.progress_reporter = progress_reporter
+        self._statements = {s.name: s for s in statements if s.name}
+        self._pending = list(statements)
+        self._running = set()
+        self._done = set()
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, parallel))
+
+    def start(self):
+        """Start statements that have no dependencies
+        :return: self
+        """
+        with self._condition:
+            self._schedule()
+        return self
+
+    def close(self):
+        """Wait for running statements and stop the thread pool.  Pending
+           statements do not start and waits for them raise"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._pool.shutdown(wait=True)
+
+    def wait(self, name=None):
+        """Wait until the statement that creates an object has succeeded.
+           Objects that no statement creates wait for all statements
+        :param name: (str): Table name or None to wait for all statements
+        """
+        statement = self._statements.get(name)
+        with self._condition:
+            while not self._finished(statement):
+                self._check()
+                self._condition.wait()
+
+    def ready(self, items, key):
+        """Yield items as the objects they need become available
+        :param items: (iterable): Items in preferred order
+        :param key: (function): Returns the table name of an item
+        """
+        pending = list(items)
+        while pending:
+            with self._condition:
+                while True:
+                    self._check()
+                    ready = [
+                        item for item in pending
+                        if self._finished(self._statements.get(key(item)))
+                    ]
+                    if ready:
+                        break
+                    self._condition.wait()
+            for item in ready:
+                pending.remove(item)
+                yield item
+
+    def _check(self):
+        """Raise if statements cannot finish.  Called with the condition
+           held"""
+        if self._error is not None:
+            raise self._error
+        elif self._closed:
+            raise Exception("DDL stopped before all statements ran")
+
+    def _finished(self, statement):
+        if statement is None:
+            return not self._pending and not self._running
+        return statement in self._done
+
+    def _schedule(self):
+        """Start statements whose dependencies are done.  Called with the
+           condition held"""
+        if self._error is not None or self._closed:
+            return
+        ready = [
+            s for s in self._pending
+            if all(d in self._done for d in s.depends)
+        ]
+        if not ready and not self._running and self._pending:
+            # References found by parsing can be wrong.  Break cycles by
+            # running the first remaining script as the old loader did.
+            ready = [self._pending[0]]
+            logger.warning(
+                "Circular DDL references, running in file order: {0}".format(
+                    ready[0].path))
+        for statement in ready:
+            self._pending.remove(statement)
+            self._running.add(statement)
+            self._pool.submit(self._execute, statement)
+
+    def _execute(self, statement):
+        message = "Executing DDL: {0}".format(statement.path)
+        logger.info(message)
+        if self.progress_reporter is not None:
+            self.progress_reporter(message)
+        try:
+            self.ch.execute(statement.sql, dry_run=self.dry_run)
+        except Exception as e:
+            logger.error("DDL failed: {0}: {1}".format(statement.path, e))
+            with self._condition:
+                self._running.discard(statement)
+                if self._error is None:
+                    self._error = e
+                self._condition.notify_all()
+            return
+        with self._condition:
+            self._running.discard(statement)
+            self._done.add(statement)
+            self._schedule()
+            self._condition.notify_all()
@@ -0,0 +1,154 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import logging
+import os
+import re
+import shutil
+import threading
+
+from altinity_datasets import catalog
+from altinity_datasets import splits
+
+import yaml
+"""Fingerprints of dumped partitions kept in the dataset manifest.  An
+   incremental dump into the same repo skips partitions whose fingerprint
+   and file are unchanged and deletes files of partitions that are gone"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Manifest key of partition records.
+MANIFEST_KEY = 'partitions'
+
+
+class DumpState:
+    """Partition records of a dataset keyed by table and partition ID.  Each
+       record has the data file name and the fingerprint of the partition
+       when it was dumped"""
+
+    def __init__(self, dataset_path, dry_run=False):
+        """Read partition records from the manifest of a dataset
+        :param dataset_path: (str): Dataset directory with manifest.yaml
+        :param dry_run: (boolean): If True do not delete files or write the
+                                   manifest
+        """
+        self.dataset_path = dataset_path
+        self.manifest_path = os.path.join(dataset_path, 'manifest.yaml')
+        self.dry_run = dry_run
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = catalog.load_yaml(f) or {}
+        self.partitions = self.manifest.get(MANIFEST_KEY) or {}
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def unchanged(self, table, partition_id, fingerprint, file_path):
+        """Return True if a partition was dumped to the same file with the
+           same fingerprint and the file still exists.  Partitions without
+           a fingerprint always change"""
+        record = self.partitions.get(table, {}).get(partition_id)
+        if fingerprint is None or record is None:
+            return False
+        elif record.get('fingerprint') != fingerprint:
+            return False
+        elif record.get('file') != os.path.basename(file_path):
+            return False
+        return os.path.exists(file_path)
+
+    def plan(self, table, partition_id, fingerprint, file_path, rows=None):
+        """Drop the record of a partition that will be dumped and record it
+           again when the dump succeeds.  A file of another name from an
+           earlier dump is deleted
+        :param rows: (int): Rows of the partition when it was fingerprinted
+        """
+        record = self.partitions.get(table, {}).pop(partition_id, None)
+        if record is not None and record.get('file') != os.path.basename(
+                file_path):
+            self._delete(table, record['file'])
+        self.pending[file_path] = (table, partition_id, fingerprint, rows)
+
+    def record(self, file_path, rows):
+        """Record a partition after its file was dumped, if the rows dumped
+           match the rows of its fingerprint.  A file with other rows may be
+           truncated, so the partition dumps again next time
+        :param rows: (int): Rows dumped according to the query log
+        :return: True if the partition was recorded
+        """
+        with self._lock:
+            table, partition_id, fingerprint, expected = self.pending.pop(
+                file_path)
+            if expected is None or rows != expected:
+                logger.warning(
+                    "Not recording partition, rows dumped do not match: "
+                    "table={0}, partition={1}, dumped={2}, expected={3}"
+                    .format(table, partition_id, rows, expected))
+                return False
+            self.partitions.setdefault(table, {})[partition_id] = {
+                'file': os.path.basename(file_path),
+                'fingerprint': fingerprint
+            }
+        return True
+
+    def remove_partitions(self, table, partition_ids):
+        """Delete files and records of a table's partitions other than
+           partition_ids"""
+        records = self.partitions.get(table, {})
+        for partition_id in sorted(set(records) - set(partition_ids)):
+            logger.info("Removing dropped partition: table={0}, "
+                        "partition={1}".format(table, partition_id))
+            self._delete(table, records.pop(partition_id)['file'])
+
+    def remove_tables(self, table_names, table_regex=None):
+        """Delete data, DDL and records of tables that match table_regex
+           but are not in table_names"""
+        for table in sorted(set(self.partitions) - set(table_names)):
+            if table_regex is not None and not re.search(table_regex, table):
+                continue
+            logger.info("Removing dropped table: {0}".format(table))
+            self.remove_partitions(table, [])
+            del self.partitions[table]
+            for path in (os.path.join(self.dataset_path, 'ddl',
+                                      table + '.sql'),
+                         os.path.join(self.dataset_path, 'data', table)):
+                self._remove(path)
+
+    def forget(self, table):
+        """Drop records of a table whose files are not tracked"""
+        self.partitions.pop(table, None)
+
+    def save(self):
+        """Write partition records to the manifest"""
+        if self.dry_run:
+            return
+        with self._lock:
+            self.manifest[MANIFEST_KEY] = {
+                table: records
+                for table, records in self.partitions.items() if records
+            }
+            with open(self.manifest_path, 'w') as f:
+                yaml.dump(self.manifest, f)
+
+    def _delete(self, table, file_name):
+        """Delete a data file and its frame index"""
+        path = os.path.join(self.dataset_path, 'data', table, file_name)
+        self._remove(path)
+        self._remove(path + splits.INDEX_SUFFIX)
+
+    def _remove(self, path):
+        if self.dry_run or not os.path.exists(path):
+            return
+        logger.info("Deleting: {0}".format(path))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
@@ -0,0 +1,227 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import bz2
+import logging
+import lzma
+import os
+import zlib
+"""Names and file extensions of data formats and compression codecs used
+   in dataset data directories.  Data files are classified by their
+   contents where magic bytes allow and by extension otherwise"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# ClickHouse formats for data files keyed by file extension.
+FORMATS = {
+    'csv': 'CSVWithNames',
+    'native': 'Native',
+    'parquet': 'Parquet',
+    'orc': 'ORC',
+    'tsv': 'TSVWithNames',
+    'ndjson': 'JSONEachRow',
+    'jsonl': 'JSONEachRow',
+    'arrow': 'Arrow',
+    'avro': 'Avro',
+}
+
+# Compression codecs keyed by file extension.
+COMPRESSIONS = {
+    'gz': 'gzip',
+    'zst': 'zstd',
+    'lz4': 'lz4',
+    'xz': 'xz',
+    'bz2': 'bz2',
+}
+
+# Containers of formats that frame their own data.  Other formats are
+# text or Native row streams.
+CONTAINERS = {
+    'Parquet': 'parquet',
+    'ORC': 'orc',
+    'Arrow': 'arrow',
+    'Avro': 'avro',
+    'Native': 'native',
+}
+
+# Formats that can be selected for dumps.  Other formats only load.
+DUMP_FORMATS = ['CSVWithNames', 'Native', 'Parquet', 'ORC']
+
+# Codecs that can be selected for dumps.
+CODECS = ['none', 'gzip', 'zstd', 'lz4']
+
+# Methods available to load data files.
+LOADERS = ['client', 'native']
+
+# Methods available to compress dumped data files.
+COMPRESSORS = ['gzip', 'clickhouse', 'parallel']
+
+# Leading bytes of compressed files.
+_COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\x04\x22\x4d\x18', 'lz4'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+]
+
+# Leading bytes of self-describing formats.
+_FORMAT_MAGIC = [
+    (b'PAR1', 'Parquet'),
+    (b'ORC', 'ORC'),
+    (b'ARROW1', 'Arrow'),
+    (b'Obj\x01', 'Avro'),
+]
+
+# Extensions of files in data directories that are never data, such as
+# indexes of seekable files.
+_IGNORED_EXTENSIONS = {'idx', 'json', 'md', 'txt', 'yaml', 'yml', 'sql',
+                       'crc', 'tmp'}
+
+# Bytes read to classify a file.
+_SNIFF_SIZE = 64 * 1024
+
+# Formats that compress internally.  Codecs for these formats are applied
+# through settings rather than by compressing the file.
+_INTERNAL_CODEC_SETTINGS = {
+    'Parquet': 'output_format_parquet_compression_method',
+    'ORC': 'output_format_orc_compression_method',
+}
+
+
+def detect(path):
+    """Return format and compression of a data file from its name
+    :param path: (str): Data file path
+    :return: Tuple of (format, compression) where compression is None for
+             uncompressed files, or None if this is not a data file
+    """
+    parts = os.path.basename(path).lower().split('.')
+    compression = None
+    if len(parts) > 2 and parts[-1] in COMPRESSIONS:
+        compression = COMPRESSIONS[parts.pop()]
+    if len(parts) < 2 or parts[-1] not in FORMATS:
+        return None
+    return FORMATS[parts[-1]], compression
+
+
+def classify(path):
+    """Return container, compression and format of a data file.  Magic
+       bytes decide compression and self-describing formats, which may
+       differ from the extension.  Text formats are taken from the
+       extension or, for compressed files without one, from the first
+       line.  Other files are not data files
+    :param path: (str): Data file path
+    :return: Tuple of (container, compression, format) where compression
+             is None for uncompressed files, or None if this is not a data
+             file
+    """
+    name = os.path.basename(path)
+    by_name = detect(path)
+    extension = name.lower().rsplit('.', 1)[-1] if '.' in name else None
+    if by_name is None:
+        if name.startswith(('.', '_')) or extension in _IGNORED_EXTENSIONS:
+            return None
+    with open(path, 'rb') as f:
+        head = f.read(_SNIFF_SIZE)
+    if not head:
+        return None if by_name is None else _classified(*by_name)
+
+    compression = None
+    for magic, codec in _COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            compression = codec
+            head = _decompress_head(head, codec)
+            break
+    format = None
+    for magic, magic_format in _FORMAT_MAGIC:
+        if head is not None and head.startswith(magic):
+            format = magic_format
+    if format is None and by_name is not None:
+        format = by_name[0]
+    elif format is None and compression is not None and head is not None:
+        format = _text_format(head)
+    if format is None:
+        logger.info("Skipping file of unknown format: {0}".format(path))
+        return None
+    if by_name is not None and by_name != (format, compression):
+        logger.warning(
+            "Contents do not match file name, loading as {0}/{1}: {2}".format(
+                format, compression, path))
+    return _classified(format, compression)
+
+
+def _classified(format, compression):
+    return CONTAINERS.get(format, 'text'), compression, format
+
+
+def _decompress_head(head, codec):
+    """Return the start of decompressed data or None if the codec is not
+       available or the data is not valid, e.g., a truncated lz4 frame"""
+    try:
+        if codec == 'gzip':
+            return zlib.decompressobj(31).decompress(head)
+        elif codec == 'xz':
+            return lzma.LZMADecompressor().decompress(head)
+        elif codec == 'bz2':
+            return bz2.BZ2Decompressor().decompress(head)
+        elif codec == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj().decompress(
+                head)
+        elif codec == 'lz4':
+            import lz4.frame
+            return lz4.frame.LZ4FrameDecompressor().decompress(head)
+    except (ImportError, EOFError, OSError, RuntimeError, ValueError,
+            zlib.error, lzma.LZMAError) as e:
+        logger.debug("Unable to decompress start of file: {0}".format(e))
+    return None
+
+
+def _text_format(head):
+    """Guess a text format from the first line, or None if not text"""
+    line = head.split(b'\n', 1)[0].lstrip(b'\xef\xbb\xbf').rstrip(b'\r')
+    try:
+        text = line.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if not text or not text.isprintable() and '\t' not in text:
+        return None
+    elif text.lstrip().startswith('{'):
+        return 'JSONEachRow'
+    elif '\t' in text:
+        return 'TSVWithNames'
+    return 'CSVWithNames'
+
+
+def file_name(tag, format, compression=None):
+    """Return name of a data file
+    :param tag: (str): Partition or shard tag
+    :param format: (str): ClickHouse format name
+    :param compression: (str): Codec that compresses the whole file or None
+    """
+    name = "data-{0}.{1}".format(tag, _extension(FORMATS, format))
+    if compression is not None:
+        name += "." + _extension(COMPRESSIONS, compression)
+    return name
+
+
+def internal_codec_setting(format):
+    """Return setting that selects the codec of an internally compressed
+       format, or None if the format is compressed as a whole file"""
+    return _INTERNAL_CODEC_SETTINGS.get(format)
+
+
+def _extension(names, value):
+    for extension, name in names.items():
+        if name == value:
+            return extension
+    raise Exception("Unknown format or codec: {0}".format(value))
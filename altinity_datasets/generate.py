@@ -0,0 +1,529 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import decimal
+import logging
+import re
+import time
+import uuid
+import zlib
+
+from altinity_datasets import native_load
+from altinity_datasets import splits
+"""Generates synthetic data at a chosen scale from the CREATE TABLE
+   statements of a dataset and distribution hints in its manifest.  Values
+   are generated as NumPy arrays one block at a time.  Parts of each table
+   are independent so that worker processes can write files or insert
+   blocks in parallel.  NumPy is imported on use as it is optional"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Bytes of uncompressed CSV generated per unit of scale.
+SCALE_BYTES = 1000**3
+
+# Default rows in each generated file or insert stream.
+DEFAULT_FILE_ROWS = 1000000
+
+# Rows generated at once.
+DEFAULT_BLOCK_ROWS = 65536
+
+# Rows generated to estimate the CSV bytes per row of a table.
+SAMPLE_ROWS = 1000
+
+# Characters of generated strings.
+_ALPHABET = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+_CREATE_TABLE = re.compile(
+    r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.`"]+)\s*'
+    r'(?:ON\s+CLUSTER\s+\S+\s*)?\(', re.IGNORECASE)
+_COLUMN_OPTIONS = re.compile(
+    r'\s+(?:DEFAULT|MATERIALIZED|ALIAS|EPHEMERAL|CODEC|COMMENT|TTL)\b',
+    re.IGNORECASE)
+_COMPUTED_COLUMN = re.compile(r'\s(?:MATERIALIZED|ALIAS)\s', re.IGNORECASE)
+_NOT_COLUMNS = ('INDEX', 'PROJECTION', 'CONSTRAINT', 'PRIMARY')
+_INT_TYPES = re.compile(r'^(U?)Int(8|16|32|64|128|256)$')
+_FLOAT_TYPES = re.compile(r'^Float(32|64)$')
+_DECIMAL_TYPES = re.compile(r'^Decimal(?:32|64|128|256)?\((?:\d+\s*,\s*)?'
+                            r'(\d+)\)$')
+_ENUM_TYPES = re.compile(r'^Enum(?:8|16)?\((.*)\)$')
+_ENUM_VALUE = re.compile(r"'((?:[^'\\]|\\.)*)'\s*=\s*-?\d+")
+_FIXED_STRING = re.compile(r'^FixedString\((\d+)\)$')
+_DATETIME_TYPES = re.compile(r'^DateTime(64)?(\(.*\))?$')
+
+# Default bounds of generated values by kind.
+_DEFAULT_RANGES = {
+    'int': (0, 1000000),
+    'float': (0.0, 1.0),
+    'decimal': (0, 1000),
+    'date': ('2019-01-01', '2019-12-31'),
+    'datetime': ('2019-01-01 00:00:00', '2019-12-31 23:59:59'),
+}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("Generating data requires numpy: "
+                        "pip3 install altinity-datasets[generate]")
+    return numpy
+
+
+def parse_tables(sql):
+    """Find CREATE TABLE statements with column lists in a DDL script
+    :param sql: (str): DDL script
+    :return: List of tuple(table, list of tuple(column name, type)).
+             Columns computed by MATERIALIZED or ALIAS are left out
+    """
+    tables = []
+    for match in _CREATE_TABLE.finditer(sql):
+        name = match.group(1).replace('`', '').replace('"', '')
+        columns = []
+        for element in _split_top_level(_parenthesized(sql, match.end() - 1)):
+            element = element.strip()
+            if not element or element.split()[0].upper() in _NOT_COLUMNS:
+                continue
+            column, rest = element.split(None, 1)
+            if _COMPUTED_COLUMN.search(' ' + rest + ' '):
+                continue
+            type_name = _COLUMN_OPTIONS.split(' ' + rest, 1)[0].strip()
+            columns.append((column.strip('`"'), type_name))
+        tables.append((name.split('.')[-1], columns))
+    return tables
+
+
+def _parenthesized(text, start):
+    """Return text inside the parentheses that open at text[start]"""
+    depth = 0
+    quote = None
+    i = start
+    while i < len(text):
+        c = text[i]
+        if quote is not None:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in ("'", '`', '"'):
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return text[start + 1:i]
+        i += 1
+    raise Exception("Unbalanced parentheses in DDL: {0}".format(
+        text[start:start + 60]))
+
+
+def _split_top_level(text):
+    """Split text on commas outside of parentheses and quotes"""
+    elements = []
+    depth = 0
+    quote = None
+    last = 0
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote is not None:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in ("'", '`', '"'):
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            elements.append(text[last:i])
+            last = i + 1
+        i += 1
+    elements.append(text[last:])
+    return elements
+
+
+def _csv_field(value):
+    """Quote a CSV field if needed"""
+    if any(c in value for c in ',"\n\r') or value != value.strip():
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+class Column:
+    """Generates values of one column.  Hints select a distribution:
+       values (with optional weights) for a fixed set of values, or
+       distribution uniform, normal, exponential, zipf or sequence with
+       min, max, mean, stddev, a, start and step as applicable.  Other
+       hints are decimals for floats, length for strings and nulls for the
+       fraction of nulls in Nullable columns"""
+
+    def __init__(self, name, type_name, hint=None):
+        """Define a column
+        :param name: (str): Column name
+        :param type_name: (str): ClickHouse column type
+        :param hint: (dict): Distribution hint from the manifest
+        """
+        self.name = name
+        self.type_name = type_name
+        self.hint = dict(hint or {})
+        self.null_fraction = 0.0
+        base = type_name
+        while True:
+            inner = native_load._wrapped_type(base, 'LowCardinality')
+            if inner is None:
+                inner = native_load._wrapped_type(base, 'Nullable')
+                if inner is not None:
+                    self.null_fraction = float(self.hint.get('nulls', 0.0))
+            if inner is None:
+                break
+            base = inner
+        self.base_type = base
+        self.kind = self._kind(base)
+        if self.kind == 'values':
+            self._set_values(base)
+
+    def _kind(self, base):
+        """Return the kind of values generated for a type"""
+        if 'values' in self.hint:
+            return 'values'
+        int_match = _INT_TYPES.match(base)
+        if int_match:
+            bits = int(int_match.group(2))
+            if int_match.group(1):
+                self.type_range = (0, 2**bits - 1)
+            else:
+                self.type_range = (-2**(bits - 1), 2**(bits - 1) - 1)
+            return 'int'
+        elif _FLOAT_TYPES.match(base):
+            return 'float'
+        elif _DECIMAL_TYPES.match(base):
+            self.scale = int(_DECIMAL_TYPES.match(base).group(1))
+            return 'decimal'
+        elif base in ('Date', 'Date32'):
+            return 'date'
+        elif _DATETIME_TYPES.match(base):
+            return 'datetime'
+        elif base == 'String' or _FIXED_STRING.match(base):
+            fixed = _FIXED_STRING.match(base)
+            self.length = int(
+                self.hint.get('length', fixed.group(1) if fixed else 8))
+            return 'string'
+        elif base == 'UUID':
+            return 'uuid'
+        elif base == 'Bool':
+            self.hint['values'] = ['true', 'false']
+            return 'values'
+        elif _ENUM_TYPES.match(base):
+            self.hint['values'] = [
+                value.replace("\\'", "'") for value in _ENUM_VALUE.findall(
+                    _ENUM_TYPES.match(base).group(1))
+            ]
+            return 'values'
+        raise Exception(
+            "Cannot generate column without a values hint: {0} {1}".format(
+                self.name, self.type_name))
+
+    def _set_values(self, base):
+        np = _numpy()
+        values = [str(value) for value in self.hint['values']]
+        if not values:
+            raise Exception("Empty values hint for column: {0}".format(
+                self.name))
+        convert = native_load.converter(base)
+        self._text_values = np.array([_csv_field(v) for v in values],
+                                     dtype=object)
+        self._python_values = np.empty(len(values), dtype=object)
+        self._python_values[:] = [convert(v) for v in values]
+        weights = self.hint.get('weights')
+        if weights is None:
+            self._weights = None
+        elif len(weights) != len(values):
+            raise Exception(
+                "Weights do not match values for column: {0}".format(
+                    self.name))
+        else:
+            total = float(sum(weights))
+            self._weights = [w / total for w in weights]
+
+    def _number(self, value):
+        """Convert a hint value to a number for the column kind"""
+        np = _numpy()
+        if self.kind == 'date':
+            return int(np.datetime64(str(value)[:10], 'D').astype('int64'))
+        elif self.kind == 'datetime':
+            return int(
+                np.datetime64(str(value).replace(' ', 'T'),
+                              's').astype('int64'))
+        return float(value)
+
+    def generate(self, rng, first_row, count):
+        """Generate values for rows first_row to first_row + count
+        :param rng: (numpy.random.Generator): Random number generator
+        :return: Tuple of (array of values, boolean array of nulls or None)
+        """
+        np = _numpy()
+        if self.kind == 'values':
+            values = rng.choice(len(self._text_values),
+                                size=count,
+                                p=self._weights)
+        elif self.kind == 'string':
+            codes = rng.integers(0,
+                                 len(_ALPHABET),
+                                 size=(count, self.length),
+                                 dtype=np.uint8)
+            alphabet = np.frombuffer(_ALPHABET, dtype=np.uint8)
+            values = alphabet[codes].view('S{0}'.format(self.length)).ravel()
+        elif self.kind == 'uuid':
+            values = np.frombuffer(rng.bytes(16 * count),
+                                   dtype='S16')
+        else:
+            values = self._numbers(np, rng, first_row, count)
+        nulls = None
+        if self.null_fraction > 0:
+            nulls = rng.random(count) < self.null_fraction
+        return values, nulls
+
+    def _numbers(self, np, rng, first_row, count):
+        """Generate numeric values.  Dates are days and date times are
+           seconds since the epoch"""
+        hint = self.hint
+        default_min, default_max = _DEFAULT_RANGES[self.kind]
+        if self.kind == 'int':
+            default_max = min(default_max, self.type_range[1])
+        low = self._number(hint.get('min', default_min))
+        high = self._number(hint.get('max', default_max))
+        distribution = hint.get('distribution', 'uniform')
+        if distribution == 'sequence':
+            start = self._number(hint.get('start', low))
+            step = float(hint.get('step', 1))
+            numbers = start + (first_row + np.arange(count)) * step
+        else:
+            if distribution == 'uniform' and self.kind in ('float',
+                                                           'decimal'):
+                numbers = rng.uniform(low, high, count)
+            elif distribution == 'uniform':
+                numbers = np.floor(rng.uniform(low, high + 1, count))
+            elif distribution == 'normal':
+                numbers = rng.normal(
+                    self._number(hint.get('mean', (low + high) / 2)),
+                    float(hint.get('stddev', (high - low) / 6)), count)
+            elif distribution == 'exponential':
+                mean = self._number(hint.get('mean', low + (high - low) / 10))
+                numbers = low + rng.exponential(mean - low, count)
+            elif distribution == 'zipf':
+                numbers = low - 1 + rng.zipf(float(hint.get('a', 2.0)),
+                                             count)
+            else:
+                raise Exception(
+                    "Unknown distribution for column {0}: {1}".format(
+                        self.name, distribution))
+            numbers = np.clip(numbers, low, high)
+        if self.kind in ('float', 'decimal'):
+            decimals = self.scale if self.kind == 'decimal' else (
+                hint.get('decimals'))
+            return numbers if decimals is None else np.round(
+                numbers, int(decimals))
+        return np.rint(numbers).astype(np.int64)
+
+    def text(self, values, nulls):
+        """Return CSV fields of generated values as an array of str"""
+        np = _numpy()
+        if self.kind == 'values':
+            fields = self._text_values[values]
+        elif self.kind == 'decimal':
+            fields = np.char.mod('%.{0}f'.format(self.scale), values)
+        elif self.kind == 'date':
+            fields = np.datetime_as_string(values.astype('datetime64[D]'))
+        elif self.kind == 'datetime':
+            fields = np.char.replace(
+                np.datetime_as_string(values.astype('datetime64[s]')), 'T',
+                ' ')
+        elif self.kind == 'uuid':
+            fields = np.array([str(uuid.UUID(bytes=v)) for v in values])
+        else:
+            fields = values.astype(str)
+        if nulls is not None:
+            fields = fields.astype(object)
+            fields[nulls] = native_load.CSV_NULL
+        return fields
+
+    def python(self, values, nulls):
+        """Return generated values as a list for native inserts"""
+        if self.kind == 'values':
+            result = self._python_values[values].tolist()
+        elif self.kind == 'decimal':
+            result = [decimal.Decimal(v) for v in self.text(values, None)]
+        elif self.kind == 'date':
+            result = values.astype('datetime64[D]').astype(object).tolist()
+        elif self.kind == 'datetime':
+            result = values.astype('datetime64[s]').astype(object).tolist()
+        elif self.kind == 'uuid':
+            result = [uuid.UUID(bytes=v) for v in values]
+        elif self.kind == 'string':
+            result = values.astype(str).tolist()
+        else:
+            result = values.tolist()
+        if nulls is not None:
+            for i in nulls.nonzero()[0]:
+                result[i] = None
+        return result
+
+
+def columns_for(table, columns, hints):
+    """Return Column instances of a table
+    :param table: (str): Table name
+    :param columns: List of tuple(name, type)
+    :param hints: (dict): 'generate' section of the manifest
+    """
+    column_hints = _table_hints(table, hints).get('columns') or {}
+    for name in column_hints:
+        if name not in dict(columns):
+            raise Exception("Hint for unknown column: {0}.{1}".format(
+                table, name))
+    return [
+        Column(name, type_name, column_hints.get(name))
+        for name, type_name in columns
+    ]
+
+
+def _table_hints(table, hints):
+    return ((hints or {}).get('tables') or {}).get(table) or {}
+
+
+def plan_tables(scripts, hints, scale):
+    """Find tables to generate and their row counts.  Tables with a rows
+       hint get that many rows for each unit of scale.  Other tables share
+       scale * SCALE_BYTES of CSV data in proportion to their weight hints
+       (1 by default)
+    :param scripts: (list): DDL scripts
+    :param hints: (dict): 'generate' section of the manifest
+    :param scale: (float): Scale factor
+    :return: List of tuple(table, list of tuple(name, type, hint), rows)
+    """
+    tables = []
+    for script in scripts:
+        tables.extend(parse_tables(script))
+    sized = [t for t, _ in tables if 'rows' not in _table_hints(t, hints)]
+    total_weight = sum(
+        float(_table_hints(t, hints).get('weight', 1)) for t in sized)
+
+    plans = []
+    for table, columns in tables:
+        if not columns:
+            continue
+        table_hints = _table_hints(table, hints)
+        generators = columns_for(table, columns, hints)
+        if 'rows' in table_hints:
+            rows = int(round(float(table_hints['rows']) * scale))
+        else:
+            share = float(table_hints.get('weight', 1)) / total_weight
+            target_bytes = scale * SCALE_BYTES * share
+            rows = int(target_bytes / _bytes_per_row(generators))
+        plans.append((table, [(c.name, c.type_name, c.hint)
+                              for c in generators], max(rows, 1)))
+    return plans
+
+
+def _bytes_per_row(generators):
+    """Estimate CSV bytes per row from a sample"""
+    np = _numpy()
+    rng = np.random.default_rng(0)
+    data = _csv_block(generators, rng, 0, SAMPLE_ROWS)
+    return max(1.0, len(data) / float(SAMPLE_ROWS))
+
+
+def plan_parts(tables, file_rows=DEFAULT_FILE_ROWS):
+    """Divide tables into parts of at most file_rows rows
+    :return: List of tuple(table, columns, part number, first row, rows)
+    """
+    parts = []
+    for table, columns, rows in tables:
+        for number, first_row in enumerate(range(0, rows, file_rows)):
+            parts.append((table, columns, number, first_row,
+                          min(file_rows, rows - first_row)))
+    return parts
+
+
+def _rng(seed, table, first_row):
+    """Return a generator that depends only on seed, table and first row
+       so that output does not depend on how parts are scheduled"""
+    np = _numpy()
+    return np.random.default_rng([seed, zlib.crc32(table.encode()),
+                                  first_row])
+
+
+def _csv_block(generators, rng, first_row, count):
+    fields = [
+        c.text(*c.generate(rng, first_row, count)).tolist()
+        for c in generators
+    ]
+    return "\n".join(",".join(row) for row in zip(*fields)) + "\n"
+
+
+def write_part(table, columns, path, first_row, rows, seed, codec=None,
+               block_rows=DEFAULT_BLOCK_ROWS):
+    """Write one part of a table to a CSVWithNames file.  Compressed files
+       have one frame per block
+    :param columns: List of tuple(name, type, hint)
+    :param path: (str): File to write
+    :param codec: (str): gzip, zstd, lz4 or None to write plain CSV
+    :return: Tuple of (bytes written, start time, seconds)
+    """
+    start = time.monotonic()
+    generators = [Column(*column) for column in columns]
+    rng = _rng(seed, table, first_row)
+    compress = splits.compressor(codec, level=1) if codec else None
+    with open(path, 'wb') as f:
+        header = (",".join(c.name for c in generators) + "\n").encode()
+        f.write(compress(header) if compress else header)
+        for lo in range(0, rows, block_rows):
+            data = _csv_block(generators, rng, first_row + lo,
+                              min(block_rows, rows - lo)).encode()
+            f.write(compress(data) if compress else data)
+        size = f.tell()
+    logger.info("Generated file: table={0}, file={1}, rows={2}".format(
+        table, path, rows))
+    return size, start, time.monotonic() - start
+
+
+def insert_part(table, columns, connection, first_row, rows, seed,
+                block_rows=DEFAULT_BLOCK_ROWS):
+    """Insert one part of a table over the native protocol
+    :param columns: List of tuple(name, type, hint)
+    :param connection: (dict): Keyword arguments of ClickHouse connector
+    :return: Tuple of (rows inserted, start time, seconds)
+    """
+    from altinity_datasets import clickhouse
+    start = time.monotonic()
+    generators = [Column(*column) for column in columns]
+    names = [c.name for c in generators]
+    rng = _rng(seed, table, first_row)
+
+    def blocks():
+        for lo in range(0, rows, block_rows):
+            count = min(block_rows, rows - lo)
+            yield names, [
+                c.python(*c.generate(rng, first_row + lo, count))
+                for c in generators
+            ]
+
+    ch = clickhouse.ClickHouse(pool_size=1, **connection)
+    try:
+        inserted = ch.insert_blocks(table, blocks())
+    finally:
+        ch.close()
+    logger.info("Inserted generated rows: table={0}, rows={1}".format(
+        table, inserted))
+    return inserted, start, time.monotonic() - start
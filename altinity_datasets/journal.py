@@ -0,0 +1,173 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+"""Checkpoint journal that records data files loaded to a database so that
+   an interrupted load can resume without reloading completed files"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Read size for computing checksums.
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def file_checksum(path):
+    """Return CRC32 of a file's contents as a hex string"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+    return "{0:08x}".format(crc)
+
+
+def default_path(dataset_path, host, database):
+    """Return journal location next to the dataset, or in the current
+       directory if the dataset directory is not writable"""
+    name = ".load-journal-{0}-{1}.jsonl".format(host, database)
+    if os.access(dataset_path, os.W_OK):
+        return os.path.join(dataset_path, name)
+    return os.path.abspath(name)
+
+
+class LoadJournal:
+    """Append-only record of completed (table, file, range) loads"""
+
+    def __init__(self, path):
+        """Open a journal
+        :param path: (str): Journal file.  Created when first written
+        """
+        self.path = path
+        self.entries = {}
+        self._checksums = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self.entries[self._key(entry['table'], entry['file'],
+                                           entry['start'],
+                                           entry['length'])] = entry
+
+    def reset(self):
+        """Forget all entries, e.g., when starting a fresh load"""
+        with self._lock:
+            self.entries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def is_done(self, table, split):
+        """Return True if a split was loaded from the same file contents
+        :param table: (str): Table name
+        :param split: (FileSplit): File or file range to check
+        """
+        entry = self.entries.get(
+            self._key(table, split.path, split.start, split.length))
+        if entry is None:
+            return False
+        split.wait()
+        if entry['size'] != os.path.getsize(split.path):
+            return False
+        return entry['checksum'] == self.checksum(split.path)
+
+    def check_ranges(self, table, file_splits):
+        """Raise an exception if the journal has ranges of a file that
+           differ from planned ranges, which would load rows twice"""
+        path = os.path.abspath(file_splits[0].path)
+        planned = set((s.start, s.length) for s in file_splits)
+        for entry in self.entries.values():
+            if entry['table'] == table and entry['file'] == path:
+                if (entry['start'], entry['length']) not in planned:
+                    raise Exception(
+                        "Journal ranges do not match split size: {0}".format(
+                            path))
+
+    def record(self, table, split, rows=None, staged=False):
+        """Append a completed split to the journal
+        :param table: (str): Table name
+        :param split: (FileSplit): File or file range that loaded
+        :param rows: (int): Rows loaded if known
+        :param staged: (boolean): If True the split is held in staging
+                                  tables kept for a resumed load
+        """
+        entry = {
+            'table': table,
+            'file': os.path.abspath(split.path),
+            'start': split.start,
+            'length': split.length,
+            'size': os.path.getsize(split.path),
+            'checksum': self.checksum(split.path),
+            'rows': rows,
+            'time': time.time()
+        }
+        if staged:
+            entry['staged'] = True
+        self._append([entry])
+
+    def publish(self, table):
+        """Record that splits of a table held in staging tables have been
+           published to the table
+        :param table: (str): Table name
+        """
+        with self._lock:
+            entries = [dict(entry, time=time.time())
+                       for entry in self.entries.values()
+                       if entry['table'] == table and entry.get('staged')]
+        for entry in entries:
+            del entry['staged']
+        self._append(entries)
+
+    def tables(self, staged):
+        """Return names of tables with splits in the journal
+        :param staged: (boolean): If True return tables with splits held in
+                                  staging tables, else tables with
+                                  published splits
+        """
+        with self._lock:
+            return set(entry['table'] for entry in self.entries.values()
+                       if bool(entry.get('staged')) == staged)
+
+    def _append(self, entries):
+        if not entries:
+            return
+        with self._lock:
+            with open(self.path, 'a') as f:
+                for entry in entries:
+                    self.entries[self._key(entry['table'], entry['file'],
+                                           entry['start'],
+                                           entry['length'])] = entry
+                    f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def checksum(self, path):
+        """Return checksum of a data file, computing it once per file"""
+        path = os.path.abspath(path)
+        with self._lock:
+            checksum = self._checksums.get(path)
+        if checksum is None:
+            checksum = file_checksum(path)
+            with self._lock:
+                self._checksums[path] = checksum
+        return checksum
+
+    def _key(self, table, path, start, length):
+        return (table, os.path.abspath(path), start, length)
@@ -0,0 +1,168 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import ast
+import csv
+import datetime
+import decimal
+import logging
+import re
+import uuid
+"""Loads CSVWithNames files into ClickHouse over the native protocol
+   without running clickhouse-client"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Default number of rows to send in each INSERT block.
+DEFAULT_BLOCK_SIZE = 65536
+
+# CSV null value as written by ClickHouse.
+CSV_NULL = '\\N'
+
+_INT_TYPES = re.compile(r'^U?Int(8|16|32|64|128|256)$')
+_FLOAT_TYPES = re.compile(r'^Float(32|64)$')
+_DECIMAL_TYPES = re.compile(r'^Decimal(32|64|128|256)?\(')
+_STRING_TYPES = re.compile(r'^(String|FixedString\(\d+\)|Enum(8|16)?\(.*\)|'
+                           r'IPv4|IPv6)$')
+_DATETIME_TYPES = re.compile(r'^DateTime(64)?(\(.*\))?$')
+_COMPOSITE_TYPES = re.compile(r'^(Array|Tuple|Map)\(')
+
+
+def _wrapped_type(type_name, wrapper):
+    """Return inner type if type_name is wrapper(inner), otherwise None"""
+    prefix = wrapper + '('
+    if type_name.startswith(prefix) and type_name.endswith(')'):
+        return type_name[len(prefix):-1]
+    return None
+
+
+def _parse_date(value):
+    return datetime.date.fromisoformat(value) if value else datetime.date(
+        1970, 1, 1)
+
+
+# Zero DateTime value.
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _parse_datetime(value):
+    """Parse a DateTime field.  Unix timestamps are UTC.  Text without an
+       offset stays naive, so the driver applies the column or server time
+       zone as the server does for text formats, whatever the client's
+       time zone"""
+    if not value:
+        return _EPOCH
+    if value.isdigit():
+        return datetime.datetime.fromtimestamp(int(value),
+                                               datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value)
+
+
+def _parse_bool(value):
+    return value.lower() in ('1', 'true')
+
+
+def _parse_composite(value):
+    # ClickHouse text form of arrays, tuples and maps is close enough to
+    # Python literal syntax for the simple values found in datasets.
+    return ast.literal_eval(value) if value else None
+
+
+def converter(type_name):
+    """Return function to convert a CSV field to a value for a column type
+    :param type_name: (str): ClickHouse column type, e.g. Nullable(Int32)
+    :return: Function that accepts a string and returns a Python value
+    """
+    inner = _wrapped_type(type_name, 'LowCardinality')
+    if inner is not None:
+        return converter(inner)
+
+    inner = _wrapped_type(type_name, 'Nullable')
+    if inner is not None:
+        convert = converter(inner)
+        return lambda value: None if value == CSV_NULL else convert(value)
+
+    if _INT_TYPES.match(type_name):
+        return lambda value: int(value) if value else 0
+    elif _FLOAT_TYPES.match(type_name):
+        return lambda value: float(value) if value else 0.0
+    elif _DECIMAL_TYPES.match(type_name):
+        return lambda value: decimal.Decimal(value or '0')
+    elif _STRING_TYPES.match(type_name):
+        return str
+    elif type_name in ('Date', 'Date32'):
+        return _parse_date
+    elif _DATETIME_TYPES.match(type_name):
+        return _parse_datetime
+    elif type_name == 'Bool':
+        return _parse_bool
+    elif type_name == 'UUID':
+        return lambda value: uuid.UUID(value) if value else uuid.UUID(int=0)
+    elif _COMPOSITE_TYPES.match(type_name):
+        return _parse_composite
+    else:
+        raise Exception(
+            "Unsupported column type for native load: {0}".format(type_name))
+
+
+def read_blocks(f, columns, block_size=DEFAULT_BLOCK_SIZE):
+    """Read CSVWithNames data as typed columnar blocks
+    :param f: Iterable of text lines starting with the CSV header
+    :param columns: List of tuple(name, type) for the target table
+    :param block_size: (int): Maximum number of rows in each block
+    :return: Generator of tuple(column_names, list of column value lists)
+    """
+    reader = csv.reader(f)
+    try:
+        header = next(reader)
+    except StopIteration:
+        return
+    types = dict(columns)
+    for name in header:
+        if name not in types:
+            raise Exception("CSV column not in table: {0}".format(name))
+    converters = [converter(types[name]) for name in header]
+
+    block = [[] for _ in header]
+    rows = 0
+    for row in reader:
+        for values, convert, value in zip(block, converters, row):
+            values.append(convert(value))
+        rows += 1
+        if rows >= block_size:
+            yield header, block
+            block = [[] for _ in header]
+            rows = 0
+    if rows > 0:
+        yield header, block
+
+
+def load_split(ch,
+               table,
+               split,
+               columns,
+               block_size=DEFAULT_BLOCK_SIZE,
+               settings=None):
+    """Load a single CSVWithNames file or file range using native protocol
+    :param ch: (ClickHouse): Connector for the target database
+    :param table: (str): Table name
+    :param split: (FileSplit): File or range of a file to load
+    :param columns: List of tuple(name, type) for the table
+    :param block_size: (int): Number of rows to send in each INSERT block
+    :param settings: (dict): Query settings for the inserts
+    :return: Number of rows loaded
+    """
+    blocks = read_blocks(split.lines(), columns, block_size)
+    rows = ch.insert_blocks(table, blocks, settings)
+    logger.info("Loaded file: table={0}, file={1}, rows={2}".format(
+        table, split.name(), rows))
+    return rows
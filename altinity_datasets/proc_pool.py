@@ -10,13 +10,35 @@
 # conditions of the subcomponent's license, as noted in the LICENSE file.
 
 import logging
+import queue
 import subprocess
+import threading
 import time
 
 # Define logger
 logger = logging.getLogger(__name__)
 
 
+class ProcessResult:
+    """Outcome of a command executed by the pool"""
+
+    def __init__(self, command, returncode, stderr, duration, start=None,
+                 queued=None):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+        self.duration = duration
+        # Value of time.monotonic() when the process started.
+        self.start = start
+        # Value of time.monotonic() when the command was submitted, before
+        # waiting for a free slot.
+        self.queued = queued
+
+    def __repr__(self):
+        return "ProcessResult(returncode={0}, duration={1:.3f}, {2!r})".format(
+            self.returncode, self.duration, self.command)
+
+
 class ProcessPool:
     """Service for executing processes in parallel"""
 
@@ -37,46 +59,61 @@ class ProcessPool:
         self.outputs = []
         self.failed = 0
         self.succeeded = 0
+        # Waiter threads post (process, result) here as soon as a child exits.
+        self._finished = queue.Queue()
 
-    def exec(self, command):
+    def exec(self, command, callback=None):
         """Submit a command for execution, blocking if pool is full
         :param command: (str): Shell command to execute
+        :param callback: (function): If specified call function with the
+                                     ProcessResult when the command exits
         """
+        queued = time.monotonic()
         if len(self.slots) >= self.size:
             self._wait()
         if self.dry_run:
             logger.info("Dry run: " + command)
         else:
             logger.info("Starting a new process: " + command)
-            process = subprocess.Popen(command, shell=True)
+            process = subprocess.Popen(command,
+                                       shell=True,
+                                       stderr=subprocess.PIPE)
             self.slots.append(process)
+            waiter = threading.Thread(target=self._wait_for_exit,
+                                      args=(process, queued,
+                                            time.monotonic(), callback),
+                                      daemon=True)
+            waiter.start()
 
     def drain(self):
         """Wait for all pending commands to finish"""
         while len(self.slots) > 0:
             self._wait()
 
+    def _wait_for_exit(self, process, queued, start, callback):
+        """Block until a child exits and post its result"""
+        _, stderr = process.communicate()
+        result = ProcessResult(process.args, process.returncode,
+                               stderr.decode('utf-8', errors='replace'),
+                               time.monotonic() - start, start, queued)
+        self._finished.put((process, result, callback))
+
     def _wait(self):
         logger.info("Waiting for command to finish")
-        cur_len = len(self.slots)
-        while cur_len > 0 and cur_len == len(self.slots):
-            for p in self.slots:
-                status = p.poll()
-                if status is None:
-                    time.sleep(1)
-                elif status == 0:
-                    logger.info("Process completed: {}".format(p.args))
-                    self.outputs.append(status)
-                    self.succeeded += 1
-                    self.slots.remove(p)
-                    break
-                else:
-                    self._progress_and_info("Process failed: {}".format(
-                        p.args))
-                    self.outputs.append(status)
-                    self.failed += 1
-                    self.slots.remove(p)
-                    break
+        process, result, callback = self._finished.get()
+        self.slots.remove(process)
+        self.outputs.append(result)
+        if result.returncode == 0:
+            logger.info("Process completed: {}".format(result.command))
+            self.succeeded += 1
+        else:
+            self._progress_and_info("Process failed: {0}: {1}".format(
+                result.command, result.stderr.strip()))
+            self.failed += 1
+        if result.stderr and result.returncode == 0:
+            logger.info("Process stderr: {0}".format(result.stderr.strip()))
+        if callback is not None:
+            callback(result)
 
     def _progress_and_info(self, message):
         if self.progress_reporter is not None:
@@ -0,0 +1,509 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+
+from altinity_datasets import catalog
+"""Dataset repos served over HTTP or from S3-compatible object storage.
+   A remote repo has a repo-index.json file that lists the manifest and
+   files of each dataset with sizes and SHA-256 checksums.  Files are
+   downloaded with parallel ranged GETs into a local cache that evicts
+   least recently used files beyond a size limit.  Each dataset is
+   mirrored as a local directory of links into the cache so that loads
+   read it like any other dataset"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Name of the index at the root of a remote repo.
+INDEX_FILE = 'repo-index.json'
+
+# Version of the repo index layout.
+INDEX_VERSION = 1
+
+# Default size limit of the file cache.  Override with
+# ALTINITY_DATASETS_CACHE_MB.
+DEFAULT_CACHE_BYTES = 10 * 1024**3
+
+# Bytes fetched by each ranged GET.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Ranged GETs at once for each file.
+DEFAULT_CONNECTIONS = 4
+
+# Seconds to wait for a response.
+HTTP_TIMEOUT = 60
+
+# Endpoint of s3:// URLs unless AWS_ENDPOINT_URL is set.
+DEFAULT_S3_ENDPOINT = 'https://s3.amazonaws.com'
+
+_COPY_SIZE = 1024 * 1024
+
+
+def is_remote(path):
+    """Return True if a repo path is an HTTP or S3 URL"""
+    return isinstance(path, str) and path.split('://', 1)[0] in ('http',
+                                                                 'https',
+                                                                 's3')
+
+
+def file_sha256(path):
+    """Return SHA-256 of a file's contents as a hex string"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_COPY_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_index(repo_path):
+    """Write repo-index.json for a local repo so that it can be served from
+       a web server or bucket
+    :param repo_path: (str): Repo directory
+    :return: Index dictionary
+    """
+    datasets = {}
+    for entry in catalog.Catalog(repo_path).datasets():
+        files = []
+        for root, _, names in os.walk(entry['path']):
+            for name in names:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, entry['path'])
+                if relative.split(os.sep)[0] not in ('manifest.yaml', 'ddl',
+                                                     'data'):
+                    continue
+                files.append({
+                    'path': relative.replace(os.sep, '/'),
+                    'size': os.path.getsize(path),
+                    'sha256': file_sha256(path)
+                })
+        datasets[entry['name']] = {
+            'manifest': entry['manifest'],
+            'files': sorted(files, key=lambda f: f['path'])
+        }
+    index = {'version': INDEX_VERSION, 'datasets': datasets}
+    fd, tmp_path = tempfile.mkstemp(dir=repo_path)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True, default=str)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, os.path.join(repo_path, INDEX_FILE))
+    return index
+
+
+def http_url(url):
+    """Return the HTTP URL of an s3://bucket/key URL using path-style
+       addressing.  Other URLs are returned as is"""
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme != 's3':
+        return url
+    endpoint = os.environ.get('AWS_ENDPOINT_URL', DEFAULT_S3_ENDPOINT)
+    return "{0}/{1}{2}".format(endpoint.rstrip('/'), parsed.netloc,
+                               urllib.parse.quote(parsed.path))
+
+
+def sign_v4(method, url, headers, access_key, secret_key, region, now,
+            session_token=None):
+    """Return headers with an AWS Signature Version 4 for an S3 request
+       without a body
+    :param headers: (dict): Headers to sign in addition to host
+    :param now: (datetime): Request time in UTC
+    """
+    parsed = urllib.parse.urlsplit(url)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    payload_hash = hashlib.sha256(b'').hexdigest()
+    signed = dict((k.lower(), str(v).strip()) for k, v in headers.items())
+    signed['host'] = parsed.netloc
+    signed['x-amz-content-sha256'] = payload_hash
+    signed['x-amz-date'] = amz_date
+    if session_token:
+        signed['x-amz-security-token'] = session_token
+    names = sorted(signed)
+    query = "&".join(
+        "{0}={1}".format(urllib.parse.quote(k, safe='-_.~'),
+                         urllib.parse.quote(v, safe='-_.~'))
+        for k, v in sorted(urllib.parse.parse_qsl(parsed.query,
+                                                  keep_blank_values=True)))
+    canonical = "\n".join([
+        method, parsed.path or '/', query,
+        "".join("{0}:{1}\n".format(n, signed[n]) for n in names),
+        ";".join(names), payload_hash
+    ])
+    scope = "{0}/{1}/s3/aws4_request".format(amz_date[:8], region)
+    to_sign = "\n".join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical.encode()).hexdigest()
+    ])
+    key = ('AWS4' + secret_key).encode()
+    for part in (amz_date[:8], region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+    result = dict(headers)
+    result.update({
+        'x-amz-content-sha256': payload_hash,
+        'x-amz-date': amz_date,
+        'Authorization':
+        "AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, "
+        "Signature={3}".format(access_key, scope, ";".join(names), signature)
+    })
+    if session_token:
+        result['x-amz-security-token'] = session_token
+    return result
+
+
+def open_url(url, headers=None):
+    """Open a GET request.  s3:// URLs are signed if AWS_ACCESS_KEY_ID and
+       AWS_SECRET_ACCESS_KEY are set and are anonymous otherwise"""
+    headers = dict(headers or {})
+    target = http_url(url)
+    if url.startswith('s3://') and os.environ.get('AWS_ACCESS_KEY_ID'):
+        headers = sign_v4(
+            'GET', target, headers, os.environ['AWS_ACCESS_KEY_ID'],
+            os.environ.get('AWS_SECRET_ACCESS_KEY', ''),
+            os.environ.get('AWS_REGION',
+                           os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')),
+            datetime.datetime.now(datetime.timezone.utc),
+            os.environ.get('AWS_SESSION_TOKEN'))
+    request = urllib.request.Request(target, headers=headers)
+    return urllib.request.urlopen(request, timeout=HTTP_TIMEOUT)
+
+
+class FileCache:
+    """Files named by SHA-256 with least recently used eviction"""
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """Open a cache
+        :param cache_dir: (str): Cache directory or None for the default
+        :param max_bytes: (int): Size limit or None for the default
+        """
+        if cache_dir is None:
+            cache_dir = catalog.default_cache_dir()
+        if max_bytes is None:
+            size_mb = os.environ.get('ALTINITY_DATASETS_CACHE_MB')
+            max_bytes = (int(size_mb) * 1024 * 1024
+                         if size_mb else DEFAULT_CACHE_BYTES)
+        self.cache_dir = cache_dir
+        self.files_path = os.path.join(cache_dir, 'files')
+        self.max_bytes = max_bytes
+        # Pins of files in use by this instance, keyed by SHA-256.
+        self.pinned = collections.Counter()
+        self._lock = threading.Lock()
+        os.makedirs(self.files_path, exist_ok=True)
+
+    def lookup(self, sha256):
+        """Return path of a cached file and mark it used, or None"""
+        path = os.path.join(self.files_path, sha256)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, url, size, sha256, connections=DEFAULT_CONNECTIONS,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+        """Return path of a file, downloading it if not cached.  The file
+           is pinned, so that this instance does not evict it, until it is
+           unpinned
+        :param url: (str): File URL
+        :param size: (int): Expected size
+        :param sha256: (str): Expected checksum
+        :param connections: (int): Ranged GETs at once
+        :param chunk_size: (int): Bytes per ranged GET
+        """
+        with self._lock:
+            self.pinned[sha256] += 1
+        path = self.lookup(sha256)
+        if path is not None:
+            return path
+        fd, tmp_path = tempfile.mkstemp(dir=self.files_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _download(url, f, size, connections, chunk_size)
+            actual = file_sha256(tmp_path)
+            if os.path.getsize(tmp_path) != size or actual != sha256:
+                raise Exception("Checksum mismatch: {0}".format(url))
+            path = os.path.join(self.files_path, sha256)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            self.unpin(sha256)
+            raise
+        logger.info("Downloaded: {0} ({1} bytes)".format(url, size))
+        self.evict()
+        return path
+
+    def unpin(self, sha256):
+        """Release a pin of a fetched file so that it may be evicted"""
+        with self._lock:
+            self.pinned[sha256] -= 1
+            if self.pinned[sha256] <= 0:
+                del self.pinned[sha256]
+
+    def evict(self):
+        """Remove least recently used files until the cache fits its limit.
+           Pinned files are kept"""
+        files = []
+        total = 0
+        with self._lock:
+            pinned = set(self.pinned)
+        for name in os.listdir(self.files_path):
+            try:
+                st = os.stat(os.path.join(self.files_path, name))
+            except OSError:
+                continue
+            total += st.st_size
+            if name not in pinned and not name.endswith('.tmp'):
+                files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            logger.info("Evicting cached file: {0}".format(name))
+            try:
+                os.remove(os.path.join(self.files_path, name))
+                total -= size
+            except OSError:
+                pass
+        if total > self.max_bytes:
+            logger.warning("File cache exceeds limit with files in use: "
+                           "{0} > {1} bytes".format(total, self.max_bytes))
+
+
+def _download(url, f, size, connections, chunk_size):
+    """Write a URL to an open file using parallel ranged GETs.  Falls back
+       to one GET if the server does not support ranges"""
+    if size == 0:
+        return
+    f.truncate(size)
+    fd = f.fileno()
+    ranges = [(start, min(start + chunk_size, size) - 1)
+              for start in range(0, size, chunk_size)]
+    with open_url(url, {'Range': 'bytes={0}-{1}'.format(*ranges[0])}) as r:
+        if r.status != 206:
+            _copy(r, fd, 0, size)
+            return
+        _copy(r, fd, ranges[0][0], ranges[0][1] - ranges[0][0] + 1)
+
+    def get_range(byte_range):
+        start, end = byte_range
+        with open_url(url, {'Range': 'bytes={0}-{1}'.format(start, end)}) as r:
+            if r.status != 206:
+                raise Exception("Range not returned: {0}".format(url))
+            _copy(r, fd, start, end - start + 1)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=connections) as pool:
+        list(pool.map(get_range, ranges[1:]))
+
+
+def _copy(response, fd, offset, length):
+    """Write a response body at an offset of a file"""
+    written = 0
+    while True:
+        data = response.read(_COPY_SIZE)
+        if not data:
+            break
+        os.pwrite(fd, data, offset + written)
+        written += len(data)
+    if written != length:
+        raise Exception("Short read: {0} of {1} bytes".format(
+            written, length))
+
+
+class RemoteRepo:
+    """A repo at an HTTP or S3 URL"""
+
+    def __init__(self, url, cache=None):
+        """Open a repo
+        :param url: (str): Repo URL
+        :param cache: (FileCache): File cache or None for the default
+        """
+        self.url = url.rstrip('/')
+        self.cache = FileCache() if cache is None else cache
+        digest = hashlib.sha1(self.url.encode('utf-8')).hexdigest()
+        self.mirror_path = os.path.join(self.cache.cache_dir, 'repos',
+                                        digest[:16])
+        self._index = None
+
+    def index(self):
+        """Return the repo index, fetching it on first use"""
+        if self._index is None:
+            with open_url(self.url + '/' + INDEX_FILE) as response:
+                index = json.loads(response.read().decode('utf-8'))
+            if index.get('version') != INDEX_VERSION:
+                raise Exception("Unsupported repo index version: {0}".format(
+                    self.url))
+            self._index = index
+        return self._index
+
+    def datasets(self, name=None):
+        """Return manifests of datasets with location fields filled in
+        :param name: (str): If specified return only this dataset
+        """
+        datasets = []
+        for ds_name, entry in sorted(self.index()['datasets'].items()):
+            if name and ds_name != name:
+                continue
+            manifest = dict(entry['manifest'])
+            manifest['repo'] = self.url
+            manifest['path'] = os.path.join(self.mirror_path, ds_name)
+            manifest['name'] = ds_name
+            manifest['url'] = self.url + '/' + ds_name
+            datasets.append(manifest)
+        return datasets
+
+    def mirror(self, name, parallel=DEFAULT_CONNECTIONS, data=True,
+               progress_reporter=None):
+        """Fetch the manifest and DDL of a dataset into its mirror directory
+           and start fetching data files, largest first
+        :param name: (str): Dataset name
+        :param parallel: (int): Files fetched at once
+        :param data: (boolean): If False fetch only manifest and DDL
+        :return: Prefetcher that lists and fetches data files
+        """
+        entry = self.index()['datasets'].get(name)
+        if entry is None:
+            raise Exception("Dataset not found: {0}".format(name))
+        ds_path = os.path.join(self.mirror_path, name)
+        _remove_stale(ds_path, set(
+            os.path.join(ds_path, *file['path'].split('/'))
+            for file in entry['files']))
+        data_files = []
+        for file in entry['files']:
+            local_path = os.path.join(ds_path, *file['path'].split('/'))
+            url = "{0}/{1}/{2}".format(self.url, name, file['path'])
+            if file['path'].startswith('data/'):
+                data_files.append((url, file['size'], file['sha256'],
+                                   local_path))
+            else:
+                if progress_reporter is not None:
+                    progress_reporter("Fetching: {0}".format(url))
+                _link(
+                    self.cache.fetch(url, file['size'], file['sha256']),
+                    local_path)
+        os.makedirs(os.path.join(ds_path, 'data'), exist_ok=True)
+        data_files.sort(key=lambda f: f[1], reverse=True)
+        return Prefetcher(self.cache, data_files, parallel, fetch=data)
+
+
+def _remove_stale(ds_path, local_paths):
+    """Remove mirror links of files that are no longer in the index so
+       that dropped data and DDL files are not loaded"""
+    for dir_path, _, file_names in os.walk(ds_path):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            if os.path.islink(path) and path not in local_paths:
+                logger.info("Removing file dropped from index: {0}".format(
+                    path))
+                os.remove(path)
+
+
+def _link(target, path):
+    """Point a mirror path at a cached file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.lexists(path):
+        os.remove(path)
+    os.symlink(target, path)
+
+
+class Prefetcher:
+    """Fetches data files of a mirrored dataset in the background.  Files
+       are fetched ahead of the loader up to a window of bytes that are
+       fetched or being fetched and not yet released by the loader"""
+
+    def __init__(self, cache, files, parallel, fetch=True, window=None):
+        """Start fetching
+        :param cache: (FileCache): File cache
+        :param files: (list): Tuples of (url, size, sha256, local path) in
+                              fetch order
+        :param parallel: (int): Files fetched at once
+        :param fetch: (boolean): If False only list files, e.g., for dry runs
+        :param window: (int): Bytes fetched ahead of the loader.  Defaults
+                              to the size limit of the cache
+        """
+        self.cache = cache
+        self.files = files
+        self.window = cache.max_bytes if window is None else window
+        self._files = {f[3]: f for f in files}
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, parallel))
+        self._futures = {}
+        self._pending = list(files) if fetch else []
+        self._held = 0
+        self._lock = threading.Lock()
+        with self._lock:
+            self._schedule()
+
+    def _schedule(self):
+        """Start fetches that fit the window.  A file starts alone if it
+           is bigger than the window.  Called with the lock held"""
+        while self._pending:
+            if self._held and self._held + self._pending[0][1] > self.window:
+                break
+            self._submit(self._pending.pop(0))
+
+    def _submit(self, file):
+        self._held += file[1]
+        self._futures[file[3]] = self._pool.submit(self._fetch, *file)
+
+    def _fetch(self, url, size, sha256, local_path):
+        _link(self.cache.fetch(url, size, sha256), local_path)
+
+    def wait(self, path):
+        """Wait until a data file is in the mirror.  Files outside the
+           window start at once.  Raises if the fetch failed.  Fetches the
+           file again if another process evicted it from the cache and left
+           a dangling link"""
+        with self._lock:
+            file = self._files.get(path)
+            if file in self._pending:
+                self._pending.remove(file)
+                self._submit(file)
+            future = self._futures.get(path)
+        if future is None:
+            return
+        future.result()
+        if not os.path.exists(path):
+            logger.info("Cached file was evicted, fetching again: {0}".format(
+                path))
+            # The fetch pins the file again.
+            self.cache.unpin(file[2])
+            self._fetch(*file)
+
+    def release(self, path):
+        """Unpin a data file once its load has finished, so that the cache
+           may evict it, and fetch more files in its place"""
+        with self._lock:
+            future = self._futures.pop(path, None)
+            if future is None:
+                return
+            self._held -= self._files[path][1]
+            self._schedule()
+        if future.done() and future.exception() is None:
+            self.cache.unpin(self._files[path][2])
+
+    def close(self):
+        """Cancel fetches that have not started and wait for the rest"""
+        for future in self._futures.values():
+            future.cancel()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,251 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import json
+import os
+import tempfile
+import time
+"""Throughput report of a load or dump with rows, bytes and timings for
+   each operation.  Reports export as JSON or as a Prometheus textfile"""
+
+# Prefix of Prometheus metric names.
+METRIC_PREFIX = 'altinity_datasets'
+
+# Table totals exported to Prometheus as (key, metric name, help).
+_TABLE_METRICS = [
+    ('rows', 'rows', 'Rows transferred'),
+    ('bytes', 'bytes', 'Bytes transferred'),
+    ('duration', 'operation_seconds', 'Sum of operation seconds'),
+    ('queue_wait', 'queue_wait_seconds', 'Sum of seconds waiting for slots'),
+    ('throughput', 'throughput_bytes_per_second', 'Bytes per second'),
+]
+
+
+class OperationStats:
+    """Rows, bytes and timings of one load or dump operation"""
+
+    def __init__(self, table, name, bytes=None, rows=None, origin=None):
+        """Define an operation that has not run yet
+        :param table: (str): Table name
+        :param name: (str): File or partition name
+        :param bytes: (int): Bytes read by loads or written by dumps
+        :param rows: (int): Rows loaded, or estimated rows dumped
+        :param origin: (float): time.monotonic() when the report started
+        """
+        self.origin = time.monotonic() if origin is None else origin
+        self.table = table
+        self.name = name
+        self.bytes = bytes
+        self.rows = rows
+        self.status = 'planned'
+        self.start = None
+        self.queue_wait = None
+        self.duration = None
+
+    def record(self, status, started, duration, queued):
+        """Record the outcome of the operation
+        :param status: (str): 'succeeded' or 'failed'
+        :param started: (float): time.monotonic() when the operation started
+        :param duration: (float): Seconds the operation ran
+        :param queued: (float): time.monotonic() when it was queued
+        """
+        self.status = status
+        self.start = started - self.origin
+        self.queue_wait = max(0.0, started - queued)
+        self.duration = duration
+
+    def throughput(self):
+        """Return bytes per second or None if unknown"""
+        if self.bytes is None or not self.duration:
+            return None
+        return self.bytes / self.duration
+
+    def to_dict(self):
+        return {
+            'table': self.table,
+            'name': self.name,
+            'status': self.status,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'start': self.start,
+            'queue_wait': self.queue_wait,
+            'duration': self.duration,
+            'throughput': self.throughput()
+        }
+
+
+class Report:
+    """Report of a dataset load or dump"""
+
+    def __init__(self, operation, dataset, database):
+        """Start a report
+        :param operation: (str): 'load' or 'dump'
+        :param dataset: (str): Dataset name
+        :param database: (str): Database name
+        """
+        self.operation = operation
+        self.dataset = dataset
+        self.database = database
+        self.timestamp = time.time()
+        self.origin = time.monotonic()
+        self.wall_time = None
+        self.operations = []
+
+    def add(self, table, name, bytes=None, rows=None):
+        """Add an operation
+        :return: OperationStats instance to record the outcome
+        """
+        stats = OperationStats(table, name, bytes, rows, self.origin)
+        self.operations.append(stats)
+        return stats
+
+    def finish(self):
+        """Record wall time of the whole load or dump.  Operations that did
+           not run, e.g., in dry runs, are marked skipped"""
+        self.wall_time = time.monotonic() - self.origin
+        for op in self.operations:
+            if op.status == 'planned':
+                op.status = 'skipped'
+
+    @property
+    def succeeded(self):
+        return self._count('succeeded')
+
+    @property
+    def failed(self):
+        return self._count('failed')
+
+    @property
+    def skipped(self):
+        return self._count('skipped')
+
+    def _count(self, status):
+        return len([op for op in self.operations if op.status == status])
+
+    def tables(self):
+        """Return totals for each table.  Throughput is bytes divided by
+           the span from the first operation start to the last end
+        :return: Dictionary of totals keyed by table name
+        """
+        tables = {}
+        for op in self.operations:
+            totals = tables.setdefault(
+                op.table, {
+                    'operations': 0,
+                    'succeeded': 0,
+                    'failed': 0,
+                    'rows': 0,
+                    'bytes': 0,
+                    'duration': 0.0,
+                    'queue_wait': 0.0,
+                    'throughput': None,
+                    '_first': None,
+                    '_last': None
+                })
+            totals['operations'] += 1
+            if op.status in ('succeeded', 'failed'):
+                totals[op.status] += 1
+            totals['rows'] += op.rows or 0
+            totals['bytes'] += op.bytes or 0
+            if op.start is None:
+                continue
+            totals['duration'] += op.duration
+            totals['queue_wait'] += op.queue_wait
+            end = op.start + op.duration
+            if totals['_first'] is None or op.start < totals['_first']:
+                totals['_first'] = op.start
+            if totals['_last'] is None or end > totals['_last']:
+                totals['_last'] = end
+        for totals in tables.values():
+            first = totals.pop('_first')
+            last = totals.pop('_last')
+            if first is not None and last > first:
+                totals['throughput'] = totals['bytes'] / (last - first)
+        return tables
+
+    def to_dict(self):
+        return {
+            'operation': self.operation,
+            'dataset': self.dataset,
+            'database': self.database,
+            'timestamp': self.timestamp,
+            'wall_time': self.wall_time,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'tables': self.tables(),
+            'operations': [op.to_dict() for op in self.operations]
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Return metrics in Prometheus text exposition format with totals
+           for each table"""
+        lines = []
+        labels = {
+            'operation': self.operation,
+            'dataset': self.dataset,
+            'database': self.database
+        }
+
+        def metric(name, help, type, samples):
+            full_name = "{0}_{1}".format(METRIC_PREFIX, name)
+            lines.append("# HELP {0} {1}".format(full_name, help))
+            lines.append("# TYPE {0} {1}".format(full_name, type))
+            for extra_labels, value in samples:
+                sample_labels = dict(labels, **extra_labels)
+                lines.append("{0}{{{1}}} {2}".format(
+                    full_name, _label_text(sample_labels), value))
+
+        tables = sorted(self.tables().items())
+        metric('last_run_timestamp_seconds', 'Start time of the last run',
+               'gauge', [({}, self.timestamp)])
+        metric('wall_seconds', 'Wall time of the last run', 'gauge',
+               [({}, self.wall_time or 0.0)])
+        status_samples = []
+        for table, totals in tables:
+            for status in ('succeeded', 'failed'):
+                status_samples.append(({
+                    'table': table,
+                    'status': status
+                }, totals[status]))
+        metric('operations', 'Operations by status', 'gauge', status_samples)
+        for key, name, help in _TABLE_METRICS:
+            samples = []
+            for table, totals in tables:
+                if totals[key] is not None:
+                    samples.append(({'table': table}, totals[key]))
+            metric(name, help, 'gauge', samples)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the report as a Prometheus textfile if the path ends in
+           .prom, otherwise as JSON.  The file is replaced atomically so
+           that collectors never read a partial file"""
+        if path.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+
+def _label_text(labels):
+    return ",".join('{0}="{1}"'.format(
+        key,
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for key, value in sorted(labels.items()))
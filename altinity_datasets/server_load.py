@@ -0,0 +1,215 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import logging
+import os
+import posixpath
+import urllib.parse
+
+from altinity_datasets import clickhouse
+from altinity_datasets import remote
+"""Loads datasets on the server from object storage locations listed in
+   the manifest.  The server lists the source files and runs INSERT SELECT
+   from the s3 table function, so no data passes through the client.  Each
+   directory of the listing, e.g., a year=YYYY/month=MM partition, loads
+   as a separate insert so that inserts can run in parallel"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Manifest keys of sources that load on the server with their formats.
+SOURCES = {'parquet': 'Parquet', 'parquet_hive': 'Parquet'}
+
+# Manifest keys of sources that cannot be inserted from.  The mergetree
+# source is a table on an s3_plain_rewritable disk that is attached rather
+# than copied.
+UNSUPPORTED_SOURCES = ('mergetree', )
+
+# Large insert blocks create fewer parts.  Bytes are uncompressed and held
+# in memory by each parallel insert.
+DEFAULT_SETTINGS = {
+    'min_insert_block_size_bytes': 1024 * 1024 * 1024,
+    'min_insert_block_size_rows': 33554432,
+    'max_insert_block_size': 33554432,
+}
+
+# Glob of source files under a manifest location.
+FILE_GLOBS = {'Parquet': '**.parquet'}
+
+
+class LoadUnit:
+    """A glob of source files that loads as one INSERT SELECT"""
+
+    def __init__(self, table, url, glob, files, bytes):
+        """Define a unit
+        :param table: (str): Target table
+        :param url: (str): Manifest location, ending in '/'
+        :param glob: (str): Files relative to the location
+        :param files: (int): Number of files that match
+        :param bytes: (int): Total size of the files
+        """
+        self.table = table
+        self.url = url
+        self.glob = glob
+        self.files = files
+        self.bytes = bytes
+
+    def name(self):
+        """Return a display name for the unit"""
+        return self.glob
+
+
+def locations(manifest, source, tables):
+    """Return (table, url) of each location of a source in a manifest.
+       Locations are URLs of the only table in the dataset or mappings with
+       table and url keys
+    :param manifest: (dict): Dataset manifest
+    :param source: (str): Manifest key, e.g., 'parquet'
+    :param tables: (list): Names of tables created by the dataset's DDL
+    """
+    if source in UNSUPPORTED_SOURCES:
+        raise Exception(
+            "Source cannot be loaded with INSERT SELECT: {0}".format(source))
+    elif source not in SOURCES:
+        raise Exception("Unknown source: {0}".format(source))
+    entries = manifest.get(source)
+    if not entries:
+        raise Exception("Manifest has no {0} locations".format(source))
+    result = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            table, url = entry['table'], entry['url']
+        elif len(tables) == 1:
+            table, url = tables[0], entry
+        else:
+            raise Exception(
+                "Location must name its table in a dataset with {0} "
+                "tables: {1}".format(len(tables), entry))
+        result.append((table, url.rstrip('/') + '/'))
+    return result
+
+
+def table_function(url, format, glob=''):
+    """Return an s3 table function call for files under a location.
+       s3:// URLs go to $AWS_ENDPOINT_URL if set, and credentials are passed
+       if AWS_ACCESS_KEY_ID is set.  The secret key is masked in logged
+       statements.  Otherwise the server's own credentials apply"""
+    if os.environ.get('AWS_ENDPOINT_URL'):
+        url = remote.http_url(url)
+    args = [clickhouse.quote(url + glob)]
+    if os.environ.get('AWS_ACCESS_KEY_ID'):
+        secret = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        clickhouse.hide(secret)
+        args.append(clickhouse.quote(os.environ['AWS_ACCESS_KEY_ID']))
+        args.append(clickhouse.quote(secret))
+    args.append(clickhouse.quote(format))
+    return "s3({0})".format(", ".join(args))
+
+
+def format_settings(settings):
+    """Return a SETTINGS clause or an empty string
+    :param settings: (dict): Setting names and values
+    """
+    if not settings:
+        return ''
+    values = []
+    for name, value in sorted(settings.items()):
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, str) and not value.lstrip('-').isdigit():
+            value = clickhouse.quote(value)
+        values.append("{0} = {1}".format(name, value))
+    return " SETTINGS " + ", ".join(values)
+
+
+def listing_sql(url, format, partition_filter=None):
+    """Return a query for the path and size of each source file.  The One
+       format reads no file contents"""
+    sql = "SELECT _path, _size FROM {0}".format(
+        table_function(url, 'One', FILE_GLOBS[format]))
+    if partition_filter:
+        sql += " WHERE {0}".format(partition_filter)
+    return sql + format_settings({'use_hive_partitioning': 1})
+
+
+def _relative(url, path):
+    """Return a listed _path relative to a location URL"""
+    parsed = urllib.parse.urlsplit(url)
+    prefixes = [parsed.netloc + parsed.path, parsed.path.lstrip('/')]
+    # Virtual-hosted URLs have the bucket in the host name.
+    prefixes.append(parsed.netloc.split('.')[0] + parsed.path)
+    for prefix in prefixes:
+        if path.startswith(prefix):
+            return path[len(prefix):]
+    raise Exception("Listed file is outside {0}: {1}".format(url, path))
+
+
+def plan_units(ch, table, url, format, partition_filter=None):
+    """List source files on the server and group them into units, one per
+       directory
+    :return: List of LoadUnit, largest first
+    """
+    groups = {}
+    for path, size in ch.execute(listing_sql(url, format, partition_filter)):
+        relative = _relative(url, path)
+        directory = posixpath.dirname(relative)
+        key = relative if not directory else directory + '/*.' + (
+            relative.rsplit('.', 1)[-1])
+        files, total = groups.get(key, (0, 0))
+        groups[key] = (files + 1, total + (size or 0))
+    units = [
+        LoadUnit(table, url, glob, files, bytes)
+        for glob, (files, bytes) in groups.items()
+    ]
+    return sorted(units, key=lambda u: (-u.bytes, u.glob))
+
+
+def insert_columns(ch, unit, format):
+    """Return columns to insert, which are table columns that have values
+       in the source.  ALIAS and MATERIALIZED columns are computed"""
+    source = set(row[0] for row in ch.execute("DESCRIBE TABLE {0}".format(
+        table_function(unit.url, format, unit.glob))))
+    columns = []
+    for row in ch.execute("DESCRIBE TABLE {0}".format(unit.table)):
+        if row[2] in ('ALIAS', 'MATERIALIZED'):
+            continue
+        elif row[0] in source:
+            columns.append(row[0])
+    if not columns:
+        raise Exception("Source has no columns of table {0}: {1}".format(
+            unit.table, unit.url + unit.glob))
+    return columns
+
+
+def insert_sql(unit, format, columns, settings):
+    """Return INSERT SELECT for a unit
+    :param columns: (list): Column names or None for all
+    """
+    if columns:
+        column_list = ", ".join("`{0}`".format(c) for c in columns)
+        target = "{0} ({1})".format(unit.table, column_list)
+    else:
+        column_list = '*'
+        target = unit.table
+    return "INSERT INTO {0} SELECT {1} FROM {2}{3}".format(
+        target, column_list, table_function(unit.url, format, unit.glob),
+        format_settings(settings))
+
+
+def load_unit(ch, unit, format, settings, columns=None):
+    """Insert a unit on the server
+    :param columns: (list): Column names from insert_columns or None to
+                            look them up
+    :return: Number of rows written
+    """
+    if columns is None:
+        columns = insert_columns(ch, unit, format)
+    return ch.insert_select(insert_sql(unit, format, columns, settings))
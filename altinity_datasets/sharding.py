@@ -0,0 +1,178 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import logging
+
+from altinity_datasets import ddl
+"""Loads into sharded clusters.  Shards come from system.clusters or from a
+   list of hosts.  Data files are spread over the shards by size and load
+   into the local tables of each shard in parallel"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+
+class Shard:
+    """A shard and the hosts of its replicas.  Loads go to the first
+       replica that accepts a connection, and replicated tables copy data
+       to the others"""
+
+    def __init__(self, number, replicas, weight=1):
+        """Define a shard
+        :param number: (int): Shard number starting from 1
+        :param replicas: (list): tuple(host, port) of each replica.  Port is
+                                 None for the default port
+        :param weight: (int): Share of data relative to other shards
+        """
+        self.number = number
+        self.replicas = replicas
+        self.weight = max(1, weight or 1)
+        self.replica = 0
+
+    @property
+    def host(self):
+        return self.replicas[self.replica][0]
+
+    @property
+    def port(self):
+        return self.replicas[self.replica][1]
+
+    def connect(self, connect):
+        """Return a connector for the first replica that accepts one and
+           load through that replica
+        :param connect: (function): Called with host and port.  Returns a
+                                    connector or raises if the host is not
+                                    available
+        """
+        error = None
+        for index, (host, port) in enumerate(self.replicas):
+            try:
+                ch = connect(host, port)
+            except Exception as e:
+                logger.warning(
+                    "Replica not available: shard={0}, host={1}, "
+                    "error={2}".format(self.number, host, e))
+                error = e
+                continue
+            self.replica = index
+            return ch
+        raise Exception("No replica of shard {0} is available: {1}".format(
+            self.number, error))
+
+    def name(self):
+        """Return host:port of the replica that loads"""
+        if self.port is None:
+            return self.host
+        return "{0}:{1}".format(self.host, self.port)
+
+
+def discover(ch, cluster):
+    """Return shards of a cluster configured on a server
+    :param ch: (ClickHouse): Connector for a host of the cluster
+    :param cluster: (str): Cluster name in system.clusters
+    :return: List of Shard instances ordered by shard number
+    """
+    result = ch.fetch_cluster(cluster)
+    if not result:
+        raise Exception("Cluster not found: {0}".format(cluster))
+    shards = []
+    for number, weight, host, port in result:
+        if not shards or shards[-1].number != number:
+            shards.append(Shard(number, [], weight))
+        shards[-1].replicas.append((host, port))
+    return shards
+
+
+def parse_hosts(hosts, default_port=None):
+    """Return a shard with one replica for each host
+    :param hosts: (list): host or host:port strings.  IPv6 addresses with
+                          a port must be in brackets
+    :param default_port: (int): Port of hosts without one
+    """
+    shards = []
+    for number, value in enumerate(hosts, 1):
+        host, port = value, default_port
+        if value.startswith('['):
+            host, _, rest = value[1:].partition(']')
+            if rest.startswith(':'):
+                port = int(rest[1:])
+        elif value.count(':') == 1:
+            host, port = value.split(':')
+            port = int(port)
+        shards.append(Shard(number, [(host, port)]))
+    return shards
+
+
+def assign(load_files, shards):
+    """Spread files over shards so that each gets bytes in proportion to its
+       weight.  Files are taken in order, which puts big files first
+    :param load_files: (list): tuple(table, FileSplit) in execution order
+    :param shards: (list): Shard instances
+    :return: List of tuple(Shard, list of tuple(table, FileSplit))
+    """
+    assigned = [[] for _ in shards]
+    loaded = [0] * len(shards)
+    for table, split in load_files:
+        size = split.size() or 0
+        index = min(
+            range(len(shards)),
+            key=lambda i: ((loaded[i] + size) / shards[i].weight, i))
+        assigned[index].append((table, split))
+        loaded[index] += size
+    return list(zip(shards, assigned))
+
+
+class ShardedConnector:
+    """Connector for a load into several shards.  Queries run on the host
+       the load connected to first, and the connectors of each shard load
+       data.  DDL runs ON CLUSTER for a named cluster or on every shard
+       for a list of hosts"""
+
+    def __init__(self, ch, shard_connectors, cluster=None):
+        """Combine connectors
+        :param ch: (ClickHouse): Connector for the first host
+        :param shard_connectors: (list): tuple(Shard, ClickHouse)
+        :param cluster: (str): Cluster name or None for a list of hosts
+        """
+        self.ch = ch
+        self.shards = shard_connectors
+        self.cluster = cluster
+
+    def __getattr__(self, name):
+        return getattr(self.ch, name)
+
+    def ddl_connector(self):
+        """Return a connector that runs statements on all shards"""
+        return DdlConnector(self)
+
+    def execute_ddl(self, sql, verbose=False, dry_run=False):
+        """Run a DDL statement on all shards"""
+        if self.cluster is not None:
+            return self.ch.execute(ddl.on_cluster(sql, self.cluster),
+                                   verbose, dry_run)
+        for _, shard_ch in self.shards:
+            shard_ch.execute(sql, verbose, dry_run)
+
+    def close(self):
+        for _, shard_ch in self.shards:
+            if shard_ch is not self.ch:
+                shard_ch.close()
+        self.ch.close()
+
+
+class DdlConnector:
+    """Passes DDL statements of a DdlRunner to all shards"""
+
+    def __init__(self, sharded):
+        self.sharded = sharded
+
+    def execute(self, sql, verbose=False, dry_run=False):
+        return self.sharded.execute_ddl(sql, verbose, dry_run)
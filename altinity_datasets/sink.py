@@ -0,0 +1,111 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import os
+import re
+
+from altinity_datasets import bench
+from altinity_datasets import clickhouse
+"""Connector that stands in for a ClickHouse server in benchmarks.  It
+   implements the methods of the ClickHouse connector that loads and dumps
+   call, answering from the benchmark spec, so it does not depend on the
+   SQL those methods run.  Methods it does not implement fail rather than
+   connect to a server"""
+
+
+class SinkConnector(clickhouse.ClickHouse):
+    """Accepts statements and inserts and returns metadata of the synthetic
+       tables of a benchmark spec"""
+
+    # BenchSpec of the dataset, set while the sink is active.
+    spec = None
+
+    def execute(self, sql, verbose=False, dry_run=False):
+        """Accept DDL and other statements without results"""
+        return []
+
+    def insert_blocks(self, table_name, blocks, settings=None):
+        return sum(len(columns[0]) if columns else 0
+                   for _, columns in blocks)
+
+    def insert_select(self, sql):
+        return None
+
+    def fetch_tables(self, table_regex=None):
+        tables = []
+        for name in self.spec.table_names():
+            if table_regex is not None and not re.search(table_regex, name):
+                continue
+            table = clickhouse.TableData(self.database, name, 'toYYYYMM(ts)',
+                                         'id')
+            table.create_table = bench.create_table_sql(name)
+            table.total_rows = self.spec.table_rows()
+            table.total_bytes = self.spec.table_rows() * self.spec.row_width
+            tables.append(table)
+        return tables
+
+    def fetch_server_resources(self):
+        return {
+            'memory': 16 * 1024**3,
+            'cores': 8,
+            'max_memory_usage': None
+        }
+
+    def fetch_all_partition_data(self, tables):
+        """Return one partition per month with rows from the spec"""
+        partitions = [
+            clickhouse.PartitionData(partition_id, partition_id, rows,
+                                     rows * self.spec.row_width, 1, 1, 0)
+            for partition_id, rows in sorted(
+                self.spec.partition_rows().items())
+        ]
+        return {table.name: list(partitions) for table in tables}
+
+    def fetch_key_values(self, table, key, partition_id, count):
+        # Partitions are not split by key in the sink.
+        return []
+
+    def count_rows(self, table):
+        return self.spec.table_rows()
+
+    def fetch_query_rows(self, query_ids, timeout=None):
+        """Return rows that the fake clickhouse-client logged"""
+        rows = {}
+        log_path = os.environ[bench.SINK_QUERY_LOG_ENV]
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                for line in f:
+                    query_id, written, result = line.split()
+                    if query_id in query_ids:
+                        rows[query_id] = (int(written), int(result))
+        return rows
+
+    def fetch_columns(self, table_name):
+        return list(bench.COLUMNS)
+
+    def fetch_engine(self, table_name):
+        return ('MergeTree',
+                'MergeTree PARTITION BY toYYYYMM(ts) ORDER BY id')
+
+    def fetch_table_names(self, prefix):
+        return []
+
+    def fetch_partition_ids(self, table_names):
+        # Every staging table holds every partition.
+        return [(name, partition_id) for name in table_names
+                for partition_id in sorted(self.spec.partition_rows())]
+
+    def fetch_cluster(self, cluster):
+        # Two shards with one replica on local ports.
+        return [(1, 1, 'localhost', 9000), (2, 1, 'localhost', 9001)]
+
+    def _get_wrapped_connection(self):
+        raise Exception("Sink connector has no server connection")
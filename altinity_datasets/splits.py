@@ -0,0 +1,422 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import argparse
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import logging
+import lzma
+import os
+import shlex
+import shutil
+import sys
+import threading
+
+from altinity_datasets import formats
+"""Splits CSVWithNames data files into byte ranges that can be loaded in
+   parallel.  Plain files split at line boundaries.  Compressed files split
+   at frame boundaries if they were written as seekable multi-frame files
+   with a frame index."""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Suffix of the frame index written next to seekable compressed files.
+INDEX_SUFFIX = '.idx'
+
+# Default amount of uncompressed data in each frame of a seekable file.
+DEFAULT_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FileSplit:
+    """A data file or a range of a CSVWithNames file that loads as a
+       separate operation"""
+
+    def __init__(self,
+                 path,
+                 start=0,
+                 length=None,
+                 header=None,
+                 format='CSVWithNames',
+                 compression=None,
+                 index=0,
+                 count=1,
+                 file_size=None,
+                 ready=None,
+                 release=None):
+        """Define a split. A split with no length covers the whole file
+        :param path: (str): Data file path
+        :param start: (int): Offset of the range in the file
+        :param length: (int): Bytes in the range or None for the whole file
+        :param header: (str): CSV header line to prepend to the range
+        :param format: (str): ClickHouse format of the data
+        :param compression: (str): Codec of the whole file or None
+        :param index: (int): Number of this split within the file
+        :param count: (int): Number of splits for the file
+        :param file_size: (int): Size of a file that may not be fetched yet
+        :param ready: (function): Called by wait() to fetch the file
+        :param release: (function): Called by finish() to release a fetched
+                                    file
+        """
+        self.path = path
+        self.start = start
+        self.length = length
+        self.header = header
+        self.format = format
+        self.compression = compression
+        self.index = index
+        self.count = count
+        self.file_size = file_size
+        self.ready = ready
+        self.release = release
+
+    def size(self):
+        """Return bytes read from disk for this split"""
+        if self.length is not None:
+            return self.length
+        elif self.file_size is not None:
+            return self.file_size
+        return os.path.getsize(self.path)
+
+    def wait(self):
+        """Wait until the file is present, which it may not be yet for
+           remote datasets"""
+        if self.ready is not None:
+            self.ready()
+
+    def finish(self):
+        """Release the file once the load of the split has finished,
+           whether or not it succeeded"""
+        if self.release is not None:
+            self.release()
+
+    def name(self):
+        """Return a display name for the split"""
+        name = os.path.basename(self.path)
+        if self.count > 1:
+            name += "[{0}/{1}]".format(self.index + 1, self.count)
+        return name
+
+    def is_csv(self):
+        """Return True if the split can be read as CSV text by cat_command
+           and lines"""
+        if self.format != 'CSVWithNames':
+            return False
+        elif self.length is not None:
+            return True
+        return self.compression in (None, 'gzip')
+
+    def cat_command(self):
+        """Return a shell command that writes the split as CSVWithNames"""
+        path = shlex.quote(self.path)
+        if self.length is None:
+            if self.compression == 'gzip':
+                return "gzip -d -c {0}".format(path)
+            return "cat {0}".format(path)
+        cmd = "tail -c +{0} {1} | head -c {2}".format(self.start + 1, path,
+                                                      self.length)
+        if self.compression == 'gzip':
+            cmd += " | gzip -d -c"
+        elif self.compression is not None:
+            cmd += " | " + decompress_command(self.compression)
+        return "{{ printf '%s\\n' {0}; {1}; }}".format(
+            shlex.quote(self.header), cmd)
+
+    def lines(self):
+        """Generate text lines of the split starting with the header"""
+        with open(self.path, 'rb') as f:
+            if self.length is None:
+                raw = f
+            else:
+                yield self.header + '\n'
+                raw = _BoundedReader(f, self.start, self.length)
+            if self.compression is not None:
+                stream = _decompressing_reader(raw, self.compression)
+            else:
+                stream = io.BufferedReader(raw) if raw is not f else f
+            for line in io.TextIOWrapper(stream, encoding='utf-8',
+                                         newline=''):
+                yield line
+
+
+class _BoundedReader(io.RawIOBase):
+    """Reads a byte range of an open file"""
+
+    def __init__(self, f, start, length):
+        self.f = f
+        self.remaining = length
+        f.seek(start)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.f.read(size)
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def plan_splits(path, split_size=None, format=None, compression=None):
+    """Divide a data file into splits of roughly split_size bytes.  Only
+       CSV files can be split; other formats load as a single unit
+    :param path: (str): Path of a data file
+    :param split_size: (int): Target bytes per split or None to disable
+    :param format: (str): Format from formats.classify or None to detect
+                          format and compression from the extension
+    :param compression: (str): Compression from formats.classify
+    :return: List of FileSplit instances
+    """
+    if format is None:
+        format, compression = formats.detect(path)
+    if split_size and os.path.getsize(path) > split_size:
+        if format == 'CSVWithNames' and compression is None:
+            return _csv_splits(path, split_size)
+        index = read_index(path)
+        if format == 'CSVWithNames' and index is not None:
+            return _frame_splits(path, index, split_size)
+        logger.info("Not splittable, loading as one unit: {0}".format(path))
+    return [FileSplit(path, format=format, compression=compression)]
+
+
+def _csv_splits(path, split_size):
+    """Split a plain CSV file at line boundaries after the header.  Quoted
+       values that contain line breaks are not supported"""
+    ranges = []
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        while start < file_size:
+            f.seek(min(start + split_size, file_size))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end - start))
+            start = end
+    header = header.decode('utf-8').rstrip('\r\n')
+    return [
+        FileSplit(path, start, length, header, index=i, count=len(ranges))
+        for i, (start, length) in enumerate(ranges)
+    ]
+
+
+def _frame_splits(path, index, split_size):
+    """Group consecutive frames of a seekable file into splits"""
+    ranges = []
+    for offset, length in index['frames']:
+        if ranges and ranges[-1][1] + length <= split_size:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    file_splits = []
+    for i, (start, length) in enumerate(ranges):
+        file_splits.append(
+            FileSplit(path,
+                      start,
+                      length,
+                      index['header'],
+                      compression=index['format'],
+                      index=i,
+                      count=len(ranges)))
+    return file_splits
+
+
+def read_index(path):
+    """Return the frame index of a seekable file or None if missing"""
+    index_path = path + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def compressor(codec, level=None):
+    """Return function that compresses bytes to one complete frame
+    :param codec: (str): gzip, zstd or lz4.  zstd and lz4 require the
+                         zstandard and lz4 packages
+    :param level: (int): Compression level or None for the codec default
+    """
+    if codec == 'gzip':
+        level = 6 if level is None else level
+        return lambda data: gzip.compress(data, compresslevel=level)
+    elif codec == 'zstd':
+        import zstandard
+        level = 3 if level is None else level
+        local = threading.local()
+
+        def compress(data):
+            # Compressors are not thread safe, so each thread has its own.
+            if not hasattr(local, 'compressor'):
+                local.compressor = zstandard.ZstdCompressor(
+                    level=level, write_content_size=True)
+            return local.compressor.compress(data)
+
+        return compress
+    elif codec == 'lz4':
+        import lz4.frame
+        return lambda data: lz4.frame.compress(
+            data, compression_level=0 if level is None else level)
+    raise Exception("Unknown compression codec: {0}".format(codec))
+
+
+def _decompressing_reader(raw, codec):
+    """Return binary stream that decompresses concatenated frames"""
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=raw)
+    elif codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(
+            raw, read_across_frames=True)
+    elif codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(raw)
+    elif codec == 'xz':
+        return lzma.LZMAFile(raw)
+    elif codec == 'bz2':
+        return bz2.BZ2File(raw)
+    raise Exception("Unknown compression codec: {0}".format(codec))
+
+
+def write_seekable(fin,
+                   path,
+                   frame_size=DEFAULT_FRAME_SIZE,
+                   codec='gzip',
+                   level=None,
+                   threads=1):
+    """Compress CSVWithNames data to a multi-frame file with an index
+
+    Each frame is complete for its codec and ends on a line boundary, so
+    the file is still readable by ordinary decompressors.  Frames compress
+    on a pool of threads, since the codecs release the GIL, and are written
+    in order.  The header line gets a frame of its own and is also kept in
+    the index.
+    :param fin: Binary input stream
+    :param path: (str): Output file path
+    :param frame_size: (int): Uncompressed bytes per frame
+    :param codec: (str): gzip, zstd or lz4
+    :param level: (int): Compression level or None for the codec default
+    :param threads: (int): Number of threads that compress frames
+    :return: Frame index, which includes bytes_in and bytes_out totals
+    """
+    compress = compressor(codec, level)
+    frames = []
+    bytes_in = 0
+    pending_frames = collections.deque()
+    with open(path, 'wb') as fout, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+
+        def write_frames(limit):
+            while len(pending_frames) > limit:
+                compressed = pending_frames.popleft().result()
+                frames.append((fout.tell(), len(compressed)))
+                fout.write(compressed)
+
+        def submit(data):
+            pending_frames.append(pool.submit(compress, data))
+            # Bound memory by waiting for the oldest frames.
+            write_frames(threads * 2)
+
+        header = fin.readline()
+        bytes_in += len(header)
+        submit(header)
+        pending = b''
+        while True:
+            chunk = fin.read(frame_size)
+            if not chunk:
+                break
+            bytes_in += len(chunk)
+            pending += chunk
+            cut = pending.rfind(b'\n') + 1
+            if cut > 0 and len(pending) >= frame_size:
+                submit(pending[:cut])
+                pending = pending[cut:]
+        if pending:
+            submit(pending)
+        write_frames(0)
+        bytes_out = fout.tell()
+
+    index = {
+        'format': codec,
+        'header': header.decode('utf-8').rstrip('\r\n'),
+        'frames': frames[1:],
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out
+    }
+    with open(path + INDEX_SUFFIX, 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def seekable_command(path,
+                     frame_size=DEFAULT_FRAME_SIZE,
+                     codec='gzip',
+                     level=None,
+                     threads=1):
+    """Return shell command that writes stdin to a seekable file"""
+    cmd = "{0} -m altinity_datasets.splits compress {1}".format(
+        shlex.quote(sys.executable), shlex.quote(path))
+    cmd += " --frame-size={0} --codec={1} --threads={2}".format(
+        frame_size, codec, threads)
+    if level is not None:
+        cmd += " --level={0}".format(level)
+    return cmd
+
+
+def decompress_command(codec):
+    """Return shell command that decompresses stdin to stdout"""
+    return "{0} -m altinity_datasets.splits decompress {1}".format(
+        shlex.quote(sys.executable), codec)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write and read seekable multi-frame compressed files')
+    commands = parser.add_subparsers(dest='command')
+    compress = commands.add_parser('compress',
+                                   help='Write stdin to a seekable file')
+    compress.add_argument('path', help='Output file')
+    compress.add_argument('--frame-size',
+                          type=int,
+                          default=DEFAULT_FRAME_SIZE,
+                          help='Uncompressed bytes per frame')
+    compress.add_argument('--codec',
+                          default='gzip',
+                          choices=['gzip', 'zstd', 'lz4'],
+                          help='Compression codec')
+    compress.add_argument('--level', type=int, help='Compression level')
+    compress.add_argument('--threads',
+                          type=int,
+                          default=1,
+                          help='Threads that compress frames')
+    decompress = commands.add_parser('decompress',
+                                     help='Decompress stdin to stdout')
+    decompress.add_argument('codec',
+                            choices=['gzip', 'zstd', 'lz4', 'xz', 'bz2'])
+    args = parser.parse_args()
+    if args.command == 'compress':
+        write_seekable(sys.stdin.buffer, args.path, args.frame_size,
+                       args.codec, args.level, args.threads)
+    elif args.command == 'decompress':
+        reader = _decompressing_reader(sys.stdin.buffer, args.codec)
+        shutil.copyfileobj(reader, sys.stdout.buffer)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
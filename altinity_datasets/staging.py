@@ -0,0 +1,348 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import collections
+import logging
+import re
+import threading
+import time
+
+from altinity_datasets import clickhouse
+"""Staged loads insert data files into staging tables with the structure of
+   each target table.  Once all files of a table have loaded, each of its
+   partitions replaces the target partition in one ALTER, so readers never
+   see a partly loaded partition and parallel inserts do not pile up parts
+   in the target.  Staging tables of a table with failed files or that
+   fails to publish are kept, and the files they hold are journaled, so
+   that a resumed load only loads the remaining files before publishing"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Prefix of staging table names.  Names starting with a dot are not
+# dumped.
+STAGING_PREFIX = '.staging_'
+
+# Attempts of each partition move before a table fails to publish.
+PUBLISH_ATTEMPTS = 3
+
+# Seconds to wait before retrying a partition move, times the attempt.
+PUBLISH_RETRY_DELAY = 1.0
+
+# Arguments of replicated engines up to the first engine parameter.
+_REPLICATED_ENGINE = re.compile(
+    r"^Replicated(\w*MergeTree)\(\s*'(?:[^'\\]|\\.)*'\s*,"
+    r"\s*'(?:[^'\\]|\\.)*'\s*,?\s*")
+
+
+def staging_engine(engine_full):
+    """Return the engine clause of a staging table.  Replicated engines
+       become local ones, since staging tables have no replicas
+    :param engine_full: (str): engine_full of the target in system.tables
+    """
+    return _REPLICATED_ENGINE.sub(r'\1(', engine_full)
+
+
+def check_published(kept):
+    """Raise if tables failed to publish
+    :param kept: (list): Tables whose staging tables were kept
+    """
+    if kept:
+        raise Exception(
+            "Tables failed to publish, staging tables are kept for a "
+            "resumed load or dataset publish: {0}".format(
+                ", ".join(sorted(set(kept)))))
+
+
+def _fetch_leftover(ch):
+    """Return staging tables in the database of a connector
+    :return: OrderedDict of table name to staging table names in slot
+             order
+    """
+    slots = []
+    for name in ch.fetch_table_names(STAGING_PREFIX):
+        table, _, slot = name[len(STAGING_PREFIX):].rpartition('_')
+        if table and slot.isdigit():
+            slots.append((table, int(slot), name))
+    leftover = collections.OrderedDict()
+    for table, _, name in sorted(slots):
+        leftover.setdefault(table, []).append(name)
+    return leftover
+
+
+def _identifier(name):
+    return "`{0}`".format(name.replace('`', '\\`'))
+
+
+class StagingTables:
+    """Staging tables of a load.  Each table's files are spread over up to
+       slots staging tables in load order.  Loaders record completed files
+       here in place of the load journal, which receives them when their
+       table publishes"""
+
+    def __init__(self, ch, load_files, slots, load_journal=None,
+                 dry_run=False, progress_reporter=None):
+        """Assign files to staging tables
+        :param ch: (ClickHouse): Connector for the load database
+        :param load_files: (list): tuple(table, FileSplit) in load order
+        :param slots: (int): Staging tables per target table
+        :param load_journal: (LoadJournal): Journal of published files
+        :param dry_run: (boolean): If True log statements only
+        :param progress_reporter: (function): Called with progress messages
+        """
+        self.ch = ch
+        self.load_journal = load_journal
+        self.loaded = collections.defaultdict(list)
+        self.dry_run = dry_run
+        self.progress_reporter = progress_reporter
+        self.staging = collections.OrderedDict()
+        self.targets = {}
+        counts = collections.Counter()
+        for table, split in load_files:
+            name = "{0}{1}_{2}".format(STAGING_PREFIX, table,
+                                       counts[table] % max(1, slots))
+            counts[table] += 1
+            names = self.staging.setdefault(table, [])
+            if name not in names:
+                names.append(name)
+            self.targets[(table, split.name())] = name
+        self.created = set()
+        self.kept = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def leftover(cls, ch, dry_run=False, progress_reporter=None):
+        """Return staging tables that an earlier load kept in the database
+           of a connector because their tables failed to publish
+        :param ch: (ClickHouse): Connector for the load database
+        :param dry_run: (boolean): If True log statements only
+        :param progress_reporter: (function): Called with progress messages
+        """
+        staged = cls(ch, [], 1, dry_run=dry_run,
+                     progress_reporter=progress_reporter)
+        for table, names in _fetch_leftover(ch).items():
+            staged.staging[table] = names
+            staged.created.add(table)
+        return staged
+
+    def adopt_leftover(self, resume):
+        """Check for staging tables that an earlier load left in the
+           database.  A resumed load loads the remaining files of their
+           tables into them and publishes them.  Other loads refuse to run
+           rather than drop tables kept for a retry
+        :param resume: (boolean): If True the load resumes from the journal
+        """
+        leftover = _fetch_leftover(self.ch)
+        if leftover and not resume:
+            raise Exception(
+                "Staging tables of an earlier load are left, resume the "
+                "load, publish them with dataset publish or load with "
+                "--clean: {0}".format(", ".join(leftover)))
+        elif not resume:
+            return
+        staged_tables = self.load_journal.tables(True)
+        published_tables = self.load_journal.tables(False)
+        for table in self.staging:
+            if table in leftover:
+                continue
+            elif table in staged_tables:
+                raise Exception(
+                    "Staging tables of journaled files are gone, load "
+                    "without --resume: {0}".format(table))
+            elif table in published_tables:
+                # Replacing partitions would drop rows of published files.
+                raise Exception(
+                    "Cannot resume a staged load of a table with published "
+                    "files, load without --resume: {0}".format(table))
+        for table, names in leftover.items():
+            if table not in staged_tables:
+                raise Exception(
+                    "Staging tables are not in the load journal, load with "
+                    "--clean: {0}".format(table))
+            self._progress(
+                "Resuming staging tables: table={0}, tables={1}".format(
+                    table, len(names)))
+            # Remaining files load into the kept staging tables.
+            remaining = [key for key in self.targets if key[0] == table]
+            for i, key in enumerate(remaining):
+                self.targets[key] = names[i % len(names)]
+            self.staging[table] = names
+            self.created.add(table)
+            # Kept until they publish.
+            self.kept.add(table)
+
+    def insert_table(self, table, split):
+        """Return the quoted staging table that a split loads into"""
+        return _identifier(self.targets[(table, split.name())])
+
+    def record(self, table, split, rows=None):
+        """Hold a journal entry for a split until its table publishes"""
+        with self._lock:
+            self.loaded[table].append((split, rows))
+
+    def create(self, table):
+        """Create the staging tables of a table after the table itself.
+           Creating fails if a staging table exists, since it may hold data
+           kept for a retry"""
+        with self._lock:
+            if table in self.created:
+                return
+            self.created.add(table)
+        engine = ""
+        if not self.dry_run:
+            engine_full = self._engine(table)[1]
+            if engine_full.startswith('Replicated'):
+                engine = " ENGINE = " + staging_engine(engine_full)
+        for name in self.staging[table]:
+            self._progress("Creating staging table: {0}".format(name))
+            self._execute("CREATE TABLE {0} AS {1}{2}".format(
+                _identifier(name), table, engine))
+
+    def publish_all(self, load_report):
+        """Publish tables whose files all loaded.  Publishing is recorded as
+           an operation of each table in the load report.  Staging tables of
+           tables with failed files or that fail to publish are kept for a
+           retry
+        :return: List of tables that failed to publish
+        """
+        failed = set(op.table for op in load_report.operations
+                     if op.status == 'failed')
+        for table in list(self.staging):
+            if table not in self.created:
+                continue
+            elif table in failed:
+                self._progress(
+                    "Not publishing table with failed loads, keeping "
+                    "staging tables: {0}".format(table))
+                self._keep(table)
+                continue
+            stats = load_report.add(table, 'publish')
+            start = time.monotonic()
+            try:
+                self.publish(table)
+            except Exception as e:
+                stats.record('failed', start, time.monotonic() - start,
+                             start)
+                self._keep(table)
+                self._progress(
+                    "Publish failed, keeping staging tables: table={0}, "
+                    "error={1}".format(table, e))
+                continue
+            stats.record('skipped' if self.dry_run else 'succeeded', start,
+                         time.monotonic() - start, start)
+            self.kept.discard(table)
+            self.drop(table)
+            if self.load_journal is not None:
+                for split, rows in self.loaded.pop(table, []):
+                    self.load_journal.record(table, split, rows)
+                if not self.dry_run:
+                    self.load_journal.publish(table)
+        return sorted(self.kept)
+
+    def publish(self, table):
+        """Move staged data into a table.  MergeTree partitions are gathered
+           in the first staging table that has them and replace the target
+           partition.  Rows of other engines are copied with one INSERT
+           SELECT per staging table"""
+        names = self.staging[table]
+        if self.dry_run:
+            for name in names:
+                self._execute(
+                    "ALTER TABLE {0} REPLACE PARTITION ... FROM {1}".format(
+                        table, _identifier(name)))
+            return
+        if not self._engine(table)[0].endswith('MergeTree'):
+            for name in names:
+                self._progress("Copying staged rows: {0} -> {1}".format(
+                    name, table))
+                # A retry could copy rows twice.
+                self._execute("INSERT INTO {0} SELECT * FROM {1}".format(
+                    table, _identifier(name)))
+            return
+
+        # Partitions of all staging tables in slot order.
+        partitions = collections.OrderedDict()
+        for name, partition_id in self._partitions(names):
+            partitions.setdefault(partition_id, []).append(name)
+        for partition_id, sources in partitions.items():
+            self._progress("Publishing partition: table={0}, "
+                           "partition={1}".format(table, partition_id))
+            first = _identifier(sources[0])
+            for other in sources[1:]:
+                # Moving leaves nothing behind, so a retry cannot duplicate
+                # rows.
+                self._retry(
+                    "ALTER TABLE {0} MOVE PARTITION ID {1} TO TABLE "
+                    "{2}".format(_identifier(other),
+                                 clickhouse.quote(partition_id), first))
+            self._retry("ALTER TABLE {0} REPLACE PARTITION ID {1} FROM "
+                        "{2}".format(table, clickhouse.quote(partition_id),
+                                     first))
+
+    def drop(self, table):
+        """Drop the staging tables of a table"""
+        for name in self.staging[table]:
+            self._execute("DROP TABLE IF EXISTS {0}".format(
+                _identifier(name)))
+
+    def close(self):
+        """Drop staging tables left by tables that did not publish, except
+           those kept for a retry"""
+        for table in self.created - self.kept:
+            try:
+                self.drop(table)
+            except Exception as e:
+                logger.warning("Unable to drop staging tables of {0}: "
+                               "{1}".format(table, e))
+
+    def _keep(self, table):
+        """Keep the staging tables of a table and journal the files they
+           hold, so that a resumed load does not load them again"""
+        self.kept.add(table)
+        if self.load_journal is not None:
+            for split, rows in self.loaded.pop(table, []):
+                self.load_journal.record(table, split, rows, staged=True)
+
+    def _engine(self, table):
+        """Return tuple(engine, engine_full) of a table"""
+        result = self.ch.fetch_engine(table)
+        if result is None:
+            raise Exception("Table not found: {0}".format(table))
+        return result
+
+    def _partitions(self, names):
+        """Return tuple(staging table, partition ID) with active parts in
+           slot order"""
+        result = self.ch.fetch_partition_ids(names)
+        return sorted(result,
+                      key=lambda row: (row[1], names.index(row[0])))
+
+    def _retry(self, sql):
+        """Execute a statement, retrying failures"""
+        for attempt in range(1, PUBLISH_ATTEMPTS + 1):
+            try:
+                return self._execute(sql)
+            except Exception as e:
+                if attempt == PUBLISH_ATTEMPTS:
+                    raise
+                logger.warning("Retrying after error: {0}".format(e))
+                time.sleep(PUBLISH_RETRY_DELAY * attempt)
+
+    def _execute(self, sql):
+        if self.dry_run:
+            logger.info("Dry run: {0}".format(sql))
+            return None
+        return self.ch.execute(sql)
+
+    def _progress(self, message):
+        logger.info(message)
+        if self.progress_reporter is not None:
+            self.progress_reporter(message)
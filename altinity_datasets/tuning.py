@@ -0,0 +1,133 @@
+# Copyright (c) 2019 Altinity LTD
+#
+# This product is licensed to you under the
+# Apache License, Version 2.0 (the "License").
+# You may not use this product except in compliance with the License.
+#
+# This product may include a number of subcomponents with
+# separate copyright notices and license terms. Your use of the source
+# code for the these subcomponents is subject to the terms and
+# conditions of the subcomponent's license, as noted in the LICENSE file.
+
+import logging
+import shlex
+"""Settings applied to the inserts of a load.  Manifests may set query
+   settings for all tables or for individual tables.  The auto profile
+   sizes insert blocks and threads from the server's memory and CPU count
+   so that large loads create few parts"""
+
+# Define logger
+logger = logging.getLogger(__name__)
+
+# Settings profiles.  'manifest' applies settings from the manifest,
+# 'auto' adds settings computed from server resources underneath them and
+# 'none' applies only settings given by the caller.
+PROFILES = ('manifest', 'auto', 'none')
+
+# Manifest settings key for all tables.
+ALL_TABLES = '*'
+
+# Share of server memory that parallel inserts may use for blocks.
+AUTO_MEMORY_FRACTION = 0.5
+
+# Share of max_memory_usage that one insert may use for blocks.
+AUTO_QUERY_MEMORY_FRACTION = 0.8
+
+# Bounds of min_insert_block_size_bytes chosen by the auto profile.
+AUTO_MIN_BLOCK_BYTES = 64 * 1024 * 1024
+AUTO_MAX_BLOCK_BYTES = 4 * 1024 * 1024 * 1024
+
+# Rows per block for the auto profile.  Bytes usually limit blocks first.
+AUTO_BLOCK_ROWS = 33554432
+
+
+def manifest_settings(manifest):
+    """Return settings from a manifest keyed by table, or '*' for all
+       tables.  Raises if the settings are malformed
+    :param manifest: (dict): Dataset manifest
+    """
+    settings = manifest.get('settings') or {}
+    if not isinstance(settings, dict):
+        raise Exception("Manifest settings must map tables to settings")
+    for table, values in settings.items():
+        if not isinstance(values, dict):
+            raise Exception(
+                "Manifest settings of {0} must map names to values".format(
+                    table))
+    return settings
+
+
+def auto_settings(resources, parallel):
+    """Return insert settings sized for server resources.  Each of the
+       parallel inserts gets an equal share of the cores and of half the
+       memory for blocks being squashed by its insert threads
+    :param resources: (dict): memory, cores and max_memory_usage from
+                              ClickHouse.fetch_server_resources
+    :param parallel: (int): Inserts running at once
+    """
+    parallel = max(1, parallel)
+    threads = max(1, (resources.get('cores') or 1) // parallel)
+    # Use the smallest blocks if memory is unknown.
+    budget = AUTO_MIN_BLOCK_BYTES * threads
+    if resources.get('memory'):
+        budget = resources['memory'] * AUTO_MEMORY_FRACTION / parallel
+    query_limit = resources.get('max_memory_usage')
+    if query_limit:
+        budget = min(budget, query_limit * AUTO_QUERY_MEMORY_FRACTION)
+    block_bytes = int(
+        min(max(budget / threads, AUTO_MIN_BLOCK_BYTES), AUTO_MAX_BLOCK_BYTES))
+    return {
+        'max_insert_threads': threads,
+        'min_insert_block_size_bytes': block_bytes,
+        'min_insert_block_size_rows': AUTO_BLOCK_ROWS,
+        'max_insert_block_size': AUTO_BLOCK_ROWS,
+    }
+
+
+class LoadSettings:
+    """Settings of each table's inserts.  Later layers override earlier
+       ones: defaults of the load method, auto settings, manifest settings
+       for all tables, manifest settings for the table and caller
+       overrides"""
+
+    def __init__(self,
+                 manifest=None,
+                 profile='manifest',
+                 auto=None,
+                 overrides=None,
+                 defaults=None):
+        """Merge settings
+        :param manifest: (dict): Dataset manifest
+        :param profile: (str): One of PROFILES
+        :param auto: (dict): Settings from auto_settings for 'auto' profile
+        :param overrides: (dict): Settings from the caller
+        :param defaults: (dict): Defaults of the load method
+        """
+        if profile not in PROFILES:
+            raise Exception("Unknown settings profile: {0}".format(profile))
+        self.tables = {}
+        self.common = {}
+        if profile != 'none':
+            self.common.update(defaults or {})
+            if profile == 'auto':
+                self.common.update(auto or {})
+            self.tables = dict(manifest_settings(manifest or {}))
+            self.common.update(self.tables.pop(ALL_TABLES, {}))
+        self.overrides = dict(overrides or {})
+
+    def table(self, name):
+        """Return settings for inserts into a table"""
+        settings = dict(self.common)
+        settings.update(self.tables.get(name, {}))
+        settings.update(self.overrides)
+        return settings
+
+
+def client_options(settings):
+    """Return clickhouse-client options that apply settings"""
+    options = []
+    for name, value in sorted(settings.items()):
+        if isinstance(value, bool):
+            value = int(value)
+        options.append(" --{0}={1}".format(name, shlex.quote(str(value))))
+    return "".join(options)
@@ -43,11 +43,17 @@ setup(
         "Intended Audience :: Developers",
         "Intended Audience :: System Administrators",
     ],
+    python_requires='>=3.7',
     install_requires=[
         'click>=6.7',
         'clickhouse-driver>=0.0.18',
         'PyYAML>=3.13'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'generate': ['numpy'],
+    },
     packages=find_packages(),
     include_package_data=True,
     entry_points = {
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+"""Tests asyncio jobs without a server"""
+import asyncio
+import functools
+import time
+import unittest
+
+from altinity_datasets import aio
+from altinity_datasets import report
+
+
+def command_job(commands, parallel=2, limit=None):
+    """Return a job that runs shell commands as operations"""
+
+    async def run(job):
+        return await aio._run_operations(job, limit, [
+            (report.OperationStats('t', cmd), "Running: {0}".format(cmd),
+             functools.partial(aio._run_command, cmd, False), None)
+            for cmd in commands
+        ])
+
+    return aio.Job(run, parallel)
+
+
+class AioTest(unittest.TestCase):
+    def test_events(self):
+        """Jobs post events for each operation and return counts"""
+
+        async def main():
+            job = command_job(['true', 'exit 3'])
+            events = [(e.state, e.name) async for e in job]
+            return events, await job
+
+        events, result = asyncio.run(main())
+        self.assertEqual((1, 1), result)
+        self.assertEqual(
+            [('failed', 'exit 3'), ('started', 'exit 3'),
+             ('started', 'true'), ('succeeded', 'true')], sorted(events))
+
+    def test_cancel(self):
+        """Cancelling a job terminates running commands"""
+
+        async def main():
+            job = command_job(['sleep 30'])
+            states = []
+            async for event in job:
+                states.append(event.state)
+                if event.state == 'started':
+                    # Let the process start before cancelling.
+                    await asyncio.sleep(0.2)
+                    job.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await job
+            return states
+
+        start = time.monotonic()
+        self.assertEqual(['started', 'cancelled'], asyncio.run(main()))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_shared_limit(self):
+        """A shared semaphore limits operations across jobs"""
+        running = [0, 0]
+
+        async def operation():
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            return 0
+
+        def job(limit):
+            async def run(job):
+                return await aio._run_operations(job, limit, [
+                    (report.OperationStats('t', str(i)), 'op', operation,
+                     None) for i in range(4)
+                ])
+
+            return aio.Job(run, 4)
+
+        async def main():
+            limit = asyncio.Semaphore(3)
+            return await asyncio.gather(job(limit), job(limit))
+
+        self.assertEqual([(4, 0), (4, 0)], asyncio.run(main()))
+        self.assertEqual(3, running[1])
+
+    def test_bind_options(self):
+        """Options are checked against the blocking api"""
+        args = aio._bind(aio.api.dataset_load, 'iris', {'parallel': 3})
+        self.assertEqual(3, args['parallel'])
+        self.assertEqual('client', args['loader'])
+        with self.assertRaises(TypeError):
+            aio._bind(aio.api.dataset_load, 'iris', {'paralel': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
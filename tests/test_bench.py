@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+"""Tests benchmarks against the sink"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import bench
+from altinity_datasets import clickhouse
+
+
+class BenchTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.results = os.path.join(self.workdir, 'results.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_partition_rows(self):
+        """Partitions divide table rows evenly"""
+        spec = bench.BenchSpec(files=1, file_size=500, row_width=50,
+                               partitions=3)
+        self.assertEqual({'201901': 4, '201902': 3, '201903': 3},
+                         spec.partition_rows())
+
+    def test_run_peak_rss(self):
+        """Peaks reached before a run are not reported as the run's"""
+        self.assertEqual({'peak_rss_kb': 200, 'peak_child_rss_kb': None},
+                         bench._run_peak_rss(
+                             {'peak_rss_kb': 100, 'peak_child_rss_kb': 50},
+                             {'peak_rss_kb': 200, 'peak_child_rss_kb': 50}))
+
+    def test_run_sink(self):
+        """Loads and dumps against the sink succeed and record results"""
+        spec = bench.BenchSpec(tables=1, files=2, file_size=5000,
+                               compression='gzip', partitions=2)
+        for loader in ('native', 'client'):
+            result = bench.run(spec, loader=loader, parallel=2,
+                               results_path=self.results)
+            self.assertEqual(2, result['load']['succeeded'])
+            self.assertEqual(0, result['load']['failed'])
+            self.assertEqual(2, result['dump']['succeeded'])
+            self.assertEqual(spec.table_rows(), result['dump']['rows'])
+        self.assertNotEqual('SinkConnector', clickhouse.ClickHouse.__name__)
+        self.assertNotIn(bench.SINK_SPEC_ENV, os.environ)
+
+        with open(self.results) as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(['native', 'client'],
+                         [r['loader'] for r in results])
+        # Rows of client loads come from the query log.
+        self.assertEqual([spec.table_rows()] * 2,
+                         [r['load']['rows'] for r in results])
+        lines = bench.compare(self.results, ['load.wall_seconds'])
+        self.assertEqual(4, len(lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+"""Tests the cached dataset catalog index"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import catalog
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.dir, 'repo')
+        self.cache = os.path.join(self.dir, 'cache')
+        self._make_dataset('iris', 'title: Iris\n', {'iris': ['iris.csv']})
+        self._make_dataset('wine', 'title: Wine\nupdated: 2019-01-02\n',
+                           {'wine': ['wine.csv.gz', 'part-0', 'README']})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _make_dataset(self, name, manifest, tables):
+        path = os.path.join(self.repo, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'manifest.yaml'), 'w') as f:
+            f.write(manifest)
+        for table, files in tables.items():
+            table_path = os.path.join(path, 'data', table)
+            os.makedirs(table_path)
+            for file_name in files:
+                file_path = os.path.join(table_path, file_name)
+                if file_name == 'README' or (
+                        '.' in file_name and not file_name.endswith('.gz')):
+                    with open(file_path, 'w') as f:
+                        f.write('x\n1\n')
+                else:
+                    with gzip.open(file_path, 'wt') as f:
+                        f.write('x\n1\n')
+
+    def test_index_and_reuse(self):
+        """Index entries are reused until a dataset changes"""
+        entries = catalog.Catalog(self.repo, self.cache).datasets()
+        self.assertEqual(['iris', 'wine'], [e['name'] for e in entries])
+        self.assertEqual('Wine', entries[1]['manifest']['title'])
+        # Files are classified by contents as loads do.  Text without a
+        # data extension is skipped.
+        table_path = os.path.join(self.repo, 'wine', 'data', 'wine')
+        self.assertEqual([{
+            'file': 'part-0',
+            'size': os.path.getsize(os.path.join(table_path, 'part-0')),
+            'container': 'text',
+            'format': 'CSVWithNames',
+            'compression': 'gzip'
+        }, {
+            'file': 'wine.csv.gz',
+            'size': os.path.getsize(os.path.join(table_path, 'wine.csv.gz')),
+            'container': 'text',
+            'format': 'CSVWithNames',
+            'compression': 'gzip'
+        }], entries[1]['tables']['wine'])
+
+        cat = catalog.Catalog(self.repo, self.cache)
+        self.assertEqual(entries, cat.datasets())
+        self.assertEqual([], cat.rebuilt)
+        # Values are the same from the cache as when parsed.
+        self.assertEqual('2019-01-02', entries[1]['manifest']['updated'])
+
+        # Changing a manifest rebuilds only that dataset.
+        manifest = os.path.join(self.repo, 'iris', 'manifest.yaml')
+        with open(manifest, 'w') as f:
+            f.write('title: New iris\n')
+        cat = catalog.Catalog(self.repo, self.cache)
+        self.assertEqual('New iris', cat.get('iris')['manifest']['title'])
+        self.assertEqual(['iris'], cat.rebuilt)
+
+    def test_added_and_removed(self):
+        """New datasets appear and removed ones disappear"""
+        catalog.Catalog(self.repo, self.cache).datasets()
+        self._make_dataset('ontime', 'title: OnTime\n', {})
+        shutil.rmtree(os.path.join(self.repo, 'wine'))
+        cat = catalog.Catalog(self.repo, self.cache)
+        self.assertEqual(['iris', 'ontime'],
+                         [e['name'] for e in cat.datasets()])
+        self.assertIsNone(cat.get('wine'))
+        self.assertIsNone(cat.get('../repo'))
+
+
+if __name__ == '__main__':
+    unittest.main()
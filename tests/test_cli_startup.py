@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+"""Tests that the CLI starts quickly for use in scripts"""
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+# Seconds allowed for a cold `ad-cli --help`.  Override on slow hosts.
+STARTUP_BUDGET = float(os.environ.get('AD_CLI_STARTUP_BUDGET', '0.5'))
+
+# Modules that must not load until a command needs them.
+DEFERRED_MODULES = [
+    'clickhouse_driver', 'yaml', 'pkg_resources', 'altinity_datasets.formats',
+    'altinity_datasets.native_load'
+]
+
+
+class CliStartupTest(unittest.TestCase):
+    def _run(self, *args):
+        return subprocess.run([sys.executable] + list(args),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              check=True)
+
+    def test_deferred_imports(self):
+        """Importing the CLI does not import heavy modules"""
+        result = self._run(
+            '-c', 'import sys, altinity_datasets.ad_cli; '
+            'print(" ".join(sorted(sys.modules)))')
+        loaded = result.stdout.decode('utf-8').split()
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, loaded)
+
+    def test_module_choice(self):
+        """Choices listed in a deferred module are checked and completed"""
+        result = self._run(
+            '-m', 'altinity_datasets.ad_cli', 'dataset', 'dump', '--help')
+        self.assertIn('[gzip|clickhouse|parallel]',
+                      result.stdout.decode('utf-8'))
+        result = subprocess.run(
+            [sys.executable, '-m', 'altinity_datasets.ad_cli', 'dataset',
+             'dump', 'x', '--compressor=zip'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        self.assertEqual(2, result.returncode)
+        self.assertIn("'zip' is not one of", result.stderr.decode('utf-8'))
+
+    def test_help_startup_time(self):
+        """Show help within the startup budget"""
+        elapsed = []
+        for _ in range(3):
+            start = time.monotonic()
+            self._run('-m', 'altinity_datasets.ad_cli', '--help')
+            elapsed.append(time.monotonic() - start)
+        self.assertLess(min(elapsed), STARTUP_BUDGET,
+                        "ad-cli --help took {0:.3f}s".format(min(elapsed)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -40,5 +40,14 @@ class ClickHouseTest(unittest.TestCase):
         self.assertIsNotNone(partitions)
         self.assertTrue(len(partitions) > 0)
 
+    def test_fetch_engine(self):
+        """Fetch engine and partitions of a table by name"""
+        engine, engine_full = self.ch.fetch_engine('iris')
+        self.assertTrue(engine_full.startswith(engine))
+        self.assertIsNone(self.ch.fetch_engine('no_such_table'))
+        self.assertIn('iris', self.ch.fetch_table_names('ir'))
+        for table, _ in self.ch.fetch_partition_ids(['iris']):
+            self.assertEqual('iris', table)
+
 if __name__ == '__main__':
     unittest.main()
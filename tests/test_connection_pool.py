@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+"""Tests reuse and eviction of pooled ClickHouse connections"""
+import threading
+import unittest
+
+from altinity_datasets import clickhouse
+
+
+class FakeConnection:
+    def __init__(self):
+        self.healthy = True
+
+    def ping(self):
+        if not self.healthy:
+            raise EOFError("Unexpected EOF while reading bytes")
+        return True
+
+
+class FakeClient:
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.pool = clickhouse.ConnectionPool(FakeClient,
+                                              max_size=2,
+                                              idle_timeout=60,
+                                              check_interval=10,
+                                              clock=lambda: self.now)
+
+    def test_reuse(self):
+        """Released clients are reused instead of reconnecting"""
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(1, self.pool.created)
+        self.assertFalse(first.disconnected)
+
+    def test_error_discards_client(self):
+        """Clients that raise errors are closed rather than reused"""
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as first:
+                raise ValueError("bad query")
+        self.assertTrue(first.disconnected)
+        with self.pool.connection() as second:
+            self.assertIsNot(first, second)
+
+    def test_idle_eviction(self):
+        """Clients idle past the timeout are closed"""
+        client = self.pool.acquire()
+        self.pool.release(client)
+        self.now = 61
+        self.assertIsNot(client, self.pool.acquire())
+        self.assertTrue(client.disconnected)
+
+    def test_health_check(self):
+        """Clients that fail a ping after sitting idle are replaced"""
+        client = self.pool.acquire()
+        self.pool.release(client)
+        client.connection.healthy = False
+        self.now = 5
+        self.assertIs(client, self.pool.acquire())
+        self.pool.release(client)
+        self.now = 20
+        replacement = self.pool.acquire()
+        self.assertIsNot(client, replacement)
+        self.assertTrue(client.disconnected)
+
+    def test_bounded(self):
+        """Callers wait while all clients are in use"""
+        held = [self.pool.acquire(), self.pool.acquire()]
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(self.pool.acquire()))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertEqual([], acquired)
+        self.pool.release(held[0])
+        waiter.join(5)
+        self.assertEqual([held[0]], acquired)
+        self.assertEqual(2, self.pool.created)
+
+    def test_close(self):
+        """Closing the pool disconnects idle clients"""
+        client = self.pool.acquire()
+        self.pool.release(client)
+        self.pool.close()
+        self.assertTrue(client.disconnected)
+        with self.assertRaises(Exception):
+            self.pool.acquire()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+"""Tests dependency ordering of DDL scripts"""
+import threading
+import time
+import unittest
+
+from altinity_datasets import ddl
+
+
+class FakeConnector:
+    """Records DDL execution with optional delays and failures"""
+
+    def __init__(self, delays=None, failures=(), gates=None):
+        self.delays = delays or {}
+        self.failures = failures
+        self.gates = gates or {}
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def execute(self, sql, dry_run=False):
+        name = ddl.DdlStatement('-', sql).name
+        with self.lock:
+            self.events.append(('start', name))
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+        if name in self.gates:
+            self.gates[name].wait(5)
+        time.sleep(self.delays.get(name, 0))
+        with self.lock:
+            self.events.append(('end', name))
+            self.running -= 1
+        if name in self.failures:
+            raise Exception("Failed: {0}".format(name))
+
+    def order(self, event, name):
+        return self.events.index((event, name))
+
+
+def statements(*scripts):
+    return ddl.link([
+        ddl.DdlStatement('{0}.sql'.format(i), sql)
+        for i, sql in enumerate(scripts)
+    ])
+
+
+SOURCE = "CREATE TABLE src (id UInt64) ENGINE = MergeTree ORDER BY id"
+TARGET = "CREATE TABLE db.`dst` AS src"
+VIEW = ("-- Copies rows from src\n"
+        "CREATE MATERIALIZED VIEW IF NOT EXISTS mv TO dst AS "
+        "SELECT id FROM src")
+OTHER = "CREATE TABLE other (id UInt64) ENGINE = Memory"
+
+
+class DdlTest(unittest.TestCase):
+    def test_parse(self):
+        """Find created objects and references"""
+        view = ddl.DdlStatement('v.sql', VIEW)
+        self.assertEqual(('MATERIALIZED VIEW', 'mv'), (view.kind, view.name))
+        self.assertEqual({'dst', 'src'}, view.references)
+        target = ddl.DdlStatement('t.sql', TARGET)
+        self.assertEqual(('dst', {'src'}), (target.name, target.references))
+        dictionary = ddl.DdlStatement(
+            'd.sql', "CREATE DICTIONARY d (id UInt64, v String) "
+            "PRIMARY KEY id SOURCE(CLICKHOUSE(TABLE 'src')) "
+            "LAYOUT(FLAT()) LIFETIME(0)")
+        self.assertEqual({'src'}, dictionary.references)
+        dist = ddl.DdlStatement(
+            'x.sql', "CREATE TABLE x (id UInt64) ENGINE = "
+            "Distributed(cluster, default, src, rand())")
+        self.assertIn('src', dist.references)
+
+    def test_link(self):
+        """Scripts depend on creators of referenced objects"""
+        source, target, view, other, unknown = statements(
+            SOURCE, TARGET, VIEW, OTHER, "SYSTEM STOP MERGES")
+        self.assertEqual([source], target.depends)
+        self.assertEqual([target, source], view.depends)
+        self.assertEqual([], other.depends)
+        self.assertEqual(4, len(unknown.depends))
+
+    def test_run_in_dependency_order(self):
+        """Independent scripts run at once, dependents wait"""
+        ch = FakeConnector(delays={'src': 0.1, 'other': 0.1})
+        runner = ddl.DdlRunner(ch, statements(VIEW, TARGET, SOURCE, OTHER),
+                               4).start()
+        runner.wait()
+        runner.close()
+        self.assertEqual(2, ch.max_running)
+        self.assertLess(ch.order('end', 'src'), ch.order('start', 'dst'))
+        self.assertLess(ch.order('end', 'dst'), ch.order('start', 'mv'))
+
+    def test_ready(self):
+        """Items are yielded as soon as their table exists"""
+        gate = threading.Event()
+        ch = FakeConnector(gates={'src': gate})
+        runner = ddl.DdlRunner(ch, statements(SOURCE, OTHER), 2).start()
+        items = runner.ready([('src', 1), ('other', 2)], lambda i: i[0])
+        self.assertEqual(('other', 2), next(items))
+        gate.set()
+        self.assertEqual(('src', 1), next(items))
+        runner.close()
+
+    def test_failure(self):
+        """Dependents of a failed script do not run and waits raise"""
+        ch = FakeConnector(failures=('src', ))
+        runner = ddl.DdlRunner(ch, statements(SOURCE, TARGET, OTHER),
+                               2).start()
+        with self.assertRaises(Exception):
+            runner.wait('dst')
+        runner.close()
+        self.assertNotIn(('start', 'dst'), ch.events)
+
+    def test_cycle(self):
+        """Circular references fall back to file order"""
+        ch = FakeConnector()
+        runner = ddl.DdlRunner(
+            ch,
+            statements("CREATE VIEW a AS SELECT * FROM b",
+                       "CREATE VIEW b AS SELECT * FROM a"), 2).start()
+        runner.wait()
+        runner.close()
+        self.assertEqual([('start', 'a'), ('end', 'a'), ('start', 'b'),
+                          ('end', 'b')], ch.events)
+
+    def test_on_cluster(self):
+        """Add ON CLUSTER after the created object"""
+        self.assertEqual(
+            "-- Copies rows from src\n"
+            "CREATE MATERIALIZED VIEW IF NOT EXISTS mv ON CLUSTER `c` TO dst "
+            "AS SELECT id FROM src", ddl.on_cluster(VIEW, 'c'))
+        self.assertEqual("CREATE TABLE db.`dst` ON CLUSTER `c` AS src",
+                         ddl.on_cluster(TARGET, 'c'))
+        for sql in ("CREATE TABLE t ON CLUSTER x (id UInt64) ENGINE = Log",
+                    "INSERT INTO src VALUES (1)"):
+            self.assertEqual(sql, ddl.on_cluster(sql, 'c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+"""Tests incremental dumps that use partition fingerprints"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import api
+from altinity_datasets import bench
+from altinity_datasets import dump_state
+
+import yaml
+
+
+class DumpStateTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.spec = bench.BenchSpec(tables=1, files=1, file_size=5000,
+                                    partitions=2)
+        self.table = self.spec.table_names()[0]
+        self.dataset_path = os.path.join(self.workdir, 'dumps',
+                                         self.spec.name())
+        self.data_path = os.path.join(self.dataset_path, 'data', self.table)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def dump(self, **options):
+        with bench.sink(self.spec, self.workdir):
+            return api.dataset_dump(self.spec.name(),
+                                    repo_path=os.path.join(
+                                        self.workdir, 'dumps'),
+                                    parallel=2,
+                                    compress=False,
+                                    **options)
+
+    def manifest(self):
+        with open(os.path.join(self.dataset_path, 'manifest.yaml')) as f:
+            return yaml.safe_load(f)
+
+    def test_incremental(self):
+        """Incremental dumps rewrite changed partitions and delete dropped
+           ones"""
+        self.assertEqual(2, self.dump().succeeded)
+        partitions = self.manifest()['partitions'][self.table]
+        self.assertEqual(['201901', '201902'], sorted(partitions))
+        self.assertEqual('data-201901.csv', partitions['201901']['file'])
+
+        # Nothing changed, so nothing dumps and manifest edits are kept.
+        manifest = self.manifest()
+        manifest['title'] = 'Edited'
+        manifest['partitions'][self.table]['201902']['fingerprint'] = 'old'
+        manifest['partitions'][self.table]['201812'] = {
+            'file': 'data-201812.csv',
+            'fingerprint': 'x'
+        }
+        with open(os.path.join(self.dataset_path, 'manifest.yaml'),
+                  'w') as f:
+            yaml.dump(manifest, f)
+        dropped = os.path.join(self.data_path, 'data-201812.csv')
+        open(dropped, 'w').close()
+        dump_report = self.dump(incremental=True)
+        self.assertEqual(['data-201902.csv'],
+                         [op.name for op in dump_report.operations])
+        self.assertFalse(os.path.exists(dropped))
+        manifest = self.manifest()
+        self.assertEqual('Edited', manifest['title'])
+        self.assertEqual(partitions, manifest['partitions'][self.table])
+
+        self.assertEqual(0, len(self.dump(incremental=True).operations))
+        with self.assertRaises(Exception):
+            self.dump(incremental=True, file_size=1000)
+
+    def test_dropped_table(self):
+        """Tables that match the selection but no longer exist are
+           removed"""
+        state = dump_state.DumpState(self.workdir)
+        os.makedirs(os.path.join(self.workdir, 'data', 'old'))
+        os.makedirs(os.path.join(self.workdir, 'ddl'))
+        open(os.path.join(self.workdir, 'ddl', 'old.sql'), 'w').close()
+        state.partitions = {
+            'old': {'all': {'file': 'data-all.csv', 'fingerprint': 'x'}},
+            'other': {'all': {'file': 'data-all.csv', 'fingerprint': 'x'}}
+        }
+        state.remove_tables(['new'], '^o.d')
+        self.assertEqual(['other'], list(state.partitions))
+        self.assertEqual([], os.listdir(os.path.join(self.workdir, 'ddl')))
+        self.assertEqual([], os.listdir(os.path.join(self.workdir, 'data')))
+
+    def test_record_rows(self):
+        """Partitions are recorded only if the rows dumped match the rows
+           of their fingerprint"""
+        state = dump_state.DumpState(self.workdir)
+        for partition_id in ('201901', '201902', '201903'):
+            state.plan('t', partition_id, 'rows=10', os.path.join(
+                self.workdir, partition_id + '.csv'), 10)
+        self.assertTrue(state.record(os.path.join(self.workdir,
+                                                  '201901.csv'), 10))
+        self.assertFalse(state.record(os.path.join(self.workdir,
+                                                   '201902.csv'), 4))
+        self.assertFalse(state.record(os.path.join(self.workdir,
+                                                   '201903.csv'), None))
+        self.assertEqual(['201901'], list(state.partitions['t']))
+        self.assertEqual({}, state.pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
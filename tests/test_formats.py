@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+"""Tests recognition and naming of data file formats"""
+import bz2
+import gzip
+import lzma
+import os
+import tempfile
+import unittest
+
+from altinity_datasets import formats
+
+
+class FormatsTest(unittest.TestCase):
+    def test_detect(self):
+        """Detect format and compression from file names"""
+        self.assertEqual(('CSVWithNames', None), formats.detect('a/x.csv'))
+        self.assertEqual(('CSVWithNames', 'gzip'),
+                         formats.detect('a/data-1.csv.gz'))
+        self.assertEqual(('Native', 'zstd'), formats.detect('x.native.zst'))
+        self.assertEqual(('Parquet', None), formats.detect('x.parquet'))
+        self.assertIsNone(formats.detect('x.csv.gz.idx'))
+        self.assertIsNone(formats.detect('README'))
+        self.assertIsNone(formats.detect('gz'))
+
+    def test_classify(self):
+        """Classify data files by content before extension"""
+        with tempfile.TemporaryDirectory() as tmp:
+
+            def write(name, data):
+                path = os.path.join(tmp, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                return path
+
+            csv = b'a,b\n1,2\n'
+            self.assertEqual(('text', None, 'CSVWithNames'),
+                             formats.classify(write('x.csv', csv)))
+            # Compression from magic bytes wins over a wrong extension.
+            self.assertEqual(('text', 'gzip', 'CSVWithNames'),
+                             formats.classify(
+                                 write('x.csv', gzip.compress(csv))))
+            self.assertEqual(('parquet', None, 'Parquet'),
+                             formats.classify(write('x.csv', b'PAR1xxxx')))
+            self.assertEqual(('text', 'xz', 'TSVWithNames'),
+                             formats.classify(
+                                 write('part-0',
+                                       lzma.compress(b'a\tb\n1\t2\n'))))
+            self.assertEqual(('text', 'bz2', 'JSONEachRow'),
+                             formats.classify(
+                                 write('x.ndjson.bz2',
+                                       bz2.compress(b'{"a": 1}\n'))))
+            self.assertEqual(('avro', None, 'Avro'),
+                             formats.classify(write('part-1', b'Obj\x01')))
+            self.assertEqual(('native', None, 'Native'),
+                             formats.classify(write('x.native',
+                                                    b'\x02\x01\x00')))
+            self.assertIsNone(formats.classify(write('part-2', b'\x02\x00')))
+            self.assertIsNone(formats.classify(write('x.csv.gz.idx', b'{}')))
+            self.assertIsNone(formats.classify(write('_SUCCESS', csv)))
+            # Uncompressed text is only data with a known extension.
+            self.assertIsNone(formats.classify(write('README', csv)))
+            self.assertIsNone(formats.classify(write('LICENSE', b'MIT\n')))
+            self.assertIsNone(formats.classify(write('NOTES.md', csv)))
+            # Compressed data that cannot be read is not classified.
+            self.assertIsNone(formats.classify(
+                write('part-3', b'\x04\x22\x4d\x18\x00\x00\x00\x00')))
+
+    def test_file_name(self):
+        """Name data files for format and compression"""
+        self.assertEqual('data-all.orc', formats.file_name('all', 'ORC'))
+        self.assertEqual('data-1.native.lz4',
+                         formats.file_name('1', 'Native', 'lz4'))
+        self.assertEqual(('Native', 'lz4'),
+                         formats.detect(formats.file_name('1', 'Native',
+                                                          'lz4')))
+
+
+if __name__ == '__main__':
+    unittest.main()
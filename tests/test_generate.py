@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+"""Tests synthetic data generation"""
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import api
+from altinity_datasets import generate
+from altinity_datasets import native_load
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DDL = """
+CREATE TABLE IF NOT EXISTS db.`events` (
+  id UInt64,
+  ts DateTime('UTC'),
+  kind Enum8('a, b' = 1, 'c' = 2),
+  price Nullable(Decimal(10, 2)) CODEC(ZSTD(1)),
+  tag LowCardinality(String) DEFAULT 'x',
+  day Date MATERIALIZED toDate(ts),
+  INDEX kind_idx kind TYPE set(0) GRANULARITY 4
+) ENGINE = MergeTree ORDER BY (id, ts);
+CREATE VIEW v AS SELECT * FROM events;
+"""
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_tables(self):
+        """Column lists skip computed columns, indexes and options"""
+        self.assertEqual([('events', [('id', 'UInt64'),
+                                      ('ts', "DateTime('UTC')"),
+                                      ('kind', "Enum8('a, b' = 1, 'c' = 2)"),
+                                      ('price', 'Nullable(Decimal(10, 2))'),
+                                      ('tag', 'LowCardinality(String)')])],
+                         generate.parse_tables(DDL))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class GenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.columns = generate.parse_tables(DDL)[0][1]
+        self.hints = {
+            'tables': {
+                'events': {
+                    'rows': 1000,
+                    'columns': {
+                        'id': {'distribution': 'sequence', 'start': 10},
+                        'price': {'distribution': 'normal', 'mean': 50,
+                                  'stddev': 5, 'min': 0, 'nulls': 0.5},
+                        'tag': {'values': ['x', 'y'], 'weights': [1, 0]}
+                    }
+                }
+            }
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_write_part(self):
+        """Parts are repeatable and readable by the native loader"""
+        (table, columns, rows), = generate.plan_tables([DDL], self.hints, 2)
+        self.assertEqual(2000, rows)
+        parts = generate.plan_parts([(table, columns, rows)], 300)
+        self.assertEqual([0, 300, 600, 900, 1200, 1500, 1800],
+                         [part[3] for part in parts])
+        self.assertEqual(200, parts[-1][4])
+        paths = [os.path.join(self.workdir, n) for n in ('a.csv', 'b.csv')]
+        for path in paths:
+            generate.write_part(table, columns, path, 5, 100, seed=1,
+                                block_rows=30)
+        with open(paths[0]) as a, open(paths[1]) as b:
+            self.assertEqual(a.read(), b.read())
+
+        with open(paths[0]) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([str(i) for i in range(15, 115)],
+                         [row['id'] for row in rows])
+        self.assertEqual({'x'}, {row['tag'] for row in rows})
+        self.assertEqual({'a, b', 'c'}, {row['kind'] for row in rows})
+        self.assertIn(native_load.CSV_NULL, {row['price'] for row in rows})
+        with open(paths[0]) as f:
+            blocks = list(native_load.read_blocks(f, self.columns))
+        self.assertEqual(100, len(blocks[0][1][0]))
+
+    def test_unknown_column_hint(self):
+        """Hints must name columns of the table"""
+        self.hints['tables']['events']['columns']['missing'] = {}
+        with self.assertRaises(Exception):
+            generate.plan_tables([DDL], self.hints, 1)
+
+    def test_dataset_generate(self):
+        """Generate a built-in dataset at a small scale"""
+        gen_report = api.dataset_generate('iris',
+                                          0.0001,
+                                          output_path=self.workdir,
+                                          codec='gzip',
+                                          file_rows=500,
+                                          parallel=2)
+        self.assertEqual(0, gen_report.failed)
+        datasets = api.dataset_search('iris', repo_path=self.workdir)
+        self.assertEqual(1, len(datasets))
+        files = sorted(os.listdir(os.path.join(self.workdir, 'iris', 'data',
+                                               'iris')))
+        self.assertEqual(len(gen_report.operations), len(files))
+        self.assertEqual('data-0.csv.gz', files[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
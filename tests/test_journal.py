@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+"""Tests the checkpoint journal used to resume loads"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import journal
+from altinity_datasets import splits
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.csv = os.path.join(self.dir, 'data.csv')
+        with open(self.csv, 'w') as f:
+            f.write('id\n' + ''.join('{0}\n'.format(i) for i in range(100)))
+        self.path = os.path.join(self.dir, 'journal.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_record_and_resume(self):
+        """Recorded splits are done after reopening the journal"""
+        file_splits = splits.plan_splits(self.csv, 100)
+        j = journal.LoadJournal(self.path)
+        j.record('t', file_splits[0], rows=10)
+        j = journal.LoadJournal(self.path)
+        self.assertTrue(j.is_done('t', file_splits[0]))
+        self.assertFalse(j.is_done('t', file_splits[1]))
+        self.assertFalse(j.is_done('other', file_splits[0]))
+        j.check_ranges('t', file_splits)
+
+    def test_changed_file(self):
+        """Files whose contents changed are loaded again"""
+        split = splits.plan_splits(self.csv)[0]
+        j = journal.LoadJournal(self.path)
+        j.record('t', split)
+        with open(self.csv, 'a') as f:
+            f.write('100\n')
+        self.assertFalse(journal.LoadJournal(self.path).is_done('t', split))
+
+    def test_changed_ranges(self):
+        """Resuming with a different split size is an error"""
+        j = journal.LoadJournal(self.path)
+        j.record('t', splits.plan_splits(self.csv, 100)[0])
+        with self.assertRaises(Exception):
+            j.check_ranges('t', splits.plan_splits(self.csv))
+
+    def test_staged(self):
+        """Staged splits are done and become published with their table"""
+        split = splits.plan_splits(self.csv)[0]
+        j = journal.LoadJournal(self.path)
+        j.record('t', split, staged=True)
+        j.record('u', split)
+        j = journal.LoadJournal(self.path)
+        self.assertTrue(j.is_done('t', split))
+        self.assertEqual({'t'}, j.tables(True))
+        self.assertEqual({'u'}, j.tables(False))
+        j.publish('t')
+        j = journal.LoadJournal(self.path)
+        self.assertEqual(set(), j.tables(True))
+        self.assertEqual({'t', 'u'}, j.tables(False))
+
+    def test_reset(self):
+        """Reset removes all entries"""
+        j = journal.LoadJournal(self.path)
+        j.record('t', splits.plan_splits(self.csv)[0])
+        j.reset()
+        self.assertEqual({}, journal.LoadJournal(self.path).entries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+"""Tests conversion of CSV data to typed blocks for native loading"""
+import datetime
+import io
+import unittest
+
+from altinity_datasets import native_load
+
+
+class NativeLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.columns = [('id', 'UInt32'), ('name', 'String'),
+                        ('day', 'Date'), ('score', 'Nullable(Float64)')]
+
+    def test_converters(self):
+        """Convert CSV fields according to column type"""
+        self.assertEqual(42, native_load.converter('Int64')('42'))
+        self.assertEqual('a', native_load.converter('LowCardinality(String)')(
+            'a'))
+        self.assertIsNone(native_load.converter('Nullable(Int8)')('\\N'))
+        self.assertEqual(datetime.datetime(2019, 1, 2, 3, 4, 5),
+                         native_load.converter('DateTime')(
+                             '2019-01-02 03:04:05'))
+        # Timestamps do not depend on the client time zone.
+        utc = datetime.timezone.utc
+        self.assertEqual(datetime.datetime(2019, 1, 2, 3, 4, 5, tzinfo=utc),
+                         native_load.converter('DateTime')('1546398245'))
+        self.assertEqual(0, native_load.converter('DateTime')('').timestamp())
+        self.assertEqual([1, 2], native_load.converter('Array(UInt8)')(
+            '[1,2]'))
+        with self.assertRaises(Exception):
+            native_load.converter('AggregateFunction(uniq, UInt64)')
+
+    def test_read_blocks(self):
+        """Split CSV rows into columnar blocks of limited size"""
+        data = io.StringIO('name,id,day,score\n'
+                           '"x, y",1,2019-01-01,1.5\n'
+                           'z,2,2019-01-02,\\N\n'
+                           'w,3,2019-01-03,0\n')
+        blocks = list(native_load.read_blocks(data, self.columns, 2))
+        self.assertEqual(2, len(blocks))
+        header, block = blocks[0]
+        self.assertEqual(['name', 'id', 'day', 'score'], header)
+        self.assertEqual(['x, y', 'z'], block[0])
+        self.assertEqual([1, 2], block[1])
+        self.assertEqual([1.5, None], block[3])
+        self.assertEqual([[u'w'], [3], [datetime.date(2019, 1, 3)], [0.0]],
+                         blocks[1][1])
+
+    def test_unknown_column(self):
+        """Reject CSV columns that are not in the table"""
+        data = io.StringIO('id,color\n1,red\n')
+        with self.assertRaises(Exception):
+            list(native_load.read_blocks(data, self.columns))
+
+
+if __name__ == '__main__':
+    unittest.main()
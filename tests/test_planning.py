@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+"""Tests planning of load and dump operations without a server"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import api
+from altinity_datasets import clickhouse
+from altinity_datasets import report
+from altinity_datasets.proc_pool import ProcessPool
+
+
+class FakeClient:
+    """Answers queries with canned results keyed by a SQL fragment"""
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def execute(self, sql, *args, **kwargs):
+        self.queries.append(sql)
+        for fragment, result in self.results:
+            if fragment in sql:
+                return result
+        raise Exception("Unexpected query: {0}".format(sql))
+
+    def disconnect(self):
+        pass
+
+
+def fake_connector(results):
+    """Return ClickHouse instance whose connections are a FakeClient"""
+    client = FakeClient(results)
+    ch = clickhouse.ClickHouse(database='db')
+    ch.pool = clickhouse.ConnectionPool(lambda: client)
+    return ch, client
+
+
+class PlanningTest(unittest.TestCase):
+    def test_largest_first(self):
+        """Schedule operations by decreasing cost across tables"""
+        ops = [('a', 1), ('b', 30), ('a', 7), ('c', 30)]
+        ordered = api._largest_first(ops, lambda op: op[1])
+        self.assertEqual([30, 30, 7, 1], [op[1] for op in ordered])
+        # Ties keep planner order.
+        self.assertEqual(['b', 'c'], [op[0] for op in ordered[:2]])
+
+    def test_partition_selects(self):
+        """Select partitions listed in system.parts by partition ID"""
+        ch, client = fake_connector([
+            ('FROM system.parts', [
+                ('t', "'setosa'", 'a1b2', 50, 40, 1, 3, 0),
+                ('t', '201601', '201601', 100, 100, 4, 4, 0)
+            ]),
+        ])
+        table = clickhouse.TableData('db', 't', 'species', 'id')
+        selects = api._partition_selects(ch, table, 'CSVWithNames')
+        self.assertEqual([('setosa', 'a1b2', 'setosa', 40),
+                          ('201601', '201601', '201601', 100)],
+                         [(s[0], s[1], s[2], s[4]) for s in selects])
+        self.assertEqual(
+            "SELECT * FROM db.t WHERE _partition_id = 'a1b2' "
+            "ORDER BY id FORMAT CSVWithNames", selects[0][3])
+
+        table = clickhouse.TableData('db', 'u')
+        table.total_bytes = 140
+        table.total_rows = 70
+        self.assertEqual(
+            [(None, 'all', 'all', "SELECT * FROM db.u FORMAT Native", 140,
+              70)],
+            api._partition_selects(ch, table, 'Native'))
+        self.assertEqual(1, len(client.queries))
+
+    def test_fetch_partitions(self):
+        """List partition keys with a select for each"""
+        ch, client = fake_connector([
+            ('FROM system.parts', [
+                ('t', "'setosa'", 'a1b2', 50, 40, 1, 3, 0),
+                ('t', '201601', '201601', 100, 100, 4, 4, 0)
+            ]),
+        ])
+        table = clickhouse.TableData('db', 't', 'species')
+        self.assertEqual(
+            [('setosa', "SELECT * FROM db.t WHERE _partition_id = 'a1b2' "
+              "FORMAT CSVWithNames"),
+             (201601, "SELECT * FROM db.t WHERE _partition_id = '201601' "
+              "FORMAT CSVWithNames")], ch.fetch_partitions(table))
+        self.assertIn("database='db' AND table IN ('t')", client.queries[0])
+
+    def test_fetch_all_partition_data(self):
+        """List partitions of all tables in one query and fingerprint them
+           by rows, blocks and mutation version"""
+        ch, client = fake_connector([
+            ('FROM system.parts', [
+                ('t', '201601', '201601', 100, 10, 1, 7, 0),
+                ('t', '201602', '201602', 50, 5, 8, 8, 12),
+                ('u', 'tuple()', 'all', 5, 1, 1, 1, 0)
+            ]),
+        ])
+        tables = [clickhouse.TableData('db', name, 'toYYYYMM(d)')
+                  for name in ('t', 'u', 'v')]
+        partitions = ch.fetch_all_partition_data(tables)
+        self.assertEqual(['t', 'u'], sorted(partitions))
+        self.assertEqual(
+            ['rows=100,blocks=1-7,mutation=0',
+             'rows=50,blocks=8-8,mutation=12'],
+            [p.fingerprint() for p in partitions['t']])
+        self.assertEqual(1, len(client.queries))
+        self.assertIn("table IN ('t', 'u', 'v')", client.queries[0])
+        self.assertIsNone(
+            clickhouse.PartitionData('x', 'x', 1, 1).fingerprint())
+
+    def test_plan_shards(self):
+        """Split big partitions by key ranges and coalesce small ones"""
+        partitions = [
+            clickhouse.PartitionData('201601', '201601', 10, 10),
+            clickhouse.PartitionData('201602', '201602', 10, 20),
+            clickhouse.PartitionData('201603', '201603', 200, 120),
+            clickhouse.PartitionData('201604', '201604', 1000, 250),
+            clickhouse.PartitionData('201605', '201605', 10, 5),
+        ]
+        splits = []
+
+        def split(partition, count):
+            splits.append((partition.partition_id, count))
+            if partition.partition_id == '201603':
+                return None
+            return clickhouse.key_ranges('id', ['334', '668'])
+
+        shards = sorted(clickhouse.plan_shards(partitions, 100, split),
+                        key=lambda s: s.tag)
+        self.assertEqual([('201603', 2), ('201604', 3)], splits)
+        self.assertEqual(
+            ['201601-201605', '201603', '201604-0', '201604-1', '201604-2'],
+            [s.tag for s in shards])
+        self.assertEqual("_partition_id IN ('201601', '201602', '201605')",
+                         shards[0].condition)
+        self.assertEqual(35, shards[0].bytes)
+        self.assertEqual(30, shards[0].rows)
+        self.assertEqual("_partition_id = '201603'", shards[1].condition)
+        self.assertEqual([333, 333, 333], [s.rows for s in shards[2:]])
+        self.assertEqual(
+            "_partition_id = '201604' AND (id < 334 OR id IS NULL)",
+            shards[2].condition)
+        self.assertEqual(
+            "_partition_id = '201604' AND id >= 334 AND id < 668",
+            shards[3].condition)
+        self.assertEqual("_partition_id = '201604' AND id >= 668",
+                         shards[4].condition)
+
+    def test_fetch_shards(self):
+        """Find key boundaries of big partitions from one key sample"""
+        ch, client = fake_connector([
+            ('FROM system.parts', [('t', '201601', '201601', 300, 300, 1,
+                                    1, 0)]),
+            ('groupArraySample', [(['a', "b'c", 'm', 'x', 'z', 'z'], )]),
+        ])
+        table = clickhouse.TableData('db', 't', 'toYYYYMM(d)',
+                                     'name, intHash32(id)')
+        shards = ch.fetch_shards(table, 100)
+        self.assertEqual(3, len(shards))
+        self.assertEqual(
+            "SELECT * FROM db.t WHERE _partition_id = '201601' AND "
+            "name >= 'z' ORDER BY name, intHash32(id) "
+            "FORMAT CSVWithNames", shards[2][1])
+        self.assertEqual(
+            "SELECT * FROM db.t WHERE _partition_id = '201601' AND "
+            "name >= 'm' AND name < 'z' ORDER BY name, intHash32(id) "
+            "FORMAT CSVWithNames", shards[1][1])
+        self.assertEqual(2, len(client.queries))
+        self.assertIn("groupArraySample(10000)(name)", client.queries[1])
+
+        # Values without simple literals leave the partition whole.
+        ch, client = fake_connector([
+            ('FROM system.parts', [('t', '201601', '201601', 300, 300, 1,
+                                    1, 0)]),
+            ('groupArraySample', [([[1], [2], [3]], )]),
+        ])
+        self.assertEqual(1, len(ch.fetch_shards(table, 100)))
+
+    def test_fetch_shards_few_values(self):
+        """Split on the whole sorting key if its first column repeats"""
+        ch, client = fake_connector([
+            ('FROM system.parts', [('t', '201601', '201601', 300, 300, 1,
+                                    1, 0)]),
+            ('(name, id)', [([('a', 1), ('a', 5), ('a', 9)], )]),
+            ('(name)', [(['a', 'a', 'a'], )]),
+        ])
+        table = clickhouse.TableData('db', 't', 'toYYYYMM(d)', 'name, id')
+        shards = ch.fetch_shards(table, 100)
+        self.assertEqual(3, len(shards))
+        self.assertEqual(
+            "SELECT * FROM db.t WHERE _partition_id = '201601' AND "
+            "(name, id) >= ('a', 5) AND (name, id) < ('a', 9) "
+            "ORDER BY name, id FORMAT CSVWithNames", shards[1][1])
+
+        # A single key value everywhere dumps the partition whole.
+        client.results[1] = ('(name, id)', [([('a', 1)] * 3, )])
+        self.assertEqual(1, len(ch.fetch_shards(table, 100)))
+
+    def test_check_dump_rows(self):
+        """Rows dumped come from the query log and must match counts"""
+        ch, client = fake_connector([
+            ("name = 'log_queries'", [('1', )]),
+            ('SYSTEM FLUSH LOGS', []),
+            ('FROM system.query_log', [('q1', 0, 60), ('q2', 0, 40)]),
+            ('count(*)', ([(100, )], [('count()', 'UInt64')])),
+        ])
+        tables = [clickhouse.TableData('db', 't')]
+        operations = [('t', None, '', 0, '/d/1.csv', None, 'q1'),
+                      ('t', None, '', 0, '/d/2.csv', None, 'q2')]
+        load_report = report.Report('dump', 'ds', 'db')
+        stats = [load_report.add('t', op[4]) for op in operations]
+        for op_stats in stats:
+            op_stats.status = 'succeeded'
+        api.check_dump_rows(ch, tables, operations, stats, True, None)
+        self.assertEqual([60, 40], [op_stats.rows for op_stats in stats])
+
+        client.results[2] = ('FROM system.query_log', [('q1', 0, 60),
+                                                       ('q2', 0, 39)])
+        with self.assertRaises(Exception):
+            api.check_dump_rows(ch, tables, operations, stats, True, None)
+        # Incremental dumps do not cover whole tables.
+        api.check_dump_rows(ch, tables, operations, stats, False, None)
+
+    def test_fetch_tables(self):
+        """Fetch table metadata and totals in batched queries"""
+        ch, client = fake_connector([
+            ('FROM system.tables', [
+                ('a', 'toYYYYMM(d)', 'd', 'CREATE TABLE db.a (d Date)', 10,
+                 100),
+                ('b', '', '', 'CREATE TABLE db.b (x Int8)', None, None),
+                ('c', '', '', 'CREATE TABLE db.c (x Int8)', None, None),
+            ]),
+            ('FROM system.parts', [('b', 5, 50)]),
+            ('count(*)', ([(7, )], [('count()', 'UInt64')])),
+        ])
+        tables = ch.fetch_tables()
+        self.assertEqual(2, len(client.queries))
+        self.assertEqual('CREATE TABLE a (d Date)', tables[0].create_table)
+        self.assertEqual('toYYYYMM(d)', tables[0].partition_key)
+        self.assertIsNone(tables[1].partition_key)
+        self.assertIsNone(tables[1].sorting_key)
+        self.assertEqual([10, 5], [ch.fetch_row_count(t) for t in tables[:2]])
+        self.assertEqual(50, tables[1].total_bytes)
+        self.assertEqual(2, len(client.queries))
+        # Tables without totals or parts are counted.
+        self.assertEqual(7, ch.fetch_row_count(tables[2]))
+
+    def test_dump_commands(self):
+        """Generate dump commands for each compressor"""
+        select = "SELECT * FROM db.t FORMAT Native"
+        cmd = api._dump_command('', select, '/d/data-all.native.zst', 'zstd',
+                                3, 'clickhouse', 1)
+        self.assertEqual(
+            "rm -f /d/data-all.native.zst && clickhouse-client --query="
+            "'SELECT * FROM db.t INTO OUTFILE '\"'\"'/d/data-all.native.zst"
+            "'\"'\"' COMPRESSION '\"'\"'zstd'\"'\"' LEVEL 3 FORMAT Native'",
+            cmd)
+        select = "SELECT * FROM db.t FORMAT CSVWithNames"
+        cmd = api._dump_command('', select, '/d/data-all.csv.gz', 'gzip',
+                                None, 'gzip', 1)
+        self.assertEqual(
+            "bash -o pipefail -c 'clickhouse-client --query='\"'\"'SELECT * "
+            "FROM db.t FORMAT CSVWithNames'\"'\"' | gzip > "
+            "/d/data-all.csv.gz'", cmd)
+        cmd = api._dump_command('', select, '/d/data-all.csv.zst', 'zstd',
+                                None, 'parallel', 4)
+        self.assertIn("altinity_datasets.splits compress /d/data-all.csv.zst",
+                      cmd)
+        self.assertIn("--codec=zstd --threads=4", cmd)
+
+    def test_dump_pipefail(self):
+        """A client that fails in a dump pipeline fails the command"""
+        workdir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(workdir, 'data-all.csv.gz')
+            cmd = api._dump_command('', 'SELECT 1 FORMAT CSVWithNames',
+                                    file_path, 'gzip', None, 'gzip', 1)
+            cmd = cmd.replace('clickhouse-client', 'exit 81;', 1)
+            pool = ProcessPool(size=1)
+            pool.exec(cmd)
+            pool.drain()
+            self.assertEqual(81, pool.outputs[0].returncode)
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
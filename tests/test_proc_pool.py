@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+"""Tests execution of shell commands in the process pool"""
+import time
+import unittest
+
+from altinity_datasets.proc_pool import ProcessPool
+
+
+class ProcessPoolTest(unittest.TestCase):
+    def test_results(self):
+        """Record exit code, stderr and duration of each command"""
+        pool = ProcessPool(size=2)
+        pool.exec("echo oops >&2; exit 3")
+        pool.exec("true")
+        pool.drain()
+        self.assertEqual(1, pool.succeeded)
+        self.assertEqual(1, pool.failed)
+        failed = [r for r in pool.outputs if r.returncode != 0][0]
+        self.assertEqual(3, failed.returncode)
+        self.assertEqual("oops\n", failed.stderr)
+        self.assertTrue(failed.duration >= 0)
+
+    def test_queue_wait(self):
+        """Commands are queued when submitted, not when they start"""
+        pool = ProcessPool(size=1)
+        results = []
+        pool.exec("sleep 0.2", results.append)
+        pool.exec("true", results.append)
+        pool.drain()
+        waited = results[1].start - results[1].queued
+        self.assertTrue(waited >= 0.1)
+        self.assertTrue(results[0].start - results[0].queued < 0.1)
+
+    def test_no_polling_delay(self):
+        """Free slots as soon as short commands exit"""
+        pool = ProcessPool(size=2)
+        start = time.monotonic()
+        for _ in range(10):
+            pool.exec("true")
+        pool.drain()
+        self.assertEqual(10, pool.succeeded)
+        self.assertTrue(time.monotonic() - start < 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
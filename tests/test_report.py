@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+"""Tests throughput reports of loads and dumps"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import report
+
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.report = report.Report('load', 'iris', 'iris_db')
+        origin = self.report.origin
+        ok = self.report.add('iris', 'a.csv', bytes=1000, rows=10)
+        ok.record('succeeded', origin + 1.0, 2.0, origin)
+        bad = self.report.add('iris', 'b.csv', bytes=500)
+        bad.record('failed', origin + 2.0, 1.0, origin)
+        self.report.add('wine', 'c.csv', bytes=100)
+        self.report.finish()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_totals(self):
+        """Compute counts and per-table totals"""
+        self.assertEqual(1, self.report.succeeded)
+        self.assertEqual(1, self.report.failed)
+        # Operations that did not run are skipped.
+        self.assertEqual(1, self.report.skipped)
+        op = self.report.operations[0]
+        self.assertEqual(1.0, op.queue_wait)
+        self.assertEqual(500.0, op.throughput())
+        tables = self.report.tables()
+        self.assertEqual(1500, tables['iris']['bytes'])
+        self.assertEqual(3.0, tables['iris']['queue_wait'])
+        # 1500 bytes from the first start at 1s to the last end at 3s.
+        self.assertEqual(750.0, tables['iris']['throughput'])
+        self.assertIsNone(tables['wine']['throughput'])
+
+    def test_write(self):
+        """Write JSON and Prometheus textfiles"""
+        json_path = os.path.join(self.dir, 'load.json')
+        self.report.write(json_path)
+        with open(json_path) as f:
+            data = json.load(f)
+        self.assertEqual(3, len(data['operations']))
+        self.assertEqual('skipped', data['operations'][2]['status'])
+
+        prom_path = os.path.join(self.dir, 'load.prom')
+        self.report.write(prom_path)
+        with open(prom_path) as f:
+            text = f.read()
+        self.assertIn('# TYPE altinity_datasets_bytes gauge', text)
+        self.assertIn(
+            'altinity_datasets_bytes{database="iris_db",dataset="iris",'
+            'operation="load",table="iris"} 1500', text)
+        self.assertIn(
+            'altinity_datasets_operations{database="iris_db",dataset="iris",'
+            'operation="load",status="failed",table="iris"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+"""Tests planning of server-side loads from object storage"""
+import asyncio
+import logging
+import os
+import threading
+import unittest
+
+from altinity_datasets import aio
+from altinity_datasets import api
+from altinity_datasets import clickhouse
+from altinity_datasets import report
+from altinity_datasets import server_load
+
+REPO_PATH = os.path.join(os.path.dirname(__file__), '..')
+
+URL = 's3://bucket/airline/ontime/'
+LISTING = [
+    ('bucket/airline/ontime/year=2000/month=1/a.parquet', 100),
+    ('bucket/airline/ontime/year=2000/month=1/b.parquet', 50),
+    ('bucket/airline/ontime/year=2000/month=2/a.parquet', 120),
+]
+
+
+class FakeConnector:
+    """Answers listing and DESCRIBE queries and records inserts"""
+
+    def __init__(self, listing=LISTING):
+        self.listing = listing
+        self.lock = threading.Lock()
+        self.queries = []
+        self.inserts = []
+
+    def execute(self, sql, dry_run=False):
+        with self.lock:
+            self.queries.append(sql)
+        if sql.startswith('SELECT _path'):
+            return self.listing
+        elif sql.startswith('DESCRIBE TABLE s3('):
+            return [('FlightDate', 'Date'), ('Year', 'UInt16'),
+                    ('Carrier', 'String')]
+        elif sql.lstrip('-').lstrip().startswith(('CREATE', 'drop')):
+            return []
+        elif sql.startswith('DESCRIBE TABLE'):
+            return [('Year', 'UInt16', 'ALIAS'), ('FlightDate', 'Date', ''),
+                    ('Carrier', 'String', ''),
+                    ('Extra', 'Nullable(String)', '')]
+        raise Exception("Unexpected query: {0}".format(sql))
+
+    def insert_select(self, sql):
+        with self.lock:
+            self.inserts.append(sql)
+        return 10
+
+
+class ServerLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_env = dict(os.environ)
+        for name in ('AWS_ENDPOINT_URL', 'AWS_ACCESS_KEY_ID',
+                     'AWS_SECRET_ACCESS_KEY'):
+            os.environ.pop(name, None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+
+    def test_locations(self):
+        """Plain locations belong to the only table"""
+        manifest = {
+            'parquet': [URL.rstrip('/')],
+            'parquet_hive': [{
+                'table': 't2',
+                'url': URL
+            }],
+            'mergetree': [URL]
+        }
+        self.assertEqual([('ontime', URL)],
+                         server_load.locations(manifest, 'parquet',
+                                               ['ontime']))
+        self.assertEqual([('t2', URL)],
+                         server_load.locations(manifest, 'parquet_hive',
+                                               ['t1', 't2']))
+        with self.assertRaises(Exception):
+            server_load.locations(manifest, 'parquet', ['t1', 't2'])
+        with self.assertRaises(Exception):
+            server_load.locations(manifest, 'mergetree', ['ontime'])
+
+    def test_plan_units(self):
+        """Files group into one unit per partition directory"""
+        ch = FakeConnector()
+        units = server_load.plan_units(ch, 'ontime', URL, 'Parquet',
+                                       'year >= 2000')
+        self.assertEqual(['year=2000/month=1/*.parquet',
+                          'year=2000/month=2/*.parquet'],
+                         [u.glob for u in units])
+        self.assertEqual([2, 1], [u.files for u in units])
+        self.assertEqual([150, 120], [u.bytes for u in units])
+        self.assertIn("WHERE year >= 2000", ch.queries[0])
+        self.assertIn("use_hive_partitioning = 1", ch.queries[0])
+
+    def test_plan_flat_files(self):
+        """Files at the top of an HTTP location load one at a time"""
+        ch = FakeConnector([('bucket/flat/199501.parquet', 5),
+                            ('bucket/flat/199502.parquet', 7)])
+        units = server_load.plan_units(ch, 'ontime',
+                                       'http://minio:9000/bucket/flat/',
+                                       'Parquet')
+        self.assertEqual(['199502.parquet', '199501.parquet'],
+                         [u.glob for u in units])
+
+    def test_insert(self):
+        """Inserts list columns the source has and apply settings"""
+        ch = FakeConnector()
+        unit = server_load.plan_units(ch, 'ontime', URL, 'Parquet')[0]
+        rows = server_load.load_unit(ch, unit, 'Parquet',
+                                     {'max_insert_block_size': 1000})
+        self.assertEqual(10, rows)
+        self.assertEqual(
+            "INSERT INTO ontime (`FlightDate`, `Carrier`) SELECT "
+            "`FlightDate`, `Carrier` FROM "
+            "s3('s3://bucket/airline/ontime/year=2000/month=1/*.parquet', "
+            "'Parquet') SETTINGS max_insert_block_size = 1000",
+            ch.inserts[0])
+
+    def test_endpoint_and_credentials(self):
+        """S3 URLs can be sent to another endpoint with credentials"""
+        os.environ['AWS_ENDPOINT_URL'] = 'http://minio:9000'
+        os.environ['AWS_ACCESS_KEY_ID'] = 'key'
+        os.environ['AWS_SECRET_ACCESS_KEY'] = "s3cr'et"
+        sql = server_load.table_function(URL, 'Parquet', 'x.parquet')
+        self.assertEqual(
+            "s3('http://minio:9000/bucket/airline/ontime/x.parquet', 'key', "
+            "'s3cr\\'et', 'Parquet')", sql)
+        # The secret key is masked in logged statements.
+        masked = ("s3('http://minio:9000/bucket/airline/ontime/x.parquet', "
+                  "'key', '[HIDDEN]', 'Parquet')")
+        self.assertEqual(masked, clickhouse.mask(sql))
+        with self.assertLogs('clickhouse_driver.connection',
+                             level='DEBUG') as logs:
+            logging.getLogger('clickhouse_driver.connection').debug(
+                'Query: %s', sql)
+        self.assertEqual(['DEBUG:clickhouse_driver.connection:Query: ' +
+                          masked], logs.output)
+
+    def test_format_settings(self):
+        """Numeric settings are not quoted"""
+        self.assertEqual(
+            " SETTINGS a = 1, b = -5, c = 'x'",
+            server_load.format_settings({
+                'c': 'x',
+                'a': 1,
+                'b': '-5'
+            }))
+        self.assertEqual('', server_load.format_settings({}))
+
+    def test_load_ontime(self):
+        """The OnTime manifest loads on the server one month at a time"""
+        prefix = 'altinity-clickhouse-data/airline/data/ontime_parquet3/'
+        ch = FakeConnector([(prefix + path[len('bucket/airline/ontime/'):],
+                             size) for path, size in LISTING])
+        ch.close = lambda: None
+        saved = api._create_database
+        api._create_database = lambda *args: ch
+        try:
+            load_report = report.Report('load', 'OnTime', 'OnTime')
+            api._load_server('OnTime', REPO_PATH, 'localhost', None, False,
+                             True, 'default', None, None, 2, False,
+                             'parquet_hive', 'year = 2000', 'manifest',
+                             {'max_insert_threads': 2}, load_report, False,
+                             None)
+        finally:
+            api._create_database = saved
+        self.assertEqual(2, len(ch.inserts))
+        self.assertEqual(20, sum(op.rows for op in load_report.operations))
+        self.assertIn('min_insert_block_size_rows = 33554432',
+                      ch.inserts[0])
+        self.assertIn('max_insert_threads = 2', ch.inserts[0])
+
+    def test_load_ontime_aio(self):
+        """Asyncio jobs post an event for each server-side insert"""
+        prefix = 'altinity-clickhouse-data/airline/data/ontime_parquet3/'
+        ch = FakeConnector([(prefix + path[len('bucket/airline/ontime/'):],
+                             size) for path, size in LISTING])
+        ch.close = lambda: None
+
+        async def main():
+            job = aio.start_load('OnTime', repo_path=REPO_PATH, parallel=2,
+                                 source='parquet_hive',
+                                 partition_filter='year = 2000')
+            events = [(e.state, e.name) async for e in job
+                      if e.state != 'message']
+            return events, await job
+
+        saved = api._create_database
+        api._create_database = lambda *args: ch
+        try:
+            events, load_report = asyncio.run(main())
+        finally:
+            api._create_database = saved
+        self.assertEqual(2, len(ch.inserts))
+        self.assertEqual(['started', 'started', 'succeeded', 'succeeded'],
+                         sorted(state for state, _ in events))
+        self.assertEqual(20, sum(op.rows for op in load_report.operations))
+        self.assertEqual(2, load_report.succeeded)
+
+
+if __name__ == '__main__':
+    unittest.main()
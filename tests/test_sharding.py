@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+"""Tests loads spread over the shards of a cluster"""
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import aio
+from altinity_datasets import api
+from altinity_datasets import bench
+from altinity_datasets import sharding
+from altinity_datasets import splits
+
+
+class FakeConnector:
+    """Records statements and returns cluster replicas"""
+
+    def __init__(self, clusters=()):
+        self.clusters = list(clusters)
+        self.statements = []
+        self.closed = False
+
+    def fetch_cluster(self, cluster):
+        return self.clusters
+
+    def execute(self, sql, verbose=False, dry_run=False):
+        self.statements.append(sql)
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+class Split(splits.FileSplit):
+    """Split with a given size"""
+
+    def __init__(self, path, size):
+        super().__init__(path)
+        self._size = size
+
+    def size(self):
+        return self._size
+
+
+class ShardingTest(unittest.TestCase):
+    def test_discover(self):
+        """Group replicas of each shard from system.clusters"""
+        ch = FakeConnector([(1, 1, 'a', 9000), (1, 1, 'b', 9000),
+                            (2, 2, 'c', 9001)])
+        shards = sharding.discover(ch, 'c1')
+        self.assertEqual([1, 2], [s.number for s in shards])
+        self.assertEqual([('a', 9000), ('b', 9000)], shards[0].replicas)
+        self.assertEqual(['a:9000', 'c:9001'], [s.name() for s in shards])
+        self.assertEqual(2, shards[1].weight)
+        with self.assertRaises(Exception):
+            sharding.discover(FakeConnector(), 'c2')
+
+    def test_parse_hosts(self):
+        """Each host is a shard with an optional port"""
+        shards = sharding.parse_hosts(['a:9001', 'b', '[::1]:9002', '::1'],
+                                      9000)
+        self.assertEqual([('a', 9001), ('b', 9000), ('::1', 9002),
+                          ('::1', 9000)], [(s.host, s.port) for s in shards])
+
+    def test_connect(self):
+        """Loads fail over to the next replica of a shard"""
+        shard = sharding.Shard(1, [('a', 9000), ('b', 9001)])
+
+        def connect(host, port):
+            if host == 'a':
+                raise Exception("Connection refused")
+            return host
+
+        self.assertEqual('b', shard.connect(connect))
+        self.assertEqual('b:9001', shard.name())
+        with self.assertRaises(Exception):
+            sharding.Shard(2, [('a', 9000)]).connect(connect)
+
+    def test_assign(self):
+        """Spread bytes over shards in proportion to their weight"""
+        shards = [sharding.Shard(1, [('a', None)]),
+                  sharding.Shard(2, [('b', None)], weight=2)]
+        load_files = [('t', Split('/d/{0}.csv'.format(size), size))
+                      for size in (60, 50, 40, 30, 20)]
+        assigned = sharding.assign(load_files, shards)
+        self.assertEqual([['50.csv', '20.csv'],
+                          ['60.csv', '40.csv', '30.csv']],
+                         [[os.path.basename(s.name()) for _, s in files]
+                          for _, files in assigned])
+
+    def test_ddl(self):
+        """Run DDL ON CLUSTER or on every host"""
+        ch = FakeConnector()
+        sharded = sharding.ShardedConnector(ch, [], 'c1')
+        sharded.ddl_connector().execute("CREATE TABLE t (x Int8) "
+                                        "ENGINE = Log")
+        self.assertEqual(["CREATE TABLE t ON CLUSTER `c1` (x Int8) "
+                          "ENGINE = Log"], ch.statements)
+
+        hosts = [FakeConnector(), FakeConnector()]
+        sharded = sharding.ShardedConnector(
+            hosts[0], list(zip(sharding.parse_hosts(['a', 'b']), hosts)))
+        sharded.ddl_connector().execute("CREATE TABLE t (x Int8) "
+                                        "ENGINE = Log")
+        self.assertEqual([1, 1], [len(h.statements) for h in hosts])
+        sharded.close()
+        self.assertTrue(all(h.closed for h in hosts))
+
+    def test_check_options(self):
+        """Reject a cluster with a host list or a server-side load"""
+        for options in ({'cluster': 'c', 'hosts': ['a']}, {'hosts': []},
+                        {'cluster': 'c', 'source': 'parquet'}):
+            with self.assertRaises(Exception):
+                api.dataset_load('x', **options)
+
+    def test_load_sink(self):
+        """Sharded loads spread files over hosts through the sink"""
+        workdir = tempfile.mkdtemp()
+        try:
+            spec = bench.BenchSpec(tables=2, files=2, file_size=5000)
+            repo_path = os.path.join(workdir, 'repo')
+            bench.generate(spec, repo_path)
+            with bench.sink(spec, workdir):
+                for loader, options in (
+                        ('client', {'cluster': 'c1'}),
+                        ('native', {'hosts': ['localhost:9000',
+                                              'localhost:9001']})):
+                    load_report = api.dataset_load(spec.name(),
+                                                   repo_path=repo_path,
+                                                   parallel=2,
+                                                   loader=loader,
+                                                   staging=True,
+                                                   **options)
+                    loads = [op for op in load_report.operations
+                             if op.name != 'publish']
+                    self.assertEqual(4, len(loads))
+                    self.assertEqual(0, load_report.failed)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_load_sink_aio(self):
+        """Asyncio jobs post an event for each file of a sharded load"""
+        workdir = tempfile.mkdtemp()
+        try:
+            spec = bench.BenchSpec(tables=2, files=2, file_size=5000)
+            repo_path = os.path.join(workdir, 'repo')
+            bench.generate(spec, repo_path)
+
+            async def main():
+                job = aio.start_load(spec.name(), repo_path=repo_path,
+                                     parallel=2, staging=True,
+                                     hosts=['localhost:9000',
+                                            'localhost:9001'])
+                events = [e.state async for e in job if e.state != 'message']
+                return events, await job
+
+            with bench.sink(spec, workdir):
+                events, load_report = asyncio.run(main())
+            self.assertEqual(['started'] * 4 + ['succeeded'] * 4,
+                             sorted(events))
+            loads = [op for op in load_report.operations
+                     if op.name != 'publish']
+            self.assertEqual(4, len(loads))
+            self.assertEqual(0, load_report.failed)
+            self.assertTrue(all(op.rows for op in loads))
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
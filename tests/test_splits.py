@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+"""Tests splitting of data files into ranges for parallel loading"""
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from altinity_datasets import splits
+
+
+class SplitsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.header = '"id","name"'
+        self.rows = ['{0},"row {0}"\n'.format(i) for i in range(1000)]
+        self.csv = os.path.join(self.dir, 'data-all.csv')
+        with open(self.csv, 'w') as f:
+            f.write(self.header + '\n')
+            f.writelines(self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _check_splits(self, file_splits):
+        """Each split has the header and together they cover all rows"""
+        rows = []
+        for split in file_splits:
+            lines = list(split.lines())
+            self.assertEqual(self.header + '\n', lines[0])
+            rows.extend(lines[1:])
+            output = subprocess.check_output(split.cat_command(),
+                                             shell=True).decode('utf-8')
+            self.assertEqual(''.join(lines), output)
+        self.assertEqual(self.rows, rows)
+
+    def test_whole_file(self):
+        """Files below the split size load as a single unit"""
+        file_splits = splits.plan_splits(self.csv, 1024 * 1024)
+        self.assertEqual(1, len(file_splits))
+        self._check_splits(file_splits)
+
+    def test_plain_splits(self):
+        """Plain CSV files split at line boundaries"""
+        file_splits = splits.plan_splits(self.csv, 1000)
+        self.assertTrue(len(file_splits) > 5)
+        self._check_splits(file_splits)
+
+    def test_seekable_splits(self):
+        """Seekable gzip files split at frame boundaries"""
+        gz = self.csv + '.gz'
+        with open(self.csv, 'rb') as f:
+            splits.write_seekable(f, gz, frame_size=500)
+        # The file is still an ordinary gzip file.
+        with gzip.open(gz, 'rt') as f:
+            self.assertEqual(self.header + '\n' + ''.join(self.rows),
+                             f.read())
+        file_splits = splits.plan_splits(gz, 300)
+        self.assertTrue(len(file_splits) > 5)
+        self._check_splits(file_splits)
+
+    def test_seekable_command(self):
+        """Write seekable files from a shell pipeline"""
+        gz = self.csv + '.gz'
+        cmd = "cat {0} | {1}".format(self.csv,
+                                     splits.seekable_command(gz, 500))
+        subprocess.check_call(cmd, shell=True)
+        self.assertIsNotNone(splits.read_index(gz))
+        self._check_splits(splits.plan_splits(gz, 1000))
+
+    def test_parallel_codecs(self):
+        """Compress frames on several threads with each codec"""
+        for codec, extension in (('gzip', 'gz'), ('zstd', 'zst'),
+                                 ('lz4', 'lz4')):
+            if codec != 'gzip' and not _has_module(codec):
+                continue
+            path = self.csv + '.' + extension
+            with open(self.csv, 'rb') as f:
+                index = splits.write_seekable(f,
+                                              path,
+                                              frame_size=500,
+                                              codec=codec,
+                                              threads=4)
+            self.assertEqual(os.path.getsize(self.csv), index['bytes_in'])
+            self.assertEqual(os.path.getsize(path), index['bytes_out'])
+            self._check_splits(splits.plan_splits(path, 300))
+
+    def test_unindexed_gzip(self):
+        """Compressed files without an index are not split"""
+        gz = self.csv + '.gz'
+        with open(self.csv, 'rb') as fin, gzip.open(gz, 'wb') as fout:
+            fout.write(fin.read())
+        file_splits = splits.plan_splits(gz, 10)
+        self.assertEqual(1, len(file_splits))
+        self._check_splits(file_splits)
+
+
+def _has_module(codec):
+    """Return True if the optional package for a codec is installed"""
+    try:
+        __import__({'zstd': 'zstandard', 'lz4': 'lz4.frame'}[codec])
+        return True
+    except ImportError:
+        return False
+
+
+if __name__ == '__main__':
+    unittest.main()
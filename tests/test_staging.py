@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+"""Tests loads through staging tables"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from altinity_datasets import api
+from altinity_datasets import bench
+from altinity_datasets import report
+from altinity_datasets import splits
+from altinity_datasets import staging
+
+
+class FakeConnector:
+    """Records statements and returns table metadata"""
+
+    def __init__(self, engine='MergeTree', parts=(), fail=0, tables=()):
+        self.database = 'db'
+        self.engine = engine
+        self.parts = list(parts)
+        self.tables = list(tables)
+        self.fail = fail
+        self.statements = []
+
+    def fetch_engine(self, table_name):
+        return self.engine.split('(')[0], self.engine
+
+    def fetch_table_names(self, prefix):
+        return [name for name in self.tables if name.startswith(prefix)]
+
+    def fetch_partition_ids(self, table_names):
+        return [part for part in self.parts if part[0] in table_names]
+
+    def execute(self, sql, dry_run=False):
+        if sql.startswith('ALTER') and self.fail > 0:
+            self.fail -= 1
+            raise Exception("Timeout")
+        self.statements.append(sql)
+        return []
+
+
+def load_files(table, count):
+    return [(table, splits.FileSplit('/d/{0}.csv'.format(i)))
+            for i in range(count)]
+
+
+class Journal:
+    """Records journal entries"""
+
+    def __init__(self, staged=(), published=()):
+        self.entries = []
+        self.staged = set(staged)
+        self.published = set(published)
+
+    def record(self, table, split, rows=None, staged=False):
+        self.entries.append((table, split.name(), rows, staged))
+
+    def publish(self, table):
+        self.staged.discard(table)
+        self.published.add(table)
+
+    def tables(self, staged):
+        return self.staged if staged else self.published
+
+
+class StagingTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_delay = staging.PUBLISH_RETRY_DELAY
+        staging.PUBLISH_RETRY_DELAY = 0
+
+    def tearDown(self):
+        staging.PUBLISH_RETRY_DELAY = self.saved_delay
+
+    def test_assign(self):
+        """Files spread over staging tables in load order"""
+        staged = staging.StagingTables(FakeConnector(), load_files('t', 3), 2)
+        self.assertEqual(['.staging_t_0', '.staging_t_1'], staged.staging['t'])
+        self.assertEqual(
+            ['`.staging_t_0`', '`.staging_t_1`', '`.staging_t_0`'],
+            [staged.insert_table(t, s) for t, s in load_files('t', 3)])
+
+    def test_replicated_engine(self):
+        """Staging tables of replicated tables are local"""
+        self.assertEqual(
+            "ReplacingMergeTree(ver) ORDER BY id",
+            staging.staging_engine(
+                "ReplicatedReplacingMergeTree('/t/{shard}', '{replica}', "
+                "ver) ORDER BY id"))
+        ch = FakeConnector("ReplicatedMergeTree('/t', 'r') ORDER BY id")
+        staged = staging.StagingTables(ch, load_files('t', 1), 2)
+        staged.create('t')
+        staged.create('t')
+        self.assertEqual([
+            "CREATE TABLE `.staging_t_0` AS t ENGINE = MergeTree() "
+            "ORDER BY id"
+        ], ch.statements)
+
+    def test_publish(self):
+        """Partitions gather in one staging table and replace the target
+           partition, retrying failures"""
+        ch = FakeConnector(parts=[('.staging_t_1', '2019'),
+                                  ('.staging_t_0', '2020'),
+                                  ('.staging_t_0', '2019')],
+                           fail=1)
+        journal = Journal()
+        staged = staging.StagingTables(ch, load_files('t', 2), 2, journal)
+        staged.create('t')
+        for table, split in load_files('t', 2):
+            staged.record(table, split, 5)
+        load_report = report.Report('load', 'ds', 'db')
+        staged.publish_all(load_report)
+        self.assertEqual([
+            "ALTER TABLE `.staging_t_1` MOVE PARTITION ID '2019' TO TABLE "
+            "`.staging_t_0`",
+            "ALTER TABLE t REPLACE PARTITION ID '2019' FROM `.staging_t_0`",
+            "ALTER TABLE t REPLACE PARTITION ID '2020' FROM `.staging_t_0`",
+            "DROP TABLE IF EXISTS `.staging_t_0`",
+            "DROP TABLE IF EXISTS `.staging_t_1`"
+        ], ch.statements[2:])
+        self.assertEqual(['succeeded'],
+                         [op.status for op in load_report.operations])
+        self.assertEqual(2, len(journal.entries))
+        self.assertFalse(any(entry[3] for entry in journal.entries))
+
+    def test_failed_loads(self):
+        """Tables with failed loads are not published.  Their staging
+           tables are kept and the files they hold are journaled"""
+        ch = FakeConnector(parts=[('.staging_t_0', '2020')])
+        journal = Journal()
+        staged = staging.StagingTables(ch, load_files('t', 2), 1, journal)
+        staged.create('t')
+        staged.record('t', load_files('t', 1)[0][1], 5)
+        load_report = report.Report('load', 'ds', 'db')
+        load_report.add('t', '1.csv').status = 'failed'
+        self.assertEqual(['t'], staged.publish_all(load_report))
+        staged.close()
+        self.assertFalse(any('REPLACE' in sql or 'DROP' in sql
+                             for sql in ch.statements))
+        self.assertEqual([('t', '0.csv', 5, True)], journal.entries)
+        with self.assertRaises(Exception):
+            api.check_load('files', True, True, 'company', None)
+
+    def test_resume(self):
+        """A resumed load loads remaining files into kept staging tables
+           and publishes them"""
+        ch = FakeConnector(parts=[('.staging_t_0', '2020'),
+                                  ('.staging_t_1', '2020'),
+                                  ('.staging_u_0', '2019')],
+                           tables=['.staging_t_0', '.staging_t_1',
+                                   '.staging_u_0'])
+        remaining = load_files('t', 1)
+        staged = staging.StagingTables(ch, remaining, 2, Journal())
+        with self.assertRaises(Exception):
+            staged.adopt_leftover(False)
+        with self.assertRaises(Exception):
+            # Kept tables must hold journaled files.
+            staged.adopt_leftover(True)
+
+        journal = Journal(staged=['t', 'u'])
+        staged = staging.StagingTables(ch, remaining, 2, journal)
+        staged.adopt_leftover(True)
+        self.assertEqual(
+            {'t': ['.staging_t_0', '.staging_t_1'], 'u': ['.staging_u_0']},
+            dict(staged.staging))
+        staged.create('t')
+        staged.record('t', remaining[0][1])
+        load_report = report.Report('load', 'ds', 'db')
+        self.assertEqual([], staged.publish_all(load_report))
+        self.assertFalse(any('CREATE' in sql for sql in ch.statements))
+        self.assertIn(
+            "ALTER TABLE u REPLACE PARTITION ID '2019' FROM `.staging_u_0`",
+            ch.statements)
+        self.assertEqual({'t', 'u'}, journal.published)
+
+        # Replacing partitions would drop rows of published files.
+        ch = FakeConnector()
+        staged = staging.StagingTables(ch, remaining, 2,
+                                       Journal(published=['t']))
+        with self.assertRaises(Exception):
+            staged.adopt_leftover(True)
+
+    def test_failed_publish(self):
+        """Staging tables of a table that fails to publish are kept until a
+           retry publishes them"""
+        ch = FakeConnector(parts=[('.staging_t_0', '2020')],
+                           fail=staging.PUBLISH_ATTEMPTS)
+        journal = Journal()
+        staged = staging.StagingTables(ch, load_files('t', 1), 1, journal)
+        staged.create('t')
+        staged.record('t', load_files('t', 1)[0][1])
+        load_report = report.Report('load', 'ds', 'db')
+        self.assertEqual(['t'], staged.publish_all(load_report))
+        staged.close()
+        self.assertFalse(any('DROP' in sql for sql in ch.statements[1:]))
+        self.assertEqual([('t', '0.csv', None, True)], journal.entries)
+        with self.assertRaises(Exception):
+            staging.check_published(['t'])
+
+        ch = FakeConnector(parts=[('.staging_t_0', '2020')],
+                           tables=['.staging_t_x', '.staging_t_0'])
+        staged = staging.StagingTables.leftover(ch)
+        self.assertEqual({'t': ['.staging_t_0']}, dict(staged.staging))
+        load_report = report.Report('load', 'ds', 'db')
+        self.assertEqual([], staged.publish_all(load_report))
+        self.assertIn(
+            "ALTER TABLE t REPLACE PARTITION ID '2020' FROM `.staging_t_0`",
+            ch.statements)
+        self.assertIn("DROP TABLE IF EXISTS `.staging_t_0`", ch.statements)
+
+    def test_load_sink(self):
+        """Staged loads publish each table through the sink"""
+        workdir = tempfile.mkdtemp()
+        try:
+            spec = bench.BenchSpec(tables=2, files=2, file_size=5000,
+                                   partitions=2)
+            repo_path = os.path.join(workdir, 'repo')
+            bench.generate(spec, repo_path)
+            with bench.sink(spec, workdir):
+                for loader in ('client', 'native'):
+                    load_report = api.dataset_load(spec.name(),
+                                                   repo_path=repo_path,
+                                                   parallel=2,
+                                                   loader=loader,
+                                                   staging=True)
+                    publish = [op for op in load_report.operations
+                               if op.name == 'publish']
+                    self.assertEqual(2, len(publish))
+                    self.assertEqual(0, load_report.failed)
+        finally:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+"""Tests insert settings profiles"""
+import unittest
+
+from altinity_datasets import tuning
+
+GB = 1024 * 1024 * 1024
+
+MANIFEST = {
+    'settings': {
+        '*': {
+            'max_insert_threads': 2,
+            'input_format_parallel_parsing': False
+        },
+        'big': {
+            'min_insert_block_size_rows': 1000
+        }
+    }
+}
+
+
+class TuningTest(unittest.TestCase):
+    def test_layers(self):
+        """Manifest settings override defaults and overrides win"""
+        settings = tuning.LoadSettings(MANIFEST,
+                                       'manifest',
+                                       overrides={'max_insert_threads': 8},
+                                       defaults={
+                                           'max_insert_threads': 1,
+                                           'min_insert_block_size_rows': 5
+                                       })
+        self.assertEqual(
+            {
+                'max_insert_threads': 8,
+                'input_format_parallel_parsing': False,
+                'min_insert_block_size_rows': 1000
+            }, settings.table('big'))
+        self.assertEqual(5, settings.table('small')[
+            'min_insert_block_size_rows'])
+
+    def test_profiles(self):
+        """Auto settings apply only to the auto profile and none ignores the
+           manifest"""
+        auto = {'max_insert_threads': 4, 'min_insert_block_size_bytes': GB}
+        settings = tuning.LoadSettings(MANIFEST, 'auto', auto)
+        self.assertEqual(GB, settings.table('t')[
+            'min_insert_block_size_bytes'])
+        self.assertEqual(2, settings.table('t')['max_insert_threads'])
+        self.assertNotIn('min_insert_block_size_bytes',
+                         tuning.LoadSettings(MANIFEST, 'manifest',
+                                             auto).table('t'))
+        self.assertEqual({'a': 1},
+                         tuning.LoadSettings(MANIFEST, 'none',
+                                             overrides={
+                                                 'a': 1
+                                             }).table('big'))
+        with self.assertRaises(Exception):
+            tuning.LoadSettings(MANIFEST, 'fast')
+        with self.assertRaises(Exception):
+            tuning.LoadSettings({'settings': {'t': 5}})
+
+    def test_auto_settings(self):
+        """Blocks share half of memory across parallel inserts"""
+        settings = tuning.auto_settings({
+            'memory': 64 * GB,
+            'cores': 16,
+            'max_memory_usage': None
+        }, 4)
+        self.assertEqual(4, settings['max_insert_threads'])
+        self.assertEqual(2 * GB, settings['min_insert_block_size_bytes'])
+        # Per-query memory limits and bounds apply.
+        settings = tuning.auto_settings({
+            'memory': 64 * GB,
+            'cores': 2,
+            'max_memory_usage': 2 * GB
+        }, 8)
+        self.assertEqual(1, settings['max_insert_threads'])
+        self.assertEqual(int(1.6 * GB),
+                         settings['min_insert_block_size_bytes'])
+        settings = tuning.auto_settings({}, 1)
+        self.assertEqual(tuning.AUTO_MIN_BLOCK_BYTES,
+                         settings['min_insert_block_size_bytes'])
+
+    def test_client_options(self):
+        """Settings become clickhouse-client options"""
+        self.assertEqual(
+            " --input_format_parallel_parsing=0 --max_insert_threads=2"
+            " --x='a b'",
+            tuning.client_options({
+                'max_insert_threads': 2,
+                'input_format_parallel_parsing': False,
+                'x': 'a b'
+            }))
+
+
+if __name__ == '__main__':
+    unittest.main()